@@ -9,6 +9,8 @@ import logging
 from collections import OrderedDict
 import installSoftware
 import ssh_deploy
+import molns_trace
+import molns_tls
 from molns_provider import ProviderBase, ProviderException
 
 #logging.getLogger('boto').setLevel(logging.ERROR)
@@ -177,13 +179,18 @@ class EC2Controller(EC2Base):
     [
     ('instance_type',
         {'q':'Default Instance Type', 'default':'c3.large', 'ask':True}),
+    ('tls_key_type',
+        {'q':'Key type of the notebook certificate (rsa, or ec: much faster to create)', 'default':'rsa', 'ask':True, 'choices':molns_tls.KEY_TYPES}),
     ])
 
     def _connect(self):
         if self.connected: return
-        self.ec2 = CreateVM(config=self.provider)
+        # Share the connection of the provider object.
+        self.provider._connect()
+        self.ec2 = self.provider.ec2
         self.connected = True
 
+    @molns_trace.traced()
     def start_instance(self, num=1):
         """ Start or resume the controller. """
         try:
@@ -192,7 +199,7 @@ class EC2Controller(EC2Base):
             ret = []
             for instance in instances:
                 ip = instance.public_dns_name
-                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id)
+                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id, instance_type=self.config['instance_type'], status=self.STATUS_RUNNING)
                 ret.append(i)
             if num == 1:
                 return ret[0]
@@ -202,6 +209,7 @@ class EC2Controller(EC2Base):
             logging.exception(e)
             raise ProviderException("Failed to start molns instance: {0}".format(e))
 
+    @molns_trace.traced()
     def resume_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
@@ -228,6 +236,7 @@ class EC2Controller(EC2Base):
             instances.ip_address = new_instance[0].public_dns_name
             logging.debug("instance.id={0} updated with ip={1}".format(instances.provider_instance_identifier, instances.ip_address))
 
+    @molns_trace.traced()
     def stop_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
@@ -240,15 +249,16 @@ class EC2Controller(EC2Base):
             ec2_instance = self.ec2.get_instance(instances.provider_instance_identifier)
             self.ec2.stop_ec2_instances([ec2_instance])
 
+    @molns_trace.traced()
     def terminate_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
             ec2_instances = []
             for instance in instances:
-                ec2_instance = self.ec2.get_instance(instances.provider_instance_identifier)
+                ec2_instance = self.ec2.get_instance(instance.provider_instance_identifier)
                 ec2_instances.append(ec2_instance)
-                self.datastore.delete_instance(instance)
             self.ec2.terminate_ec2_instances(ec2_instances)
+            self.datastore.delete_instances(instances)
         else:
             ec2_instance = self.ec2.get_instance(instances.provider_instance_identifier)
             self.ec2.terminate_ec2_instances([ec2_instance])
@@ -261,6 +271,30 @@ class EC2Controller(EC2Base):
         except Exception as e:
             #logging.exception(e)
             return self.STATUS_TERMINATED
+        return self._get_status_from_state(status)
+
+    @molns_trace.traced()
+    def get_instances_status(self, instances):
+        """ Get the status of several instances with one request.
+        Returns:
+            A dict of provider_instance_identifier -> status.
+        """
+        self._connect()
+        try:
+            states = self.ec2.get_instances_state([i.provider_instance_identifier for i in instances])
+        except ProviderException as e:
+            # The request fails as a whole if one of the instances is unknown.
+            logging.debug("EC2Controller.get_instances_status() falling back to one request per instance: {0}".format(e))
+            return ProviderBase.get_instances_status(self, instances)
+        ret = {}
+        for i in instances:
+            if i.provider_instance_identifier in states:
+                ret[i.provider_instance_identifier] = self._get_status_from_state(states[i.provider_instance_identifier])
+            else:
+                ret[i.provider_instance_identifier] = self.STATUS_TERMINATED
+        return ret
+
+    def _get_status_from_state(self, status):
         if status == 'running' or status == 'pending':
             return self.STATUS_RUNNING
         if status == 'stopped' or status == 'stopping':
@@ -284,6 +318,7 @@ class EC2WorkerGroup(EC2Controller):
         {'q':'Number of virtual machines in group', 'default':'1', 'ask':True}),
     ])
 
+    @molns_trace.traced()
     def start_instance(self, num=1):
         """ Start worker group vms. """
         try:
@@ -292,7 +327,7 @@ class EC2WorkerGroup(EC2Controller):
             ret = []
             for instance in instances:
                 ip = instance.public_dns_name
-                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id,  worker_group_id=self.id)
+                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id,  worker_group_id=self.id, instance_type=self.config['instance_type'], status=self.STATUS_RUNNING)
                 ret.append(i)
             if num == 1:
                 return ret[0]
@@ -302,6 +337,7 @@ class EC2WorkerGroup(EC2Controller):
             logging.exception(e)
             raise ProviderException("Failed to start molns instance: {0}".format(e))
 
+    @molns_trace.traced()
     def terminate_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
@@ -309,8 +345,8 @@ class EC2WorkerGroup(EC2Controller):
             for instance in instances:
                 ec2_instance = self.ec2.get_instance(instance.provider_instance_identifier)
                 ec2_instances.append(ec2_instance)
-                self.datastore.delete_instance(instance)
             self.ec2.terminate_ec2_instances(ec2_instances)
+            self.datastore.delete_instances(instances)
         else:
             ec2_instance = self.ec2.get_instance(instances.provider_instance_identifier)
             self.ec2.terminate_ec2_instances([ec2_instance])
@@ -357,6 +393,20 @@ class CreateVM:
     def get_instance_status(self, instance_id):
         return self.get_instance(instance_id).state
 
+    def get_instances_state(self, instance_ids):
+        """ Return a dict of instance_id -> state, using one request for all the instances. """
+        if len(instance_ids) == 0:
+            return {}
+        try:
+            reservations = self.conn.get_all_reservations(instance_ids=instance_ids)
+        except EC2ResponseError as e:
+            raise ProviderException("failed to get the state of instances {0}: {1}".format(instance_ids, e))
+        states = {}
+        for reservation in reservations:
+            for instance in reservation.instances:
+                states[instance.id] = instance.state
+        return states
+
     
     def get_vm_status(self, key_name=None, verbose=False, show_all=False):
         if key_name is None:
@@ -385,6 +435,7 @@ class CreateVM:
         except IndexError:
             return False
 
+    @molns_trace.traced()
     def start_vms(self, image_id=None, key_name=None, group_name=None, num=None, instance_type=None):
         if key_name is None:
             key_name = self.config['key_name']
@@ -449,6 +500,7 @@ class CreateVM:
         print "EC2 instances started."
         return sorted(instances, key=lambda vm: vm.id)
 
+    @molns_trace.traced()
     def start_ec2_instances(self, image_id=None, key_name=None, group_name=None, num=1, instance_type=None):
         if key_name is None:
             key_name = self.config['key_name']
@@ -497,6 +549,7 @@ class CreateVM:
         (stopped_vms, running_vms) = self.get_vm_status(key_name)
         self.terminate_ec2_instances(running_vms+stopped_vms)
 
+    @molns_trace.traced()
     def resume_ec2_instances(self, instances):
         num_instance = len(instances) 
         print "Resuming EC2 instance(s). This will take a minute..."
@@ -515,6 +568,7 @@ class CreateVM:
         print "EC2 instances resumed."
         return instances
 
+    @molns_trace.traced()
     def stop_ec2_instances(self, instances):
         num_instance = len(instances) 
         print "Stopping EC2 instance(s). This will take a minute..."
@@ -532,6 +586,7 @@ class CreateVM:
                     time.sleep(5)
         print "EC2 instances stopped."
 
+    @molns_trace.traced()
     def terminate_ec2_instances(self, instances):
         num_instance = len(instances) 
         print "Terminating EC2 instance(s). This will take a minute..."
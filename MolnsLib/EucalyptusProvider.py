@@ -11,6 +11,8 @@ from urlparse import urlparse
 from collections import OrderedDict
 import installSoftware
 import ssh_deploy
+import molns_trace
+import molns_tls
 from molns_provider import ProviderBase, ProviderException
 
 #logging.getLogger('boto').setLevel(logging.ERROR)
@@ -204,13 +206,18 @@ class EucalyptusController(EucalyptusBase):
     [
     ('instance_type',
         {'q':'Default Instance Type', 'default':'c3.large', 'ask':True}),
+    ('tls_key_type',
+        {'q':'Key type of the notebook certificate (rsa, or ec: much faster to create)', 'default':'rsa', 'ask':True, 'choices':molns_tls.KEY_TYPES}),
     ])
 
     def _connect(self):
         if self.connected: return
-        self.eucalyptus = CreateVM(config=self.provider)
+        # Share the connection of the provider object.
+        self.provider._connect()
+        self.eucalyptus = self.provider.eucalyptus
         self.connected = True
 
+    @molns_trace.traced()
     def start_instance(self, num=1):
         """ Start or resume the controller. """
         try:
@@ -219,7 +226,7 @@ class EucalyptusController(EucalyptusBase):
             ret = []
             for instance in instances:
                 ip = instance.public_dns_name
-                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id)
+                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id, instance_type=self.config['instance_type'], status=self.STATUS_RUNNING)
                 ret.append(i)
             if num == 1:
                 return ret[0]
@@ -229,6 +236,7 @@ class EucalyptusController(EucalyptusBase):
             logging.exception(e)
             raise ProviderException("Failed to start molns instance: {0}".format(e))
 
+    @molns_trace.traced()
     def resume_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
@@ -255,6 +263,7 @@ class EucalyptusController(EucalyptusBase):
             instances.ip_address = new_instance[0].public_dns_name
             logging.debug("instance.id={0} updated with ip={1}".format(instances.provider_instance_identifier, instances.ip_address))
 
+    @molns_trace.traced()
     def stop_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
@@ -267,15 +276,16 @@ class EucalyptusController(EucalyptusBase):
             eucalyptus_instance = self.eucalyptus.get_instance(instances.provider_instance_identifier)
             self.eucalyptus.stop_eucalyptus_instances([eucalyptus_instance])
 
+    @molns_trace.traced()
     def terminate_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
             eucalyptus_instances = []
             for instance in instances:
-                eucalyptus_instance = self.eucalyptus.get_instance(instances.provider_instance_identifier)
+                eucalyptus_instance = self.eucalyptus.get_instance(instance.provider_instance_identifier)
                 eucalyptus_instances.append(eucalyptus_instance)
-                self.datastore.delete_instance(instance)
             self.eucalyptus.terminate_eucalyptus_instances(eucalyptus_instances)
+            self.datastore.delete_instances(instances)
         else:
             eucalyptus_instance = self.eucalyptus.get_instance(instances.provider_instance_identifier)
             self.eucalyptus.terminate_eucalyptus_instances([eucalyptus_instance])
@@ -288,6 +298,30 @@ class EucalyptusController(EucalyptusBase):
         except Exception as e:
             #logging.exception(e)
             return self.STATUS_TERMINATED
+        return self._get_status_from_state(status)
+
+    @molns_trace.traced()
+    def get_instances_status(self, instances):
+        """ Get the status of several instances with one request.
+        Returns:
+            A dict of provider_instance_identifier -> status.
+        """
+        self._connect()
+        try:
+            states = self.eucalyptus.get_instances_state([i.provider_instance_identifier for i in instances])
+        except ProviderException as e:
+            # The request fails as a whole if one of the instances is unknown.
+            logging.debug("EucalyptusController.get_instances_status() falling back to one request per instance: {0}".format(e))
+            return ProviderBase.get_instances_status(self, instances)
+        ret = {}
+        for i in instances:
+            if i.provider_instance_identifier in states:
+                ret[i.provider_instance_identifier] = self._get_status_from_state(states[i.provider_instance_identifier])
+            else:
+                ret[i.provider_instance_identifier] = self.STATUS_TERMINATED
+        return ret
+
+    def _get_status_from_state(self, status):
         if status == 'running' or status == 'pending':
             return self.STATUS_RUNNING
         if status == 'stopped' or status == 'stopping':
@@ -311,6 +345,7 @@ class EucalyptusWorkerGroup(EucalyptusController):
         {'q':'Number of virtual machines in group', 'default':'1', 'ask':True}),
     ])
 
+    @molns_trace.traced()
     def start_instance(self, num=1):
         """ Start worker group vms. """
         try:
@@ -319,7 +354,7 @@ class EucalyptusWorkerGroup(EucalyptusController):
             ret = []
             for instance in instances:
                 ip = instance.public_dns_name
-                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id,  worker_group_id=self.id)
+                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id,  worker_group_id=self.id, instance_type=self.config['instance_type'], status=self.STATUS_RUNNING)
                 ret.append(i)
             if num == 1:
                 return ret[0]
@@ -329,6 +364,7 @@ class EucalyptusWorkerGroup(EucalyptusController):
             logging.exception(e)
             raise ProviderException("Failed to start molns instance: {0}".format(e))
 
+    @molns_trace.traced()
     def terminate_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
@@ -336,8 +372,8 @@ class EucalyptusWorkerGroup(EucalyptusController):
             for instance in instances:
                 eucalyptus_instance = self.eucalyptus.get_instance(instance.provider_instance_identifier)
                 eucalyptus_instances.append(eucalyptus_instance)
-                self.datastore.delete_instance(instance)
             self.eucalyptus.terminate_eucalyptus_instances(eucalyptus_instances)
+            self.datastore.delete_instances(instances)
         else:
             eucalyptus_instance = self.eucalyptus.get_instance(instances.provider_instance_identifier)
             self.eucalyptus.terminate_eucalyptus_instances([eucalyptus_instance])
@@ -398,6 +434,20 @@ class CreateVM:
     def get_instance_status(self, instance_id):
         return self.get_instance(instance_id).state
 
+    def get_instances_state(self, instance_ids):
+        """ Return a dict of instance_id -> state, using one request for all the instances. """
+        if len(instance_ids) == 0:
+            return {}
+        try:
+            reservations = self.conn.get_all_reservations(instance_ids=instance_ids)
+        except EC2ResponseError as e:
+            raise ProviderException("failed to get the state of instances {0}: {1}".format(instance_ids, e))
+        states = {}
+        for reservation in reservations:
+            for instance in reservation.instances:
+                states[instance.id] = instance.state
+        return states
+
     
     def get_vm_status(self, key_name=None, verbose=False, show_all=False):
         if key_name is None:
@@ -426,6 +476,7 @@ class CreateVM:
         except IndexError:
             return False
 
+    @molns_trace.traced()
     def start_vms(self, image_id=None, key_name=None, group_name=None, num=None, instance_type=None):
         if key_name is None:
             key_name = self.config['key_name']
@@ -490,6 +541,7 @@ class CreateVM:
         print "Eucalyptus instances started."
         return sorted(instances, key=lambda vm: vm.id)
 
+    @molns_trace.traced()
     def start_eucalyptus_instances(self, image_id=None, key_name=None, group_name=None, num=1, instance_type=None):
         if key_name is None:
             key_name = self.config['key_name']
@@ -538,6 +590,7 @@ class CreateVM:
         (stopped_vms, running_vms) = self.get_vm_status(key_name)
         self.terminate_eucalyptus_instances(running_vms+stopped_vms)
 
+    @molns_trace.traced()
     def resume_eucalyptus_instances(self, instances):
         num_instance = len(instances) 
         print "Resuming Eucalyptus instance(s). This will take a minute..."
@@ -556,6 +609,7 @@ class CreateVM:
         print "Eucalyptus instances resumed."
         return instances
 
+    @molns_trace.traced()
     def stop_eucalyptus_instances(self, instances):
         num_instance = len(instances) 
         print "Stopping Eucalyptus instance(s). This will take a minute..."
@@ -573,6 +627,7 @@ class CreateVM:
                     time.sleep(5)
         print "Eucalyptus instances stopped."
 
+    @molns_trace.traced()
     def terminate_eucalyptus_instances(self, instances):
         num_instance = len(instances) 
         print "Terminating Eucalyptus instance(s). This will take a minute..."
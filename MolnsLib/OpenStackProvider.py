@@ -6,6 +6,8 @@ from novaclient import client as novaclient
 from collections import OrderedDict
 import collections
 import installSoftware
+import molns_trace
+import molns_tls
 from molns_provider import ProviderBase, ProviderException
 
 # quite the logging of 'requests.packages.urllib3.connectionpool'
@@ -213,6 +215,19 @@ class OpenStackProvider(OpenStackBase):
         instance = self.nova.servers.get(instance_id)
         return instance.status
 
+    def _get_instances_status(self, instance_ids):
+        """ Return a dict of instance_id -> status for the instances found by listing all the
+        servers of the project (every page of the listing). """
+        self._connect()
+        instance_ids = set(instance_ids)
+        try:
+            # limit=-1: all the pages, not only the first osapi_max_limit servers.
+            servers = self.nova.servers.list(limit=-1)
+        except TypeError:
+            # A novaclient without paging: the ids not listed are asked for one by one.
+            servers = self.nova.servers.list()
+        return dict((server.id, server.status) for server in servers if server.id in instance_ids)
+
     def _stop_instances(self, instance_ids):
         self._connect()
         instances = []
@@ -220,6 +235,7 @@ class OpenStackProvider(OpenStackBase):
             instances.append(self.nova.servers.get(instance_id))
         self._stop_vm(instances)
 
+    @molns_trace.traced()
     def _resume_instances(self, instance_ids):
         self._connect()
         for instance_id in instance_ids:
@@ -242,6 +258,7 @@ class OpenStackProvider(OpenStackBase):
                 instance.delete()
                 raise ProviderException("Failed to boot vm\n{0}".format(e))
 
+    @molns_trace.traced()
     def _terminate_instances(self, instance_ids):
         self._connect()
         if not isinstance(instance_ids, list):
@@ -271,6 +288,7 @@ class OpenStackProvider(OpenStackBase):
             raise ProviderException("Failed to terminate vm(s)\n{0}".format(e))
     
 
+    @molns_trace.traced()
     def _stop_vm(self, instances):
         self._connect()
         if not isinstance(instances, list):
@@ -305,6 +323,7 @@ class OpenStackProvider(OpenStackBase):
             instance_type = self.config["default_instance_type"]
         return self.__boot_vm(self.config["molns_image_name"], instance_type=instance_type, num=num)
 
+    @molns_trace.traced()
     def __boot_vm(self, image_name, instance_type, num=1):
         self._connect()
         instances = []
@@ -354,6 +373,7 @@ class OpenStackProvider(OpenStackBase):
             logging.exception(e)
             raise ProviderException("Could not delete floating ip '{0}'".format(ip))
 
+    @molns_trace.traced()
     def _attach_floating_ip(self, instance):
        # Try to attach a floating IP to the controller
         logging.info("Attaching floating ip to the server...")
@@ -375,8 +395,11 @@ class OpenStackController(OpenStackBase):
     [
     ('instance_type',
         {'q':'Default Instance Type (Flavor)', 'default':'standard.xsmall', 'ask':True}),
+    ('tls_key_type',
+        {'q':'Key type of the notebook certificate (rsa, or ec: much faster to create)', 'default':'rsa', 'ask':True, 'choices':molns_tls.KEY_TYPES}),
     ])
 
+    @molns_trace.traced()
     def start_instance(self, num=1):
         """ Start or resume the controller. """
         #print "nova_instance = self.provider._boot_molns_vm(self, instance_type={0})".format(self.config['instance_type'])
@@ -385,14 +408,15 @@ class OpenStackController(OpenStackBase):
             ret = []
             for i in nova_instance:
                 ip = self.provider._attach_floating_ip(i)
-                i  = self.datastore.get_instance(provider_instance_identifier=i.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id)
+                i  = self.datastore.get_instance(provider_instance_identifier=i.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id, instance_type=self.config['instance_type'], status=self.STATUS_RUNNING)
                 ret.append(i)
             return ret
         else:
             ip = self.provider._attach_floating_ip(nova_instance)
-            i  = self.datastore.get_instance(provider_instance_identifier=nova_instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id)
+            i  = self.datastore.get_instance(provider_instance_identifier=nova_instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id, instance_type=self.config['instance_type'], status=self.STATUS_RUNNING)
             return i
 
+    @molns_trace.traced()
     def resume_instance(self, instances):
         if isinstance(instances, list):
             pids = [x.provider_instance_identifier for x in instances]
@@ -400,6 +424,7 @@ class OpenStackController(OpenStackBase):
         else:
             self.provider._resume_instances([instances.provider_instance_identifier])
 
+    @molns_trace.traced()
     def stop_instance(self, instances):
         if isinstance(instances, list):
             pids = [x.provider_instance_identifier for x in instances]
@@ -407,14 +432,15 @@ class OpenStackController(OpenStackBase):
         else:
             self.provider._stop_instances([instances.provider_instance_identifier])
 
+    @molns_trace.traced()
     def terminate_instance(self, instances):
         if isinstance(instances, list):
             pids = []
             for instance in instances:
-                self.provider._delete_floating_ip(instances.ip_address)
-                self.datastore.delete_instance(instances)
+                self.provider._delete_floating_ip(instance.ip_address)
                 pids.append(instance.provider_instance_identifier)
             self.provider._terminate_instances(pids)
+            self.datastore.delete_instances(instances)
         else:
             self.provider._terminate_instances([instances.provider_instance_identifier])
             self.provider._delete_floating_ip(instances.ip_address)
@@ -425,6 +451,25 @@ class OpenStackController(OpenStackBase):
             status = self.provider._get_instance_status(instance.provider_instance_identifier)
         except novaclient.exceptions.NotFound as e:
             return self.STATUS_TERMINATED
+        return self._get_status_from_server_status(status)
+
+    @molns_trace.traced()
+    def get_instances_status(self, instances):
+        """ Get the status of several instances with one request.
+        Returns:
+            A dict of provider_instance_identifier -> status.
+        """
+        statuses = self.provider._get_instances_status([i.provider_instance_identifier for i in instances])
+        ret = {}
+        for i in instances:
+            if i.provider_instance_identifier in statuses:
+                ret[i.provider_instance_identifier] = self._get_status_from_server_status(statuses[i.provider_instance_identifier])
+            else:
+                # Not listed: asked for directly, terminated only if the server is not found.
+                ret[i.provider_instance_identifier] = self.get_instance_status(i)
+        return ret
+
+    def _get_status_from_server_status(self, status):
         if status == 'ACTIVE' or status == 'BUILD':
             return self.STATUS_RUNNING
         if status == 'SHUTOFF':
@@ -448,6 +493,7 @@ class OpenStackWorkerGroup(OpenStackController):
         {'q':'Number of virtual machines in group', 'default':'1', 'ask':True}),
     ])
 
+    @molns_trace.traced()
     def start_instance(self, num=1):
         """ Start or resume the controller. """
         #print "nova_instance = self.provider._boot_molns_vm(self, instance_type={0})".format(self.config['instance_type'])
@@ -461,7 +507,7 @@ class OpenStackWorkerGroup(OpenStackController):
                     logging.exception(e)
                     logging.debug("Terminating instance {0}".format(i.id))
                     i.delete()
-                inst  = self.datastore.get_instance(provider_instance_identifier=i.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id, worker_group_id=self.id)
+                inst  = self.datastore.get_instance(provider_instance_identifier=i.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id, worker_group_id=self.id, instance_type=self.config['instance_type'], status=self.STATUS_RUNNING)
                 ret.append(inst)
             return ret
         else:
@@ -473,17 +519,18 @@ class OpenStackWorkerGroup(OpenStackController):
                 nova_instance.delete()
                 raise e
 
-            i  = self.datastore.get_instance(provider_instance_identifier=nova_instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id, worker_group_id=self.id)
+            i  = self.datastore.get_instance(provider_instance_identifier=nova_instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id, worker_group_id=self.id, instance_type=self.config['instance_type'], status=self.STATUS_RUNNING)
             return i
 
+    @molns_trace.traced()
     def terminate_instance(self, instances):
         if isinstance(instances, list):
             pids = []
             for instance in instances:
                 self.provider._delete_floating_ip(instance.ip_address)
                 pids.append(instance.provider_instance_identifier)
-                self.datastore.delete_instance(instance)
             self.provider._terminate_instances(pids)
+            self.datastore.delete_instances(instances)
         else:
             self.provider._terminate_instances([instances.provider_instance_identifier])
             self.provider._delete_floating_ip(instances.ip_address)
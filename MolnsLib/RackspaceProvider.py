@@ -5,6 +5,7 @@ import logging
 from collections import OrderedDict
 import collections
 import installSoftware
+import molns_tls
 from molns_provider import ProviderBase, ProviderException
 from OpenStackProvider import OpenStackProvider, OpenStackController, OpenStackWorkerGroup
 import pyrax
@@ -67,6 +68,8 @@ class RackspaceController(OpenStackController):
     [
     ('instance_type',
         {'q':'Default Instance Type (Flavor)', 'default':'standard.xsmall', 'ask':True}),
+    ('tls_key_type',
+        {'q':'Key type of the notebook certificate (rsa, or ec: much faster to create)', 'default':'rsa', 'ask':True, 'choices':molns_tls.KEY_TYPES}),
     ])
 
 ##########################################
@@ -0,0 +1,136 @@
+import time
+import random
+import base64
+import hashlib
+import pipes
+
+#############################################################
+# The steps of a deployment, run on the host as one shell script.
+#
+#   plan = DeployPlan('controller')
+#   plan.step('scratch space', "sudo mkdir -p /mnt/molnsarea", "sudo chown ubuntu /mnt/molnsarea")
+#   plan.write_file('.molns/s3.json', data)
+#   script = plan.render()
+#
+# Each command of a step runs in its own subshell, as if it had been run with exec_command,
+# and the step fails if a command returns a non-zero exit code.  The script prints a marker
+# line when a step begins, ends or fails, which DeployPlanProgress reads from the output to
+# report each step.
+#############################################################
+
+STEP_MARKER = '@@MOLNS-STEP'
+
+class DeployPlan():
+    def __init__(self, name):
+        self.name = name
+        # A list of (step name, [command, ...])
+        self.steps = []
+
+    def step(self, name, *commands):
+        """ Add a step, that runs the commands (shell command lines) in order. """
+        self.steps.append((name, list(commands)))
+
+    def write_file(self, remote_file_name, data, mode=None):
+        """ Add a step that writes data to a file on the host (relative to the home directory).
+
+        Args:
+            remote_file_name: the path of the file.
+            data: a str, the exact content of the file.
+            mode: the permission bits of the file (e.g. 0600), or None to keep the default.
+        """
+        path = pipes.quote(remote_file_name)
+        # base64, so that any content survives the here-document unchanged.
+        command = "base64 -d > {0} <<'MOLNS_EOF'\n{1}\nMOLNS_EOF".format(path, base64.encodestring(data).rstrip('\n'))
+        commands = [command]
+        if mode is not None:
+            # Not readable by others, even before the chmod.
+            commands = ["umask 077; " + command, "chmod {0:o} {1}".format(mode, path)]
+        self.step("write {0}".format(remote_file_name), *commands)
+
+    def render(self):
+        """ Return the plan as a bash script.  The script removes itself when it ends. """
+        lines = [
+            "#!/bin/bash",
+            "trap 'rm -f \"$0\"' EXIT",
+            "_molns_step() {{ printf '\\n{0} %s\\n' \"$*\"; }}".format(STEP_MARKER),
+        ]
+        for n, (name, commands) in enumerate(self.steps):
+            lines.append("")
+            lines.append("# {0}".format(name))
+            lines.append("_molns_step {0} begin".format(n))
+            for command in commands:
+                lines.append("( {0}\n) || {{ status=$?; _molns_step {1} fail $status; exit $status; }}".format(command, n))
+            lines.append("_molns_step {0} end".format(n))
+        return '\n'.join(lines) + '\n'
+
+class DeployPlanError(Exception):
+    def __init__(self, plan, step, status, output_tail):
+        Exception.__init__(self, "step '{0}' of the {1} deployment failed: Exit Code: {2}\tOUTPUT: {3}".format(step, plan.name, status, output_tail))
+        self.step = step
+        self.status = status
+        self.output_tail = output_tail
+
+class DeployPlanProgress():
+    """ Follow a running plan from its output (the on_output function of exec_command). """
+    # Bytes of output kept, for the error message of a failed step.
+    TAIL_BYTES = 4096
+
+    def __init__(self, plan, on_step=None):
+        """
+        Args:
+            plan: the DeployPlan that runs.
+            on_step: a function called with (step number, step name, seconds) when a step ended.
+        """
+        self.plan = plan
+        self.on_step = on_step
+        self.current = None
+        self.started = None
+        self.failed = None
+        self.done = set()
+        # A list of (step name, start time, seconds), of the steps that ended.
+        self.timings = []
+        self._partial = ''
+        self._tail = ''
+
+    def on_output(self, stream, data):
+        if stream != 'stdout':
+            self._tail = (self._tail + data)[-self.TAIL_BYTES:]
+            return
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            if line.startswith(STEP_MARKER):
+                self._marker(line.split()[1:])
+            elif len(line) > 0:
+                self._tail = (self._tail + line + '\n')[-self.TAIL_BYTES:]
+
+    def _marker(self, fields):
+        now = time.time()
+        n = int(fields[0])
+        if fields[1] == 'begin':
+            (self.current, self.started, self._tail) = (n, now, '')
+        elif fields[1] == 'end':
+            name = self.plan.steps[n][0]
+            self.done.add(n)
+            self.timings.append((name, self.started, now - self.started))
+            if self.on_step is not None:
+                self.on_step(n, name, now - self.started)
+        elif fields[1] == 'fail':
+            self.failed = (n, int(fields[2]))
+
+    def check(self, status):
+        """ Raise DeployPlanError if the plan did not complete.  status is the exit code of the script. """
+        if self.failed is not None:
+            (n, step_status) = self.failed
+            raise DeployPlanError(self.plan, self.plan.steps[n][0], step_status, self._tail)
+        if status != 0 or len(self.done) != len(self.plan.steps):
+            step = self.plan.steps[self.current][0] if self.current is not None else '(start)'
+            raise DeployPlanError(self.plan, step, status, self._tail)
+
+def notebook_password_hash(passphrase):
+    """ Return the hash of a password for c.NotebookApp.password, as IPython.lib.passwd() does,
+    so that the password does not have to be sent to the host to be hashed. """
+    if isinstance(passphrase, unicode):
+        passphrase = passphrase.encode('utf-8')
+    salt = '%012x' % random.SystemRandom().getrandbits(4 * 12)
+    return 'sha1:{0}:{1}'.format(salt, hashlib.sha1(passphrase + salt).hexdigest())
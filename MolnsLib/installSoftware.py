@@ -4,6 +4,9 @@ import paramiko
 import sys
 import time
 import logging
+import ssh_exec
+import molns_ready
+from ssh_pool import pool
 logging.getLogger('paramiko.transport').setLevel(logging.ERROR)
 
 
@@ -141,6 +144,8 @@ class InstallSW:
     SSH_CONNECT_WAITTIME = 5
     # Default SSH port
     DEFAULT_SSH_PORT = 22
+    # Seconds an install command may run (some compile large packages).
+    COMMAND_TIMEOUT = 3600
 
     def __init__(self, hostname, config=None, ssh_endpoint=None, username=None, password=None):
         if config is not None:
@@ -155,16 +160,23 @@ class InstallSW:
         self.hostname = hostname
         self.ssh_endpoint = ssh_endpoint
         self.keyfile = self.config.sshkeyfilename()
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        # A time.time() by which the whole install must have finished, or None.
+        self.deadline = None
+        # Set by connect(), to a connection of the SSH connection pool.
+        self.ssh = None
         self.log_file = None
 
     def connect(self):
         print "Connecting to {0}:{1} keyfile={2}".format(self.hostname,self.ssh_endpoint,self.keyfile)
+        if not pool.has_connection(self.hostname, self.ssh_endpoint, self.username, self.keyfile):
+            # Log in once sshd accepts connections.
+            if not molns_ready.wait_for_port(self.hostname, int(self.ssh_endpoint), timeout=self.MAX_NUMBER_SSH_CONNECT_ATTEMPTS * self.SSH_CONNECT_WAITTIME):
+                print "ssh connect Failed!!!\t{0}:{1}".format(self.hostname,self.ssh_endpoint)
+                raise Exception("Can not connect to {0}:{1}".format(self.hostname,self.ssh_endpoint))
         for i in range(self.MAX_NUMBER_SSH_CONNECT_ATTEMPTS):
             try:
-                self.ssh.connect(self.hostname, self.ssh_endpoint, username=self.username, 
-                    key_filename=self.keyfile)
+                self.disconnect()
+                self.ssh = pool.get(self.hostname, self.ssh_endpoint, self.username, self.keyfile)
                 print "SSH connection established"
                 return
             except Exception as e:
@@ -174,6 +186,23 @@ class InstallSW:
         print "ssh connect Failed!!!\t{0}:{1}".format(self.hostname,self.ssh_endpoint)
         raise Exception("Can not connect to {0}:{1}".format(self.hostname,self.ssh_endpoint))
 
+    def disconnect(self):
+        """ Done with the host.  The connection stays open in the pool. """
+        if self.ssh is not None:
+            pool.release(self.hostname, self.ssh_endpoint, self.username, self.keyfile, self.ssh)
+            self.ssh = None
+
+    def _open_session(self):
+        pool.touch(self.hostname, self.ssh_endpoint, self.username, self.keyfile)
+        try:
+            return self.ssh.get_transport().open_session()
+        except (paramiko.SSHException, EOFError, AttributeError) as e:
+            # The connection was lost (e.g. sshd was restarted by an install step): reconnect once.
+            logging.debug("InstallSW: reconnecting to {0}: {1}".format(self.hostname, e))
+            pool.discard(self.hostname, self.ssh_endpoint, self.username, self.keyfile)
+            self.ssh = pool.get(self.hostname, self.ssh_endpoint, self.username, self.keyfile)
+            return self.ssh.get_transport().open_session()
+
     def run_with_logging(self):
         logging.debug("run_with_logging()")
         try:
@@ -197,15 +226,17 @@ class InstallSW:
             logging.exception(e)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
         finally:
-            self.ssh.close()
+            self.disconnect()
 
     def run(self):
         self.connect()
-        if self.check_if_pyurdme_installed():
-            print "pyurdme is already installed, skipping install."
-        else:
-            self.exec_command_list_switch(self.command_list)
-        self.ssh.close()
+        try:
+            if self.check_if_pyurdme_installed():
+                print "pyurdme is already installed, skipping install."
+            else:
+                self.exec_command_list_switch(self.command_list)
+        finally:
+            self.disconnect()
 
     def exec_command_list_switch(self, command_list):
         # get total size:
@@ -281,53 +312,35 @@ class InstallSW:
         except InstallSWException:
             return False
 
-    def exec_command(self, command, pretty_command=None, verbose=True):
+    def exec_command(self, command, pretty_command=None, verbose=True, timeout=None):
+        """ Run command on the host.  The output goes to the install log as it arrives, and only
+        its end is kept: the last lines of stdout are returned. """
         if pretty_command is None:
             pretty_command = command
+        if timeout is None:
+            timeout = self.COMMAND_TIMEOUT
         try:
-            stdout_data = []
-            stderr_data = []
             self.log_exec('\n\nInstallSW.exec_command({0})\n'.format(command))
-            session = self.ssh.get_transport().open_session()
-            session.exec_command(command)
-            nbytes = 4096
-            #TODO add a timeout here, don't wait for commands forever.
-            while True:
-                if session.recv_ready():
-                    msg = session.recv(nbytes)
-                    stdout_data.append(msg)
-                    self.log_exec(msg)
-                if session.recv_stderr_ready():
-                    msg = session.recv_stderr(nbytes)
-                    stderr_data.append(msg)
-                    self.log_exec(msg)
-                if session.exit_status_ready():
-                    break
-                time.sleep(0.1) # Sleep breifly to prevent over-polling
-
-            status = session.recv_exit_status()
-            self.log_exec('\nInstallSW.exec_command({0}) Exit Status={1}'.format(command, status))
-            str_return = ''.join(stdout_data).splitlines()
-            stderr_str = ''.join(stderr_data)
-            session.close()
-            if status != 0:
-                raise paramiko.SSHException("Exit Code: {0}\tSTDOUT: {1}\tSTDERR: {2}\n\n".format(status, "\n".join(str_return), stderr_str))
+            result = ssh_exec.run_command(self._open_session(), command, timeout=timeout, deadline=self.deadline,
+                                          on_output=lambda stream, data: self.log_exec(data))
+            self.log_exec('\nInstallSW.exec_command({0}) Exit Status={1}'.format(command, result.status))
+            if result.status != 0:
+                raise paramiko.SSHException(result.error_message())
             if verbose:
                 print "OK.........."
-            return str_return
+            return result.stdout_tail.splitlines()
         except paramiko.SSHException as e:
+            self.log_exec('\nInstallSW.exec_command({0}) Failed: {1}'.format(command, e))
             if verbose:
                 print "FAILED......\t{0}".format(e)
             raise InstallSWException()
 
     def exec_multi_command(self, command, next_command):
         try:
-            stdin, stdout, stderr = self.ssh.exec_command(command)
-            stdin.write(next_command)
-            stdin.flush()
-            status = stdout.channel.recv_exit_status()
-            if status != 0:
-                raise paramiko.SSHException("Exit Code: {0}\tSTDOUT: {1}\tSTDERR: {2}\n\n".format(status, stdout.read(), stderr.read()))
+            result = ssh_exec.run_command(self._open_session(), command, timeout=self.COMMAND_TIMEOUT, deadline=self.deadline,
+                                          on_output=lambda stream, data: self.log_exec(data), input_data=next_command)
+            if result.status != 0:
+                raise paramiko.SSHException(result.error_message())
         except paramiko.SSHException as e:
             print "FAILED......\t{0}:{1}\t{2}\t{3}".format(self.hostname, self.ssh_endpoint, command, e)
             raise InstallSWException()
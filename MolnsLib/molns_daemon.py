@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import logging
+import traceback
+
+class DaemonException(Exception):
+    pass
+
+#############################################################
+# Protocol: the client sends one request, a JSON object on one line, and the daemon answers
+# with JSON lines {"stdout": text} / {"stderr": text} while the command runs, and a final
+# {"exit": code}.  Control requests {"control": "ping"} and {"control": "stop"} are answered
+# with a single line.
+#############################################################
+
+def socket_path(config_dir):
+    return os.path.join(os.path.abspath(config_dir), MolnsDaemon.SOCKET_NAME)
+
+def _send(wfile, msg):
+    wfile.write(json.dumps(msg) + "\n")
+    wfile.flush()
+
+def _connect(config_dir):
+    """ Return a socket connected to the daemon of config_dir, or None if it is not running. """
+    path = socket_path(config_dir)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in [errno.ENOENT, errno.ECONNREFUSED, errno.EINVAL]:
+            return None # Not running, or a stale socket left by a daemon that was killed
+        raise
+    return sock
+
+def _request(sock, request):
+    """ Send a request, and return the file to read the answer from. """
+    wfile = sock.makefile('wb')
+    _send(wfile, request)
+    wfile.close()
+    return sock.makefile('rb')
+
+def run_in_daemon(config_dir, request):
+    """ Run a command in the daemon of config_dir, if there is one.  The output of the command
+    is written to sys.stdout and sys.stderr as it arrives.
+
+    Args:
+        config_dir: a str, the config dir served by the daemon.
+        request: a dict with the command line 'args', the 'cwd' of the client, and the global options.
+    Returns:
+        The exit code of the command, or None if the daemon is not running.
+    Raises:
+        DaemonException if the connection is lost before the command is done.
+    """
+    sock = _connect(config_dir)
+    if sock is None:
+        return None
+    try:
+        rfile = _request(sock, request)
+        for line in rfile:
+            msg = json.loads(line)
+            if 'stdout' in msg:
+                sys.stdout.write(msg['stdout'].encode('utf-8'))
+                sys.stdout.flush()
+            elif 'stderr' in msg:
+                sys.stderr.write(msg['stderr'].encode('utf-8'))
+            elif 'exit' in msg:
+                return msg['exit']
+        raise DaemonException("Connection to molnsd lost before the command was done")
+    finally:
+        sock.close()
+
+def _control(config_dir, control):
+    sock = _connect(config_dir)
+    if sock is None:
+        return None
+    try:
+        line = _request(sock, {'control':control}).readline()
+        if line == '':
+            raise DaemonException("molnsd did not answer")
+        return json.loads(line)
+    finally:
+        sock.close()
+
+def daemon_status(config_dir):
+    """ Return a dict with the pid, start time and number of requests served by the daemon of config_dir, or None if it is not running. """
+    return _control(config_dir, 'ping')
+
+def stop_daemon(config_dir, timeout=10):
+    """ Stop the daemon of config_dir.  Returns False if it was not running. """
+    if _control(config_dir, 'stop') is None:
+        return False
+    t0 = time.time()
+    while os.path.exists(socket_path(config_dir)):
+        if time.time() > t0 + timeout:
+            raise DaemonException("molnsd did not stop within {0} seconds".format(timeout))
+        time.sleep(0.1)
+    return True
+
+def start_daemon(config_dir, handler, timeout=10):
+    """ Start a daemon serving config_dir in the background.
+
+    Args:
+        config_dir: a str, the config dir to serve.
+        handler: the function called with each command request (see MolnsDaemon).
+    Returns:
+        The pid of the daemon.
+    """
+    config_dir = os.path.abspath(config_dir)
+    if len(socket_path(config_dir)) > 100:
+        raise DaemonException("The path of the config dir is too long for a Unix socket: {0}".format(config_dir))
+    if daemon_status(config_dir) is not None:
+        raise DaemonException("molnsd is already running for {0}".format(config_dir))
+    if os.path.exists(socket_path(config_dir)):
+        os.remove(socket_path(config_dir))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        # Detach from the terminal, and leave the serving to a grandchild.
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+        try:
+            os.umask(077)
+            null_fd = os.open(os.devnull, os.O_RDONLY)
+            log_fd = os.open(os.path.join(config_dir, MolnsDaemon.LOG_NAME), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600)
+            os.dup2(null_fd, 0)
+            os.dup2(log_fd, 1)
+            os.dup2(log_fd, 2)
+            MolnsDaemon(config_dir, handler).serve_forever()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    t0 = time.time()
+    while time.time() < t0 + timeout:
+        status = daemon_status(config_dir)
+        if status is not None:
+            return status['pid']
+        time.sleep(0.1)
+    raise DaemonException("molnsd did not start, see {0}".format(os.path.join(config_dir, MolnsDaemon.LOG_NAME)))
+
+#############################################################
+
+class _StreamWriter():
+    """ File like object that sends what is written to it to the client. """
+    encoding = 'utf-8'
+
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+        self.softspace = 0
+        self.connected = True
+
+    def write(self, data):
+        if not self.connected or len(data) == 0:
+            return
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        try:
+            _send(self.wfile, {self.name:data})
+        except socket.error:
+            # The client went away, the command runs to completion anyway.
+            self.connected = False
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class MolnsDaemon():
+    """ Serve molns commands for one config dir over a Unix socket.
+
+    The requests are served one at a time, in the daemon process, so the handler can keep
+    state between requests (the datastore session, the provider connections).  The handler
+    is called with the request dict, with sys.stdout and sys.stderr sending to the client,
+    and returns the exit code of the command.
+    """
+    SOCKET_NAME = 'molnsd.sock'
+    LOG_NAME = 'molnsd.log'
+
+    def __init__(self, config_dir, handler):
+        self.config_dir = config_dir
+        self.handler = handler
+        self.socket_path = socket_path(config_dir)
+        self.started = time.time()
+        self.requests = 0
+        self.running = False
+
+    def serve_forever(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(16)
+        logging.info("molnsd (pid {0}) serving {1}".format(os.getpid(), self.socket_path))
+        self.running = True
+        try:
+            while self.running:
+                (conn, addr) = server.accept()
+                try:
+                    self._handle(conn)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+
+    def _handle(self, conn):
+        request = json.loads(conn.makefile('rb').readline())
+        wfile = conn.makefile('wb')
+        if 'control' in request:
+            if request['control'] == 'stop':
+                self.running = False
+            _send(wfile, {'pid':os.getpid(), 'started':self.started, 'requests':self.requests})
+            return
+        self.requests += 1
+        (stdout, stderr) = (sys.stdout, sys.stderr)
+        sys.stdout = _StreamWriter(wfile, 'stdout')
+        sys.stderr = _StreamWriter(wfile, 'stderr')
+        try:
+            exit_code = self.handler(request)
+        except Exception:
+            sys.stderr.write(traceback.format_exc())
+            exit_code = 1
+        finally:
+            (sys.stdout, sys.stderr) = (stdout, stderr)
+        try:
+            _send(wfile, {'exit':exit_code})
+        except socket.error:
+            pass
@@ -1,15 +1,17 @@
 #!/usr/bin/env python
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
-from sqlalchemy import Column, Integer, String, Sequence
+from sqlalchemy import Column, Integer, String, DateTime, Sequence, Index, bindparam
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import sessionmaker
 import os
+import datetime
+import fcntl
+import sqlite3
 import logging
-import sys
-#############################################################
-#VALID_PROVIDER_TYPES = ['OpenStack', 'EC2', 'Rackspace']
-VALID_PROVIDER_TYPES = ['OpenStack', 'EC2', 'Eucalyptus']
+from molns_datastore_base import DatastoreBase, DatastoreException, InstanceListing, VALID_PROVIDER_TYPES, get_provider_handle
 #############################################################
 #### SCHEMA #################################################
 #############################################################
@@ -17,6 +19,9 @@ VALID_PROVIDER_TYPES = ['OpenStack', 'EC2', 'Eucalyptus']
 class Provider(Base):
     """ DB object for an infrastructure service provider. """
     __tablename__ = 'providers'
+    __table_args__ = (
+        Index('ix_providers_name', 'name', unique=True),
+    )
     id = Column(Integer, Sequence('provider_id_seq'), primary_key=True)
     type = Column(String) #'EC2', 'Azure', 'OpenStack'
     name = Column(String)
@@ -27,6 +32,9 @@ class Provider(Base):
 class ProviderData(Base):
     """ DB object to store the key/value pairs for a service provider. """
     __tablename__ = 'provider_data'
+    __table_args__ = (
+        Index('ix_provider_data_parent_id_name', 'parent_id', 'name', unique=True),
+    )
     id = Column(Integer, Sequence('provider_data_id_seq'), primary_key=True)
     parent_id = Column(Integer)
     name = Column(String)
@@ -38,6 +46,10 @@ class ProviderData(Base):
 class Controller(Base):
     """ DB object for a MOLNS controller. """
     __tablename__ = 'controllers'
+    __table_args__ = (
+        Index('ix_controllers_name', 'name', unique=True),
+        Index('ix_controllers_provider_id', 'provider_id'),
+    )
     id = Column(Integer, Sequence('controller_id_seq'), primary_key=True)
     type = Column(String) #'EC2', 'Azure', 'OpenStack'
     name = Column(String)
@@ -49,6 +61,9 @@ class Controller(Base):
 class ControllerData(Base):
     """ DB object to store the key/value pairs for a controller. """
     __tablename__ = 'controller_data'
+    __table_args__ = (
+        Index('ix_controller_data_parent_id_name', 'parent_id', 'name', unique=True),
+    )
     id = Column(Integer, Sequence('controller_data_id_seq'), primary_key=True)
     parent_id = Column(Integer)
     name = Column(String)
@@ -60,6 +75,11 @@ class ControllerData(Base):
 class WorkerGroup(Base):
     """ DB object for a MOLNS WorkerGroup. """
     __tablename__ = 'worker_groups'
+    __table_args__ = (
+        Index('ix_worker_groups_name', 'name', unique=True),
+        Index('ix_worker_groups_provider_id', 'provider_id'),
+        Index('ix_worker_groups_controller_id', 'controller_id'),
+    )
     id = Column(Integer, Sequence('worker_group_id_seq'), primary_key=True)
     type = Column(String) #'EC2', 'Azure', 'OpenStack'
     name = Column(String)
@@ -72,6 +92,9 @@ class WorkerGroup(Base):
 class WorkerGroupData(Base):
     """ DB object to store the key/value pairs for a worker groups. """
     __tablename__ = 'worker_group_data'
+    __table_args__ = (
+        Index('ix_worker_group_data_parent_id_name', 'parent_id', 'name', unique=True),
+    )
     id = Column(Integer, Sequence('worker_group_data_id_seq'), primary_key=True)
     parent_id = Column(Integer)
     name = Column(String)
@@ -84,6 +107,12 @@ class WorkerGroupData(Base):
 class Instance(Base):
     """ DB object for a MOLNS VM instance. """
     __tablename__ = 'instances'
+    __table_args__ = (
+        Index('ix_instances_provider_instance_identifier', 'provider_instance_identifier', unique=True),
+        Index('ix_instances_provider_id', 'provider_id'),
+        Index('ix_instances_controller_id_worker_group_id', 'controller_id', 'worker_group_id'),
+        Index('ix_instances_worker_group_id', 'worker_group_id'),
+    )
     id = Column(Integer, Sequence('instance_id_seq'), primary_key=True)
     type = Column(String) #'head-node' or 'worker'
     controller_id = Column(Integer)
@@ -91,13 +120,74 @@ class Instance(Base):
     provider_id = Column(Integer)
     ip_address = Column(String)
     provider_instance_identifier = Column(String)
+    instance_type = Column(String)
+    launch_time = Column(DateTime)
+    # Last known status of the instance, and when (UTC) it was observed.
+    status = Column(String)
+    status_time = Column(DateTime)
     
     def __str__(self):
         return "Instance({0}): provider_instance_identifier={1} provider_id={2} controller_id={3} worker_group_id={4}".format(self.id, self.provider_instance_identifier, self.provider_id, self.controller_id, self.worker_group_id)
 
 
-class DatastoreException(Exception):
-    pass
+class SchemaVersion(Base):
+    """ DB object recording the version of the datastore schema. """
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+
+    def __str__(self):
+        return "SchemaVersion({0})".format(self.version)
+
+
+#############################################################
+#### MIGRATIONS #############################################
+#############################################################
+# Each migration upgrades the schema of an existing datastore from the previous version.
+# Datastores created from scratch get the current schema from create_all(), and are
+# stamped with SCHEMA_VERSION without running any migrations.
+
+def _create_indexes(connection, indexes):
+    """ Create indexes given as (name, table, columns, unique) tuples, if they do not exist.
+    A unique index that can not be created because of duplicate rows is created as a
+    regular index instead.
+    """
+    for (name, table, columns, unique) in indexes:
+        ddl = "CREATE {0}INDEX IF NOT EXISTS {1} ON {2} ({3})"
+        if unique:
+            try:
+                connection.execute(ddl.format('UNIQUE ', name, table, ', '.join(columns)))
+                continue
+            except IntegrityError as e:
+                logging.warning("Table {0} has duplicate {1} values, index {2} is not unique: {3}".format(table, columns, name, e))
+        connection.execute(ddl.format('', name, table, ', '.join(columns)))
+
+def _migration_add_indexes(connection):
+    _create_indexes(connection, [
+        ('ix_providers_name', 'providers', ['name'], True),
+        ('ix_provider_data_parent_id_name', 'provider_data', ['parent_id', 'name'], True),
+        ('ix_controllers_name', 'controllers', ['name'], True),
+        ('ix_controllers_provider_id', 'controllers', ['provider_id'], False),
+        ('ix_controller_data_parent_id_name', 'controller_data', ['parent_id', 'name'], True),
+        ('ix_worker_groups_name', 'worker_groups', ['name'], True),
+        ('ix_worker_groups_provider_id', 'worker_groups', ['provider_id'], False),
+        ('ix_worker_groups_controller_id', 'worker_groups', ['controller_id'], False),
+        ('ix_worker_group_data_parent_id_name', 'worker_group_data', ['parent_id', 'name'], True),
+        ('ix_instances_provider_instance_identifier', 'instances', ['provider_instance_identifier'], True),
+        ('ix_instances_provider_id', 'instances', ['provider_id'], False),
+        ('ix_instances_controller_id_worker_group_id', 'instances', ['controller_id', 'worker_group_id'], False),
+        ('ix_instances_worker_group_id', 'instances', ['worker_group_id'], False),
+    ])
+
+def _migration_add_instance_state(connection):
+    for (column, column_type) in [('instance_type', 'VARCHAR'), ('launch_time', 'DATETIME'), ('status', 'VARCHAR'), ('status_time', 'DATETIME')]:
+        connection.execute("ALTER TABLE instances ADD COLUMN {0} {1}".format(column, column_type))
+
+# List of (version, description, function) in the order they must be applied.
+MIGRATIONS = [
+    (1, "add indexes and unique constraints", _migration_add_indexes),
+    (2, "add instance type, launch time and last known status", _migration_add_instance_state),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
 #############################################################
 HANDLE_MAPPING = {
@@ -106,67 +196,151 @@ HANDLE_MAPPING = {
     'WorkerGroup':(WorkerGroup,WorkerGroupData),
 }
 
-#from OpenStackProvider import OpenStackProvider, OpenStackController, OpenStackWorkerGroup
-#from EC2Provider import EC2Provider, EC2Controller, EC2WorkerGroup
-
-def dynamic_module_import(name):
-    mod = __import__(name)
-    components = name.split('.')
-    for comp in components[1:]:
-        mod = getattr(mod, comp)
-    return mod
-
-def get_provider_handle(kind, ptype):
-    """ Return object of 'kind' (Provider, Controller or WokerGroup) for provider of type 'ptype'.  Load the module if necessary. """
-    #logging.debug("get_provider_handle(kind={0}, ptype={1})".format(kind, ptype))
-    valid_handles = ['Provider', 'Controller', 'WorkerGroup']
-    if kind not in valid_handles:
-        raise DatastoreException("Unknown kind {0}".format(kind))
-    if ptype not in VALID_PROVIDER_TYPES:
-        raise DatastoreException("Unknown {1} type {0}".format(ptype, kind))
-    cls_name = "{0}{1}".format(ptype, kind)
-    pkg_name = "MolnsLib.{0}Provider".format(ptype)
-    if pkg_name not in sys.modules:
-        logging.debug("loading {0} from {1}".format(cls_name, pkg_name))
-    pkg = dynamic_module_import(pkg_name)
-    try:
-        #logging.debug("dir(pkg={0})={1}".format(pkg, dir(pkg)))
-        mod = getattr(pkg, cls_name)
-    except AttributeError:
-        raise DatastoreException("module {0} does not contain {1}".format(pkg_name, cls_name))
-    return mod
+def _sqlite_on_connect(dbapi_connection, connection_record):
+    """ Put every new SQLite connection of the datastore in WAL mode. """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
 
 #############################################################
 
 
-class Datastore():
-    """ Access API for the MOLNS datastore. """
+class Datastore(DatastoreBase):
+    """ Access API for the MOLNS datastore, stored in a SQLite database.
+
+    The datastore can be used by several processes at the same time (parallel molns
+    commands, or processes forked during a deploy).  The database is opened in WAL mode,
+    so readers do not block the writer, and every write transaction starts with
+    'BEGIN IMMEDIATE', so concurrent writers wait for each other (up to
+    SQLITE_BUSY_TIMEOUT seconds) instead of failing with "database is locked".
+    """
     MOLNS_DATASTORE = 'molns_datastore.db'
-    MOLNS_CONFIG_DIR = '.molns'
+    # How long (in seconds) to wait for another process to release the database lock.
+    SQLITE_BUSY_TIMEOUT = 60
+    # Number of instance rows loaded at a time by the iter_* methods.
+    INSTANCE_BATCH_SIZE = 1000
+    # Number of ids per DELETE statement (SQLite limits the number of bound parameters).
+    DELETE_BATCH_SIZE = 500
 
     def __init__(self, db_file=None, config_dir=None):
         """ Constructor. """
         if db_file is not None:
-            self.engine = create_engine('sqlite:///{0}'.format(db_file))
             if config_dir is None:
-                self.config_dir = os.path.abspath(os.path.dirname(db_file))
-        elif config_dir is not None:
+                config_dir = os.path.abspath(os.path.dirname(db_file))
+        else:
+            if config_dir is None:
+                config_dir = self.MOLNS_CONFIG_DIR
             if not os.path.exists(config_dir):
                 os.makedirs(config_dir)
-            self.engine = create_engine('sqlite:///{0}/{1}'.format(config_dir, self.MOLNS_DATASTORE))
-            self.config_dir = config_dir
-        else:
-            if not os.path.exists(self.MOLNS_CONFIG_DIR):
-                os.makedirs(self.MOLNS_CONFIG_DIR)
-            self.engine = create_engine('sqlite:///{0}/{1}'.format(self.MOLNS_CONFIG_DIR, self.MOLNS_DATASTORE))
-
-        Base.metadata.create_all(self.engine) # Create all the tables
+            db_file = '{0}/{1}'.format(config_dir, self.MOLNS_DATASTORE)
+        DatastoreBase.__init__(self, config_dir=config_dir)
+        self.db_file = db_file
+        self._open()
+        self._upgrade_schema()
+
+    def copy(self):
+        """ Return a datastore on the same database file, with its own connection and session,
+        to be used by another thread. """
+        return self.__class__(db_file=self.db_file, config_dir=self.config_dir)
+
+    def _open(self):
+        """ Create the engine and session of this process. """
+        self.engine = create_engine('sqlite:///{0}'.format(self.db_file),
+            connect_args={'timeout': self.SQLITE_BUSY_TIMEOUT, 'isolation_level': 'IMMEDIATE'})
+        event.listen(self.engine, 'connect', _sqlite_on_connect)
         Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        self._session = Session()
+        self._pid = os.getpid()
+        # Connection used only to watch 'PRAGMA data_version', see refresh().
+        self._watch_connection = None
+        self._data_version = None
+        event.listen(self._session, 'after_commit', self._after_commit)
+        # Identity map of the config objects handed out, keyed by (kind, id), so that every
+        # lookup of the same object returns the same handle (and its provider connection).
+        self._object_cache = {}
+
+    @property
+    def session(self):
+        """ The session of the current process.  A process forked from the one that opened the
+        datastore must not use the inherited connections, so it gets a new engine and session
+        (and new config objects) on first use.
+        """
+        if self._pid != os.getpid():
+            logging.debug("Datastore used in forked process {0}, re-opening {1}".format(os.getpid(), self.db_file))
+            self._open()
+        return self._session
+
+    def _get_data_version(self):
+        if self._watch_connection is None:
+            self._watch_connection = sqlite3.connect(self.db_file, timeout=self.SQLITE_BUSY_TIMEOUT)
+        return self._watch_connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def _after_commit(self, session):
+        if self._watch_connection is not None:
+            self._data_version = self._get_data_version()
+
+    def refresh(self):
+        """ Make sure changes made by other processes are seen, for processes that keep the
+        datastore open across commands (molnsd).  The data version of the database changes on
+        every commit of another connection; the commits of this session are tracked, so that
+        the cached config objects are only dropped when another process wrote to the datastore.
+        """
+        data_version = self._get_data_version()
+        changed = self._data_version is not None and data_version != self._data_version
+        self.session.commit() # End the current transaction, and track the data version
+        if changed:
+            logging.debug("Datastore {0} changed by another process, dropping cached objects".format(self.db_file))
+            self._object_cache = {}
+            self.session.expire_all()
+
+    def _upgrade_schema(self):
+        """ Create the tables, and migrate the schema of an existing datastore to SCHEMA_VERSION. """
+        if self._get_schema_version() == SCHEMA_VERSION:
+            return
+        # DDL statements are not transactional in pysqlite, so hold a file lock while the
+        # schema is checked to keep concurrent molns processes from creating it twice.
+        with open(self.db_file + '.lock', 'a') as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                self._upgrade_schema_locked()
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def _get_schema_version(self):
+        """ Return the schema version stored in the datastore, or None if it has none. """
+        try:
+            with self.engine.connect() as connection:
+                return connection.execute("SELECT max(version) FROM schema_version").scalar()
+        except OperationalError:
+            return None # No schema_version table
+
+    def _upgrade_schema_locked(self):
+        existing_tables = inspect(self.engine).get_table_names()
+        Base.metadata.create_all(self.engine) # Create all the tables
+        with self.engine.begin() as connection:
+            version = connection.execute("SELECT max(version) FROM schema_version").scalar()
+            if version is None:
+                if Provider.__tablename__ in existing_tables:
+                    version = 0 # Datastore created before schema versioning
+                else:
+                    version = SCHEMA_VERSION
+            if version > SCHEMA_VERSION:
+                raise DatastoreException("Datastore schema version {0} is newer than this version of molns ({1})".format(version, SCHEMA_VERSION))
+            for (migration_version, description, migration) in MIGRATIONS:
+                if migration_version > version:
+                    logging.debug("Upgrading datastore schema to version {0}: {1}".format(migration_version, description))
+                    migration(connection)
+            connection.execute(SchemaVersion.__table__.delete())
+            connection.execute(SchemaVersion.__table__.insert(), version=SCHEMA_VERSION)
 
     def __del__(self):
         """ Destructor. """
-        self.session.commit()
+        # Only commit the session in the process that opened it.
+        if '_session' in self.__dict__ and self._pid == self._getpid():
+            self._session.commit()
+
+    # Keep a reference for __del__, which can run after the os module is torn down.
+    _getpid = staticmethod(os.getpid)
     
 
     def list_objects(self, kind):
@@ -175,38 +349,10 @@ class Datastore():
             kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
         Returns: a list of objects.
         """
-        if kind not in HANDLE_MAPPING:
-            raise DatastoreException("Unknown kind {0}".format(kind))
+        self._check_kind(kind)
         (handle, d_handle) = HANDLE_MAPPING[kind]
         return self.session.query(handle).all()
 
-    def create_object(self, ptype, name, kind, **kwargs):
-        """ Setup a new objects of kind (Provider, Controller, WorkerGroup).
-        
-        Args:
-            ptype: a str, the Provider type ('EC2', 'Azure', 'OpenStack').
-            name: a str, the name of the object.
-            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
-            All **kwargs args are passed to the provide handle object constructor.
-        """
-        if kind not in HANDLE_MAPPING:
-            raise DatastoreException("Unknown kind {0}".format(kind))
-        (handle, d_handle) = HANDLE_MAPPING[kind]
-        p = self.session.query(handle).filter_by(name=name).first()
-        if p is not None:
-            raise DatastoreException("{1} {0} already exists with type".format(name, kind, p.type))
-
-        p_handle = get_provider_handle(kind, ptype)
-        #logging.debug("create_object() {1}(name={0})".format(name, p_handle))
-        p = p_handle(name=name, config_dir=self.config_dir)
-        if 'provider_id' in kwargs:
-            p.provider_id = kwargs['provider_id']
-            #logging.debug("create_object() provider_id={0}".format(kwargs['provider_id']))
-        if 'controller_id' in kwargs:
-            p.controller_id = kwargs['controller_id']
-            #logging.debug("create_object() controller_id={0}".format(kwargs['controller_id']))
-        return p
-    
     def delete_object(self, name, kind):
         """ Delete a objects of kind (Provider, Controller, WorkerGroup).
         
@@ -216,93 +362,50 @@ class Datastore():
         Raises:
             DatastoreException when provider is not found, or on error.
         """
-        if kind not in HANDLE_MAPPING:
-            raise DatastoreException("Unknown kind {0}".format(kind))
+        self._check_kind(kind)
         (handle, d_handle) = HANDLE_MAPPING[kind]
         p = self.session.query(handle).filter_by(name=name).first()
         if p is None:
             raise DatastoreException("{0} {1} not found".format(kind, name))
         logging.debug("Deleting entry: {0}".format(p))
+        self._invalidate_object(kind, p.id)
+        data_table = d_handle.__table__
+        self.session.execute(data_table.delete().where(data_table.c.parent_id == p.id))
         self.session.delete(p)
         self.session.commit()
     
-    def get_object(self, name, kind):
-        """ Get a config object of of kind (Provider, Controller, WorkerGroup).
-        
-        Args:
-            name: a str, the name of the object.
-            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
-        Returns:
-            A config object.
-        Raises:
-            DatastoreException when object is not found, or on error.
-        """
-        if kind not in HANDLE_MAPPING:
-            raise DatastoreException("Unknown kind {0}".format(kind))
+    def _find_object_row(self, kind, **filters):
+        """ Return the row of kind matching the filters (name or id), or None. """
         (handle, d_handle) = HANDLE_MAPPING[kind]
-        p = self.session.query(handle).filter_by(name=name).first()
-        if p is None:
-            raise DatastoreException("{0} {1} not found".format(kind, name))
-        return self._get_object_data(d_handle, kind, p.type, p)
+        return self.session.query(handle).filter_by(**filters).first()
 
-    def get_object_by_id(self, id, kind):
-        """ Get a config object of of kind (Provider, Controller, WorkerGroup).
-        
-        Args:
-            id: an int, the id of the object.
-            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
-        Returns:
-            A config object.
-        Raises:
-            DatastoreException when object is not found, or on error.
-        """
-        if kind not in HANDLE_MAPPING:
-            raise DatastoreException("Unknown kind {0}".format(kind))
+    def _get_object_config(self, kind, id):
+        """ Return the stored key/value data of an object as a dict. """
         (handle, d_handle) = HANDLE_MAPPING[kind]
-        p = self.session.query(handle).filter_by(id=id).first()
-        if p is None:
-            raise DatastoreException("{0} {1} not found".format(kind, id))
-        return self._get_object_data(d_handle, kind, p.type, p)
-
-    def _get_object_data(self, d_handle, kind, ptype, p):
-        data = {}
-        p_data = self.session.query(d_handle).filter_by(parent_id=p.id).all()
-        for d in p_data:
-            data[d.name] = d.value
-
-        p_handle = get_provider_handle(kind, ptype)
-        #logging.debug("{2}(name={0}, data={1})".format(name,data,p_handle))
-        ret = p_handle(name=p.name, config=data, config_dir=self.config_dir)
-        ret.id = p.id
-        ret.datastore = self
-        if 'provider_id' in p.__dict__:
-            #logging.debug("_get_object_data(): provider_id={0}".format(p.provider_id))
-            try:
-                ret.provider = self.get_object_by_id(id=p.provider_id, kind='Provider')
-            except DatastoreException as e:
-                logging.debug('Error: provider {0} not found'.format(p.provider_id))
-                ret.provider = None
-        if 'controller_id' in p.__dict__:
-            #logging.debug("_get_object_data(): controller_id={0}".format(p.controller_id))
-            try:
-                ret.controller = self.get_object_by_id(id=p.controller_id, kind='Controller')
-            except DatastoreException as e:
-                logging.debug('Error: controller {0} not found'.format(p.controller_id))
-                ret.controller = None
-        return ret
+        return dict(self.session.query(d_handle.name, d_handle.value).filter_by(parent_id=id))
 
+    def save_objects(self, configs, kind):
+        """ Save the configuration of several provider objects in a single transaction.
 
-
-    def save_object(self, config, kind):
-        """ Save the configuration of a provider object.
-        
-        Args: 
-            config: an infrastructure service provider object (e.g. OpenStackProvider)
-            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        Args:
+            configs: a list of infrastructure service provider objects (e.g. OpenStackProvider)
+            kind: a str, the kind of the objects, one of (Provider, Controller, WorkerGroup).
         """
-        if kind not in HANDLE_MAPPING:
-            raise DatastoreException("Unknown kind {0}".format(kind))
+        self._check_kind(kind)
         (handle, d_handle) = HANDLE_MAPPING[kind]
+        saved_ids = []
+        try:
+            for config in configs:
+                saved_ids.append(self._save_object_rows(config, handle, d_handle))
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        for id in saved_ids:
+            self._invalidate_object(kind, id)
+
+    def _save_object_rows(self, config, handle, d_handle):
+        """ Write the row and the data rows of one object, without committing. Returns the id of the row. """
         p = self.session.query(handle).filter_by(name=config.name).first()
         if p is None:
             # Add new entry.
@@ -316,34 +419,42 @@ class Datastore():
         if 'controller_id' in config.__dict__:
             logging.debug("controller_id is in config.__dict__ {0}".format(config.controller_id))
             p.controller_id = config.controller_id
+        self.session.flush() # Assigns p.id to a new entry
         #logging.debug("Updated DB entry: {0}".format(p))
-        self.session.commit()
 
+        # Diff the config against the stored data, and apply the changes with one statement each.
         data = config.config.copy()
-        p_data = self.session.query(d_handle).filter_by(parent_id=p.id).all()
-        for d in p_data:
-            if d.name in data:
-                d.value = data[d.name]
-                del data[d.name]
+        data_table = d_handle.__table__
+        to_update = []
+        to_delete = []
+        for (d_id, d_name, d_value) in self.session.query(d_handle.id, d_handle.name, d_handle.value).filter_by(parent_id=p.id):
+            if d_name in data:
+                if d_value != data[d_name]:
+                    to_update.append({'d_id':d_id, 'd_value':data[d_name]})
+                del data[d_name]
             else:
-                #logging.debug("Deleting entry: {0}".format(d))
-                self.session.delete(d)
-        for d in data.keys():
-            dd = d_handle(parent_id=p.id, name=d, value=data[d])
-            #logging.debug("Created new entry: {0}".format(dd))
-            self.session.add(dd)
-        self.session.commit()
+                to_delete.append(d_id)
+        to_insert = [{'parent_id':p.id, 'name':name, 'value':value} for name, value in data.iteritems()]
+        if len(to_delete) > 0:
+            self.session.execute(data_table.delete().where(data_table.c.id.in_(to_delete)))
+        if len(to_update) > 0:
+            self.session.execute(data_table.update().where(data_table.c.id == bindparam('d_id')).values(value=bindparam('d_value')), to_update)
+        if len(to_insert) > 0:
+            self.session.execute(data_table.insert(), to_insert)
+        return p.id
 
 
     def get_instance_by_id(self, id):
         """ Create or get the value for an instance. """
         return self.session.query(Instance).filter_by(id=id).first()
     
-    def get_instance(self, provider_instance_identifier, ip_address, provider_id=None, controller_id=None, worker_group_id=None):
+    def get_instance(self, provider_instance_identifier, ip_address, provider_id=None, controller_id=None, worker_group_id=None, instance_type=None, status=None):
         """ Create or get the value for an instance. """
         p = self.session.query(Instance).filter_by(provider_instance_identifier=provider_instance_identifier).first()
         if p is None:
-            p = Instance(provider_instance_identifier=provider_instance_identifier, ip_address=ip_address, provider_id=provider_id, controller_id=controller_id, worker_group_id=worker_group_id)
+            now = datetime.datetime.utcnow()
+            p = Instance(provider_instance_identifier=provider_instance_identifier, ip_address=ip_address, provider_id=provider_id, controller_id=controller_id, worker_group_id=worker_group_id,
+                instance_type=instance_type, launch_time=now, status=status, status_time=now if status is not None else None)
             self.session.add(p)
             self.session.commit()
             #logging.debug("Creating instance: {0}".format(p))
@@ -352,39 +463,62 @@ class Datastore():
             pass
         return p
 
+    def set_instance_status(self, instance, status):
+        """ Record the status of an instance, as observed now. """
+        instance.status = status
+        instance.status_time = datetime.datetime.utcnow()
+        self.session.commit()
+
+    def set_instances_status(self, instances_status):
+        """ Record the status of several instances, given as a list of (instance, status) pairs, in one transaction. """
+        now = datetime.datetime.utcnow()
+        for (instance, status) in instances_status:
+            instance.status = status
+            instance.status_time = now
+        self.session.commit()
+
+    def _instance_query(self, provider_id=None, controller_id=None, worker_group_id=None):
+        if provider_id is not None:
+            return self.session.query(Instance).filter_by(provider_id=provider_id)
+        elif controller_id is not None:
+            return self.session.query(Instance).filter_by(controller_id=controller_id)
+        elif worker_group_id is not None:
+            return self.session.query(Instance).filter_by(worker_group_id=worker_group_id)
+        return self.session.query(Instance)
+
     def get_controller_instances(self,controller_id=None):
         logging.debug("get_controller_instances by controller_id={0}".format(controller_id))
-        ret = self.session.query(Instance).filter_by(controller_id=controller_id, worker_group_id=None).all()
-        if ret is None:
-            return []
-        else:
-            return ret
+        return self.session.query(Instance).filter_by(controller_id=controller_id, worker_group_id=None).all()
 
-    def get_worker_instances(self,controller_id=None):
-        #logging.debug("get_worker_instances by controller_id={0}".format(controller_id))
-        ret = self.session.query(Instance).filter_by(controller_id=controller_id).filter(Instance.worker_group_id!=None).all()
-        if ret is None:
-            return []
-        else:
-            return ret
+    def iter_worker_instances(self, controller_id=None):
+        """ Iterate over the worker instances of a controller, loading INSTANCE_BATCH_SIZE rows at a time. """
+        q = self.session.query(Instance).filter_by(controller_id=controller_id).filter(Instance.worker_group_id!=None)
+        return iter(q.order_by(Instance.id).yield_per(self.INSTANCE_BATCH_SIZE))
 
+    def iter_all_instances(self, provider_id=None, controller_id=None, worker_group_id=None):
+        """ Iterate over the instances (filtered as in get_all_instances), loading
+        INSTANCE_BATCH_SIZE rows at a time.  The datastore must not be written to
+        before the iteration is done.
+        """
+        q = self._instance_query(provider_id=provider_id, controller_id=controller_id, worker_group_id=worker_group_id)
+        return iter(q.order_by(Instance.id).yield_per(self.INSTANCE_BATCH_SIZE))
 
-    def get_all_instances(self, provider_id=None, controller_id=None, worker_group_id=None):
+    def iter_instance_listing(self, provider_id=None, controller_id=None, worker_group_id=None):
+        """ Iterate over the result of get_instance_listing, loading INSTANCE_BATCH_SIZE rows at a time.
+        The instances and the names of their owners are read with a single query.
+        """
+        q = self.session.query(Instance, Provider.name, Provider.type, Controller.name, WorkerGroup.name)\
+            .outerjoin(Provider, Provider.id == Instance.provider_id)\
+            .outerjoin(Controller, Controller.id == Instance.controller_id)\
+            .outerjoin(WorkerGroup, WorkerGroup.id == Instance.worker_group_id)
         if provider_id is not None:
-            #logging.debug("get_all_instances by provider_id={0}".format(provider_id))
-            ret = self.session.query(Instance).filter_by(provider_id=provider_id).all()
-        elif controller_id is not None:
-            #logging.debug("get_all_instances by controller_id={0}".format(controller_id))
-            ret = self.session.query(Instance).filter_by(controller_id=controller_id).all()
-        elif worker_group_id is not None:
-            #logging.debug("get_all_instances by worker_group_id={0}".format(worker_group_id))
-            ret = self.session.query(Instance).filter_by(worker_group_id=worker_group_id).all()
-        else:
-            ret = self.session.query(Instance).all()
-        if ret is None:
-            return []
-        else:
-            return ret
+            q = q.filter(Instance.provider_id == provider_id)
+        if controller_id is not None:
+            q = q.filter(Instance.controller_id == controller_id)
+        if worker_group_id is not None:
+            q = q.filter(Instance.worker_group_id == worker_group_id)
+        for row in q.order_by(Instance.id).yield_per(self.INSTANCE_BATCH_SIZE):
+            yield InstanceListing(*row)
 
     def delete_instance(self, instance):
         """ Delete an instance. """
@@ -392,5 +526,28 @@ class Datastore():
         self.session.delete(instance)
         self.session.commit()
 
+    def delete_instances(self, instances):
+        """ Delete several instances in a single transaction. """
+        ids = [i.id for i in instances]
+        table = Instance.__table__
+        try:
+            for n in range(0, len(ids), self.DELETE_BATCH_SIZE):
+                self.session.execute(table.delete().where(table.c.id.in_(ids[n:n+self.DELETE_BATCH_SIZE])))
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        for i in instances:
+            if i in self.session:
+                self.session.expunge(i)
+
+    def delete_all_instances(self):
+        """ Delete all the instances, without loading them.  Returns the number of instances deleted. """
+        for i in [obj for obj in self.session.identity_map.values() if isinstance(obj, Instance)]:
+            self.session.expunge(i)
+        count = self.session.execute(Instance.__table__.delete()).rowcount
+        self.session.commit()
+        return count
+
 
 
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+import logging
+import sys
+import collections
+#############################################################
+#VALID_PROVIDER_TYPES = ['OpenStack', 'EC2', 'Rackspace']
+VALID_PROVIDER_TYPES = ['OpenStack', 'EC2', 'Eucalyptus']
+#############################################################
+OBJECT_KINDS = ['Provider', 'Controller', 'WorkerGroup']
+
+# Datastore backends, by name: the class implementing DatastoreBase for each.
+DATASTORE_BACKENDS = collections.OrderedDict([
+    ('sqlite', 'MolnsLib.molns_datastore.Datastore'),
+    ('memory', 'MolnsLib.molns_datastore_memory.MemoryDatastore'),
+])
+
+class DatastoreException(Exception):
+    pass
+
+# An Instance row joined with the names of the objects that own it.
+InstanceListing = collections.namedtuple("InstanceListing", ["instance", "provider_name", "provider_type", "controller_name", "worker_group_name"])
+
+#############################################################
+
+def dynamic_module_import(name):
+    mod = __import__(name)
+    components = name.split('.')
+    for comp in components[1:]:
+        mod = getattr(mod, comp)
+    return mod
+
+def get_provider_handle(kind, ptype):
+    """ Return object of 'kind' (Provider, Controller or WokerGroup) for provider of type 'ptype'.  Load the module if necessary. """
+    #logging.debug("get_provider_handle(kind={0}, ptype={1})".format(kind, ptype))
+    if kind not in OBJECT_KINDS:
+        raise DatastoreException("Unknown kind {0}".format(kind))
+    if ptype not in VALID_PROVIDER_TYPES:
+        raise DatastoreException("Unknown {1} type {0}".format(ptype, kind))
+    cls_name = "{0}{1}".format(ptype, kind)
+    pkg_name = "MolnsLib.{0}Provider".format(ptype)
+    if pkg_name not in sys.modules:
+        logging.debug("loading {0} from {1}".format(cls_name, pkg_name))
+    pkg = dynamic_module_import(pkg_name)
+    try:
+        #logging.debug("dir(pkg={0})={1}".format(pkg, dir(pkg)))
+        mod = getattr(pkg, cls_name)
+    except AttributeError:
+        raise DatastoreException("module {0} does not contain {1}".format(pkg_name, cls_name))
+    return mod
+
+def get_datastore_backend(name):
+    """ Return the datastore class of the backend 'name' (see DATASTORE_BACKENDS).  Load the module if necessary. """
+    if name not in DATASTORE_BACKENDS:
+        raise DatastoreException("Unknown datastore backend {0}, must be one of {1}".format(name, ', '.join(DATASTORE_BACKENDS.keys())))
+    (pkg_name, cls_name) = DATASTORE_BACKENDS[name].rsplit('.', 1)
+    return getattr(dynamic_module_import(pkg_name), cls_name)
+
+#############################################################
+
+
+class DatastoreBase():
+    """ Access API for the MOLNS datastore, independent of how the data is stored.
+
+    This class turns stored rows into config objects (e.g. EC2Provider), and keeps an
+    identity map of the objects handed out.  A backend stores the rows and implements:
+
+        list_objects(kind)
+        delete_object(name, kind)
+        save_objects(configs, kind)
+        _find_object_row(kind, **filters)
+        _get_object_config(kind, id)
+
+    and the instance methods: get_instance_by_id, get_instance, set_instance_status,
+    get_controller_instances, iter_worker_instances, iter_all_instances,
+    iter_instance_listing, delete_instance, delete_instances and delete_all_instances.
+    The get_* list versions of the iter_* methods are built on them.
+
+    An object row has the attributes id, name and type, and provider_id / controller_id
+    for the kinds that have them.
+    """
+    MOLNS_CONFIG_DIR = '.molns'
+
+    def __init__(self, config_dir=None):
+        """ Constructor. """
+        self.config_dir = config_dir
+        # Identity map of the config objects handed out, keyed by (kind, id), so that every
+        # lookup of the same object returns the same handle (and its provider connection).
+        self._object_cache = {}
+
+    def refresh(self):
+        """ Make sure changes made by other processes are seen, for processes that keep the
+        datastore open across commands (molnsd).
+        """
+        pass
+
+    def copy(self):
+        """ Return a datastore on the same data, to be used by another thread. """
+        raise NotImplementedError("{0} does not implement copy".format(self.__class__.__name__))
+
+    def _check_kind(self, kind):
+        if kind not in OBJECT_KINDS:
+            raise DatastoreException("Unknown kind {0}".format(kind))
+
+    def _find_object_row(self, kind, **filters):
+        """ Return the row of kind matching the filters (name or id), or None. """
+        raise NotImplementedError("{0} does not implement _find_object_row".format(self.__class__.__name__))
+
+    def _get_object_config(self, kind, id):
+        """ Return the stored key/value data of an object as a dict. """
+        raise NotImplementedError("{0} does not implement _get_object_config".format(self.__class__.__name__))
+
+    def list_objects(self, kind):
+        """ Get all the currently configured objects of kind (Provider, Controller, WorkerGroup).
+        Args:
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        Returns: a list of objects.
+        """
+        raise NotImplementedError("{0} does not implement list_objects".format(self.__class__.__name__))
+
+    def create_object(self, ptype, name, kind, **kwargs):
+        """ Setup a new objects of kind (Provider, Controller, WorkerGroup).
+
+        Args:
+            ptype: a str, the Provider type ('EC2', 'Azure', 'OpenStack').
+            name: a str, the name of the object.
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+            All **kwargs args are passed to the provide handle object constructor.
+        """
+        self._check_kind(kind)
+        p = self._find_object_row(kind, name=name)
+        if p is not None:
+            raise DatastoreException("{1} {0} already exists with type".format(name, kind, p.type))
+
+        p_handle = get_provider_handle(kind, ptype)
+        #logging.debug("create_object() {1}(name={0})".format(name, p_handle))
+        p = p_handle(name=name, config_dir=self.config_dir)
+        p.datastore = self
+        if 'provider_id' in kwargs:
+            p.provider_id = kwargs['provider_id']
+            #logging.debug("create_object() provider_id={0}".format(kwargs['provider_id']))
+        if 'controller_id' in kwargs:
+            p.controller_id = kwargs['controller_id']
+            #logging.debug("create_object() controller_id={0}".format(kwargs['controller_id']))
+        return p
+
+    def delete_object(self, name, kind):
+        """ Delete a objects of kind (Provider, Controller, WorkerGroup).
+
+        Args:
+            name: a str, the name of the object.
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        Raises:
+            DatastoreException when provider is not found, or on error.
+        """
+        raise NotImplementedError("{0} does not implement delete_object".format(self.__class__.__name__))
+
+    def get_object(self, name, kind):
+        """ Get a config object of of kind (Provider, Controller, WorkerGroup).
+
+        Args:
+            name: a str, the name of the object.
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        Returns:
+            A config object.
+        Raises:
+            DatastoreException when object is not found, or on error.
+        """
+        self._check_kind(kind)
+        p = self._find_object_row(kind, name=name)
+        if p is None:
+            raise DatastoreException("{0} {1} not found".format(kind, name))
+        return self._get_object_data(kind, p)
+
+    def get_object_by_id(self, id, kind):
+        """ Get a config object of of kind (Provider, Controller, WorkerGroup).
+
+        Args:
+            id: an int, the id of the object.
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        Returns:
+            A config object.
+        Raises:
+            DatastoreException when object is not found, or on error.
+        """
+        self._check_kind(kind)
+        if (kind, id) in self._object_cache:
+            return self._object_cache[(kind, id)]
+        p = self._find_object_row(kind, id=id)
+        if p is None:
+            raise DatastoreException("{0} {1} not found".format(kind, id))
+        return self._get_object_data(kind, p)
+
+    def _get_object_data(self, kind, p):
+        if (kind, p.id) in self._object_cache:
+            return self._object_cache[(kind, p.id)]
+        data = self._get_object_config(kind, p.id)
+        p_handle = get_provider_handle(kind, p.type)
+        #logging.debug("{2}(name={0}, data={1})".format(name,data,p_handle))
+        ret = p_handle(name=p.name, config=data, config_dir=self.config_dir)
+        ret.id = p.id
+        ret.datastore = self
+        self._object_cache[(kind, p.id)] = ret
+        # The provider and controller are loaded on first access (see ProviderBase.provider).
+        if 'provider_id' in p.__dict__:
+            ret.provider_id = p.provider_id
+        if 'controller_id' in p.__dict__:
+            ret.controller_id = p.controller_id
+        return ret
+
+    def get_related_object(self, id, kind):
+        """ Get the config object for a relationship of another config object.
+
+        Args:
+            id: an int, the id of the object.
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        Returns:
+            A config object, or None if the object is not found.
+        """
+        try:
+            return self.get_object_by_id(id=id, kind=kind)
+        except DatastoreException as e:
+            logging.debug('Error: {0} {1} not found'.format(kind.lower(), id))
+            return None
+
+    def _invalidate_object(self, kind, id):
+        """ Remove an object from the object cache, along with the cached objects that refer to it. """
+        stale = self._object_cache.pop((kind, id), None)
+        if stale is None:
+            return
+        for key, obj in self._object_cache.items():
+            if obj.__dict__.get('_provider') is stale or obj.__dict__.get('_controller') is stale:
+                self._invalidate_object(*key)
+
+    def save_object(self, config, kind):
+        """ Save the configuration of a provider object.
+
+        Args:
+            config: an infrastructure service provider object (e.g. OpenStackProvider)
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        """
+        self.save_objects([config], kind)
+
+    def save_objects(self, configs, kind):
+        """ Save the configuration of several provider objects in a single transaction.
+
+        Args:
+            configs: a list of infrastructure service provider objects (e.g. OpenStackProvider)
+            kind: a str, the kind of the objects, one of (Provider, Controller, WorkerGroup).
+        """
+        raise NotImplementedError("{0} does not implement save_objects".format(self.__class__.__name__))
+
+    def get_instance_by_id(self, id):
+        """ Create or get the value for an instance. """
+        raise NotImplementedError("{0} does not implement get_instance_by_id".format(self.__class__.__name__))
+
+    def get_instance(self, provider_instance_identifier, ip_address, provider_id=None, controller_id=None, worker_group_id=None, instance_type=None, status=None):
+        """ Create or get the value for an instance. """
+        raise NotImplementedError("{0} does not implement get_instance".format(self.__class__.__name__))
+
+    def set_instance_status(self, instance, status):
+        """ Record the status of an instance, as observed now. """
+        raise NotImplementedError("{0} does not implement set_instance_status".format(self.__class__.__name__))
+
+    def set_instances_status(self, instances_status):
+        """ Record the status of several instances, given as a list of (instance, status) pairs. """
+        for (instance, status) in instances_status:
+            self.set_instance_status(instance, status)
+
+    def get_controller_instances(self, controller_id=None):
+        raise NotImplementedError("{0} does not implement get_controller_instances".format(self.__class__.__name__))
+
+    def iter_worker_instances(self, controller_id=None):
+        """ Iterate over the worker instances of a controller. """
+        raise NotImplementedError("{0} does not implement iter_worker_instances".format(self.__class__.__name__))
+
+    def get_worker_instances(self, controller_id=None):
+        return list(self.iter_worker_instances(controller_id=controller_id))
+
+    def iter_all_instances(self, provider_id=None, controller_id=None, worker_group_id=None):
+        """ Iterate over the instances (filtered as in get_all_instances).  The datastore must not
+        be written to before the iteration is done.
+        """
+        raise NotImplementedError("{0} does not implement iter_all_instances".format(self.__class__.__name__))
+
+    def get_all_instances(self, provider_id=None, controller_id=None, worker_group_id=None):
+        return list(self.iter_all_instances(provider_id=provider_id, controller_id=controller_id, worker_group_id=worker_group_id))
+
+    def iter_instance_listing(self, provider_id=None, controller_id=None, worker_group_id=None):
+        """ Iterate over the result of get_instance_listing. """
+        raise NotImplementedError("{0} does not implement iter_instance_listing".format(self.__class__.__name__))
+
+    def get_instance_listing(self, provider_id=None, controller_id=None, worker_group_id=None):
+        """ Get instances together with the name and type of their provider, and the names of
+        their controller and worker group.
+
+        Args:
+            provider_id: an int, only return instances of this provider.
+            controller_id: an int, only return instances of this controller (including its workers).
+            worker_group_id: an int, only return instances of this worker group.
+        Returns:
+            A list of InstanceListing tuples, ordered by instance id.  The owner names are None
+            if the owner object no longer exists.
+        """
+        return list(self.iter_instance_listing(provider_id=provider_id, controller_id=controller_id, worker_group_id=worker_group_id))
+
+    def delete_instance(self, instance):
+        """ Delete an instance. """
+        raise NotImplementedError("{0} does not implement delete_instance".format(self.__class__.__name__))
+
+    def delete_instances(self, instances):
+        """ Delete several instances in a single transaction. """
+        raise NotImplementedError("{0} does not implement delete_instances".format(self.__class__.__name__))
+
+    def delete_all_instances(self):
+        """ Delete all the instances, without loading them.  Returns the number of instances deleted. """
+        raise NotImplementedError("{0} does not implement delete_all_instances".format(self.__class__.__name__))
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+import datetime
+import itertools
+import logging
+from molns_datastore_base import DatastoreBase, DatastoreException, InstanceListing
+
+#############################################################
+
+class MemoryObjectRow():
+    """ Stored row of a Provider, Controller or WorkerGroup. """
+    def __init__(self, id, kind, name, type):
+        self.id = id
+        self.name = name
+        self.type = type
+        if kind in ['Controller', 'WorkerGroup']:
+            self.provider_id = None
+        if kind == 'WorkerGroup':
+            self.controller_id = None
+        self.kind = kind
+
+    def __str__(self):
+        return "{0}({1}): name={2} type={3}".format(self.kind, self.id, self.name, self.type)
+
+class MemoryInstance():
+    """ Stored MOLNS VM instance, with the same attributes as the Instance table. """
+    def __init__(self, id, provider_instance_identifier, ip_address, provider_id=None, controller_id=None, worker_group_id=None, instance_type=None, launch_time=None, status=None, status_time=None):
+        self.id = id
+        self.type = None
+        self.provider_instance_identifier = provider_instance_identifier
+        self.ip_address = ip_address
+        self.provider_id = provider_id
+        self.controller_id = controller_id
+        self.worker_group_id = worker_group_id
+        self.instance_type = instance_type
+        self.launch_time = launch_time
+        self.status = status
+        self.status_time = status_time
+
+    def __str__(self):
+        return "Instance({0}): provider_instance_identifier={1} provider_id={2} controller_id={3} worker_group_id={4}".format(self.id, self.provider_instance_identifier, self.provider_id, self.controller_id, self.worker_group_id)
+
+#############################################################
+
+
+class MemoryDatastore(DatastoreBase):
+    """ Access API for a MOLNS datastore that only lives in memory.
+
+    Nothing is written to disk, and the data is lost when the datastore is garbage collected.
+    This is meant for tests and benchmarks, and for molns runs that do not need to keep their
+    configuration.  The config dir is only used for files written by the providers (e.g. ssh
+    keys), and is not created by the datastore.
+    """
+
+    def __init__(self, db_file=None, config_dir=None):
+        """ Constructor. """
+        if db_file is not None:
+            raise DatastoreException("MemoryDatastore does not use a db_file")
+        if config_dir is None:
+            config_dir = self.MOLNS_CONFIG_DIR
+        DatastoreBase.__init__(self, config_dir=config_dir)
+        # Ids are numbered per kind, as in the tables of the SQLite datastore.
+        self._ids = dict((kind, itertools.count(1)) for kind in ['Provider', 'Controller', 'WorkerGroup', 'Instance'])
+        # Rows and key/value data of the config objects, by kind and id.
+        self._rows = {'Provider':{}, 'Controller':{}, 'WorkerGroup':{}}
+        self._data = {'Provider':{}, 'Controller':{}, 'WorkerGroup':{}}
+        self._instances = {}
+        # provider_instance_identifier -> instance id
+        self._instance_identifiers = {}
+
+    def copy(self):
+        """ The data only exists in this object, so other threads share it.  Each update of
+        the dicts is atomic, and concurrent commands work on different instances. """
+        return self
+
+    def list_objects(self, kind):
+        """ Get all the currently configured objects of kind (Provider, Controller, WorkerGroup).
+        Args:
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        Returns: a list of objects.
+        """
+        self._check_kind(kind)
+        return [self._rows[kind][id] for id in sorted(self._rows[kind])]
+
+    def delete_object(self, name, kind):
+        """ Delete a objects of kind (Provider, Controller, WorkerGroup).
+
+        Args:
+            name: a str, the name of the object.
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        Raises:
+            DatastoreException when provider is not found, or on error.
+        """
+        self._check_kind(kind)
+        p = self._find_object_row(kind, name=name)
+        if p is None:
+            raise DatastoreException("{0} {1} not found".format(kind, name))
+        logging.debug("Deleting entry: {0}".format(p))
+        self._invalidate_object(kind, p.id)
+        del self._rows[kind][p.id]
+        del self._data[kind][p.id]
+
+    def _find_object_row(self, kind, **filters):
+        """ Return the row of kind matching the filters (name or id), or None. """
+        if 'id' in filters:
+            p = self._rows[kind].get(filters['id'])
+            if p is None or any(getattr(p, k) != v for k, v in filters.iteritems()):
+                return None
+            return p
+        for id in sorted(self._rows[kind]):
+            p = self._rows[kind][id]
+            if all(getattr(p, k) == v for k, v in filters.iteritems()):
+                return p
+        return None
+
+    def _get_object_config(self, kind, id):
+        """ Return the stored key/value data of an object as a dict. """
+        return self._data[kind][id].copy()
+
+    def save_objects(self, configs, kind):
+        """ Save the configuration of several provider objects.
+
+        Args:
+            configs: a list of infrastructure service provider objects (e.g. OpenStackProvider)
+            kind: a str, the kind of the objects, one of (Provider, Controller, WorkerGroup).
+        """
+        self._check_kind(kind)
+        saved_ids = []
+        for config in configs:
+            p = self._find_object_row(kind, name=config.name)
+            if p is None:
+                p = MemoryObjectRow(self._ids[kind].next(), kind, config.name, config.type)
+                self._rows[kind][p.id] = p
+            if 'provider_id' in config.__dict__:
+                p.provider_id = config.provider_id
+            if 'controller_id' in config.__dict__:
+                p.controller_id = config.controller_id
+            self._data[kind][p.id] = config.config.copy()
+            saved_ids.append(p.id)
+        for id in saved_ids:
+            self._invalidate_object(kind, id)
+
+    def get_instance_by_id(self, id):
+        """ Create or get the value for an instance. """
+        return self._instances.get(id)
+
+    def get_instance(self, provider_instance_identifier, ip_address, provider_id=None, controller_id=None, worker_group_id=None, instance_type=None, status=None):
+        """ Create or get the value for an instance. """
+        if provider_instance_identifier in self._instance_identifiers:
+            return self._instances[self._instance_identifiers[provider_instance_identifier]]
+        now = datetime.datetime.utcnow()
+        p = MemoryInstance(self._ids['Instance'].next(), provider_instance_identifier=provider_instance_identifier, ip_address=ip_address, provider_id=provider_id, controller_id=controller_id, worker_group_id=worker_group_id,
+            instance_type=instance_type, launch_time=now, status=status, status_time=now if status is not None else None)
+        self._instances[p.id] = p
+        self._instance_identifiers[provider_instance_identifier] = p.id
+        return p
+
+    def set_instance_status(self, instance, status):
+        """ Record the status of an instance, as observed now. """
+        instance.status = status
+        instance.status_time = datetime.datetime.utcnow()
+
+    def _iter_instances(self, **filters):
+        for id in sorted(self._instances):
+            i = self._instances.get(id)
+            if i is not None and all(getattr(i, k) == v for k, v in filters.iteritems() if v is not None):
+                yield i
+
+    def get_controller_instances(self, controller_id=None):
+        return [i for i in self._iter_instances() if i.controller_id == controller_id and i.worker_group_id is None]
+
+    def iter_worker_instances(self, controller_id=None):
+        """ Iterate over the worker instances of a controller. """
+        return (i for i in self._iter_instances() if i.controller_id == controller_id and i.worker_group_id is not None)
+
+    def iter_all_instances(self, provider_id=None, controller_id=None, worker_group_id=None):
+        """ Iterate over the instances (filtered as in get_all_instances). """
+        if provider_id is not None:
+            return self._iter_instances(provider_id=provider_id)
+        elif controller_id is not None:
+            return self._iter_instances(controller_id=controller_id)
+        elif worker_group_id is not None:
+            return self._iter_instances(worker_group_id=worker_group_id)
+        return self._iter_instances()
+
+    def iter_instance_listing(self, provider_id=None, controller_id=None, worker_group_id=None):
+        """ Iterate over the result of get_instance_listing. """
+        for i in self._iter_instances(provider_id=provider_id, controller_id=controller_id, worker_group_id=worker_group_id):
+            provider = self._rows['Provider'].get(i.provider_id)
+            controller = self._rows['Controller'].get(i.controller_id)
+            worker_group = self._rows['WorkerGroup'].get(i.worker_group_id)
+            yield InstanceListing(i,
+                provider.name if provider is not None else None,
+                provider.type if provider is not None else None,
+                controller.name if controller is not None else None,
+                worker_group.name if worker_group is not None else None)
+
+    def delete_instance(self, instance):
+        """ Delete an instance. """
+        del self._instances[instance.id]
+        del self._instance_identifiers[instance.provider_instance_identifier]
+
+    def delete_instances(self, instances):
+        """ Delete several instances. """
+        for i in instances:
+            if self._instances.pop(i.id, None) is not None:
+                del self._instance_identifiers[i.provider_instance_identifier]
+
+    def delete_all_instances(self):
+        """ Delete all the instances.  Returns the number of instances deleted. """
+        count = len(self._instances)
+        self._instances.clear()
+        self._instance_identifiers.clear()
+        return count
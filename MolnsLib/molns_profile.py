@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import collections
+
+class CommandProfiler():
+    """ Profile a molns command, for 'molns --profile[=file]'.
+
+    Two profiles are taken at the same time:
+    - cProfile, of the thread that runs the command.  Written as pstats to <file>.pstats.
+    - A sampling profile of all the threads (the provider requests and deployments run in
+      threads), taken every sample_interval seconds.  Written to <file>.collapsed, one
+      'frame;frame;...;frame count' line per stack, the input of flamegraph.pl.
+    Both measure wall clock time, so time spent sleeping or waiting for the network counts.
+    """
+    def __init__(self, filename=None, sample_interval=0.005):
+        if filename is None:
+            filename = time.strftime('molns-profile-%Y%m%d-%H%M%S')
+        self.filename = filename
+        self.sample_interval = sample_interval
+        self.profile = cProfile.Profile()
+        self.samples = collections.Counter()
+        self.num_samples = 0
+        self.start_time = None
+        self.wall_time = None
+        self._running = False
+        self._sampler = None
+
+    def start(self):
+        self.start_time = time.time()
+        self._running = True
+        self._sampler = threading.Thread(target=self._sample_loop, name='molns-profile')
+        self._sampler.daemon = True
+        self._sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self._running = False
+        self._sampler.join()
+        self.wall_time = time.time() - self.start_time
+
+    def _sample_loop(self):
+        me = threading.current_thread().ident
+        while self._running:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for (ident, frame) in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-{0}'.format(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+            self.num_samples += 1
+            time.sleep(self.sample_interval)
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return "{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def write(self):
+        """ Write the profiles.  Returns the names of the files written. """
+        pstats_file = self.filename + '.pstats'
+        collapsed_file = self.filename + '.collapsed'
+        self.profile.dump_stats(pstats_file)
+        with open(collapsed_file, 'w') as fd:
+            for (stack, count) in sorted(self.samples.items()):
+                fd.write("{0} {1}\n".format(stack, count))
+        return [pstats_file, collapsed_file]
+
+    def report(self, out=None, limit=15):
+        """ Print the functions where the time went. """
+        if out is None:
+            out = sys.stderr
+        out.write("profile: {0:.3f}s wall clock, {1} samples of all threads\n".format(self.wall_time, self.num_samples))
+        # Where the threads were, by the innermost frame (waiting on a socket, sleeping, ...)
+        leaves = collections.Counter()
+        for (stack, count) in self.samples.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        if self.num_samples > 0:
+            out.write("\nWall clock, all threads (innermost function, share of the samples):\n")
+            for (frame, count) in leaves.most_common(limit):
+                out.write("  {0:6.1f}%  {1}\n".format(100.0 * count / self.num_samples, frame))
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('tottime')
+        out.write("\nCommand thread, by own time:\n")
+        stats.print_stats(limit)
+        stats.sort_stats('cumulative')
+        out.write("Command thread, by cumulative time:\n")
+        stats.print_stats(limit)
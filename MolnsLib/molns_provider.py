@@ -1,5 +1,6 @@
 import os
 import collections
+import datetime
 class ProviderException(Exception):
     pass
 
@@ -55,6 +56,70 @@ class ProviderBase():
                 ret += '\n\t{0} = {1}'.format(k,v)
         return ret
 
+    @property
+    def provider(self):
+        """ The Provider object of this object, loaded from the datastore on first access. """
+        if '_provider' not in self.__dict__:
+            self._provider = self._get_related_object('provider_id', 'Provider')
+        return self._provider
+
+    @property
+    def controller(self):
+        """ The Controller object of this object, loaded from the datastore on first access. """
+        if '_controller' not in self.__dict__:
+            self._controller = self._get_related_object('controller_id', 'Controller')
+        return self._controller
+
+    def _get_related_object(self, id_attr, kind):
+        if id_attr not in self.__dict__ or 'datastore' not in self.__dict__:
+            raise AttributeError("{0} has no {1}".format(self.OBJ_NAME, kind.lower()))
+        return self.datastore.get_related_object(id=self.__dict__[id_attr], kind=kind)
+
+    def get_cached_instance_status(self, instance, max_age=None):
+        """ Get the status of an instance.  The last known status stored in the datastore is
+        returned if it was observed at most max_age seconds ago, otherwise the status is
+        requested from the provider and stored.
+        """
+        status = self.get_last_known_status(instance, max_age=max_age)
+        if status is not None:
+            return status
+        status = self.get_instance_status(instance)
+        self.datastore.set_instance_status(instance, status)
+        return status
+
+    def get_cached_instances_status(self, instances, max_age=None):
+        """ Get the status of several instances, as get_cached_instance_status() does, with one
+        get_instances_status() request for those whose last known status is too old, and the
+        new statuses stored in one transaction.
+        Returns:
+            A list of the statuses, in the order of instances.
+        """
+        statuses = [self.get_last_known_status(i, max_age=max_age) for i in instances]
+        stale = [i for (i, status) in zip(instances, statuses) if status is None]
+        if len(stale) == 0:
+            return statuses
+        result = self.get_instances_status(stale)
+        new_statuses = [(i, result[i.provider_instance_identifier]) for i in stale]
+        self.datastore.set_instances_status(new_statuses)
+        new_by_id = dict((i.provider_instance_identifier, status) for (i, status) in new_statuses)
+        return [status if status is not None else new_by_id[i.provider_instance_identifier] for (i, status) in zip(instances, statuses)]
+
+    def get_last_known_status(self, instance, max_age=None):
+        """ Return the status stored in the datastore if it was observed at most max_age seconds ago, otherwise None. """
+        if max_age is not None and instance.status is not None and instance.status_time is not None:
+            age = datetime.datetime.utcnow() - instance.status_time
+            if age.total_seconds() <= max_age:
+                return instance.status
+        return None
+
+    def get_instances_status(self, instances):
+        """ Get the status of several instances from the provider.  Providers that can describe
+        many instances with one request override this, the default asks for each instance.
+        Returns:
+            A dict of provider_instance_identifier -> status.
+        """
+        return dict((i.provider_instance_identifier, self.get_instance_status(i)) for i in instances)
+
     def get_config_vars(self):
         for key, conf in self.CONFIG_VARS.iteritems():
             if key in self.config and self.config[key] is not None and self.config[key] != '':
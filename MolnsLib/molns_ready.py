@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import time
+import errno
+import random
+import select
+import socket
+
+#############################################################
+# Wait for hosts to accept TCP connections (e.g. for sshd to come up on new instances).
+#
+#   ready = molns_ready.wait_for_ports([(ip, 22) for ip in ips], timeout=300)
+#
+# Each host is probed with non-blocking connects, all of them at once in one select() loop.
+# A host whose connect is refused or unanswered is probed again after a backoff that doubles
+# from MIN_BACKOFF up to MAX_BACKOFF, with jitter, so a host is seen as ready within about a
+# second of its port opening.
+#############################################################
+
+# Seconds a connect may stay unanswered before it is counted as failed (and tried again).
+ATTEMPT_TIMEOUT = 1.0
+MIN_BACKOFF = 0.1
+MAX_BACKOFF = 1.0
+
+def backoff(failures):
+    """ Return the seconds to wait after the given number of failed attempts. """
+    delay = min(MIN_BACKOFF * (2 ** (failures - 1)), MAX_BACKOFF)
+    return delay * random.uniform(0.5, 1.0)
+
+def _connect(address):
+    """ Start a non-blocking connect.  Returns (socket, errno): the socket is None if the
+    connect failed at once, and errno is 0 if it succeeded at once. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    try:
+        err = sock.connect_ex(address)
+    except socket.error as e:
+        err = e.errno
+    if err in [0, errno.EINPROGRESS, errno.EWOULDBLOCK]:
+        return (sock, err)
+    sock.close()
+    return (None, err)
+
+def probe_ports(addresses, timeout=1.0):
+    """ Try to connect to several (host, port) addresses at once.
+
+    Args:
+        addresses: a list of (host, port) tuples.
+        timeout: seconds to wait for the connections, in total.
+    Returns:
+        The set of addresses that accepted a connection.
+    """
+    pending = {}
+    accepted = set()
+    for address in set(addresses):
+        (sock, err) = _connect(address)
+        if sock is None:
+            continue
+        if err == 0:
+            accepted.add(address)
+            sock.close()
+        else:
+            pending[sock] = address
+    deadline = time.time() + timeout
+    try:
+        while len(pending) > 0 and time.time() < deadline:
+            (_, writable, _) = select.select([], pending.keys(), [], max(deadline - time.time(), 0))
+            for sock in writable:
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    accepted.add(pending[sock])
+                del pending[sock]
+                sock.close()
+    finally:
+        for sock in pending:
+            sock.close()
+    return accepted
+
+def iter_ready(addresses, timeout=None):
+    """ Wait for several (host, port) addresses to accept a connection.
+
+    Args:
+        addresses: a list of (host, port) tuples.
+        timeout: seconds to wait in total, or None to wait until all of them are ready.
+    Returns:
+        A generator of the addresses, as each becomes ready.  It ends when all are ready, or
+        at the timeout.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    # address -> failed attempts, and address -> the time of its next attempt, of the addresses not ready
+    failures = dict((address, 0) for address in set(addresses))
+    next_attempt = dict((address, 0) for address in failures)
+    in_flight = {}  # socket -> (address, time started)
+
+    def failed(address, now):
+        failures[address] += 1
+        next_attempt[address] = now + backoff(failures[address])
+
+    try:
+        while len(failures) > 0:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                return
+            busy = set(address for (address, started) in in_flight.values())
+            for address in [a for a in failures if a not in busy and next_attempt[a] <= now]:
+                (sock, err) = _connect(address)
+                if sock is None:
+                    failed(address, now)
+                elif err == 0:
+                    sock.close()
+                    del failures[address]
+                    yield address
+                else:
+                    in_flight[sock] = (address, now)
+            if len(failures) == 0:
+                return
+            # Wake up for the first of: a connect that ends, times out, or an attempt is due.
+            busy = set(address for (address, started) in in_flight.values())
+            wake = [next_attempt[a] for a in failures if a not in busy]
+            wake += [started + ATTEMPT_TIMEOUT for (address, started) in in_flight.values()]
+            if deadline is not None:
+                wake.append(deadline)
+            wait = max(min(wake) - time.time(), 0) if len(wake) > 0 else MAX_BACKOFF
+            (_, writable, _) = select.select([], in_flight.keys(), [], wait)
+            now = time.time()
+            for sock in writable:
+                (address, started) = in_flight.pop(sock)
+                ok = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                sock.close()
+                if ok:
+                    del failures[address]
+                    yield address
+                else:
+                    failed(address, now)
+            for sock in [s for (s, (address, started)) in in_flight.items() if now - started >= ATTEMPT_TIMEOUT]:
+                (address, started) = in_flight.pop(sock)
+                sock.close()
+                failed(address, now)
+    finally:
+        for sock in in_flight:
+            sock.close()
+
+def wait_for_ports(addresses, timeout=None):
+    """ Wait for several (host, port) addresses to accept a connection.  Returns the set of
+    those that did before the timeout (seconds, or None to wait for all). """
+    return set(iter_ready(addresses, timeout))
+
+def wait_for_port(host, port, timeout=None):
+    """ Wait for host to accept connections on port.  Returns False at the timeout. """
+    return len(wait_for_ports([(host, port)], timeout)) > 0
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import shutil
+import socket
+import logging
+import datetime
+import tempfile
+import subprocess
+import molns_trace
+
+class TLSException(Exception):
+    pass
+
+KEY_TYPES = ['rsa', 'ec']
+
+class TLSMaterial():
+    """ The key and self-signed certificate of the notebook and nginx of a controller.
+
+    They are made on this machine, the first time a controller is deployed, and stored in
+    <config_dir>/<controller name>/tls/, so deploying the controller again (or resuming it) only
+    uploads them.  They are made again when the certificate is about to expire, when the
+    hostname of the controller changed, or when the key type changed.  EC keys are made in
+    milliseconds, where an RSA-4096 key can take seconds.
+    """
+    KEY_FILE = 'ssl_key.pem'
+    CERT_FILE = 'ssl_cert.pem'
+    INFO_FILE = 'tls.json'
+    RSA_KEY_SIZE = 4096
+    EC_CURVE = 'prime256v1'
+    # Days the certificates are valid.
+    VALID_DAYS = 365
+    # Days before the expiry of a certificate when it is replaced.
+    RENEW_DAYS = 30
+    SUBJECT = [('C', 'CN'), ('ST', 'SH'), ('L', 'STAR'), ('O', 'Dis')]
+
+    def __init__(self, directory, key_type='rsa'):
+        if key_type not in KEY_TYPES:
+            raise TLSException("Unknown TLS key type '{0}', must be one of: {1}".format(key_type, ", ".join(KEY_TYPES)))
+        self.directory = directory
+        self.key_type = key_type
+
+    @classmethod
+    def for_controller(cls, controller, config_dir):
+        """ Returns the TLSMaterial of a controller object. """
+        return cls(os.path.join(config_dir, controller.name, 'tls'), controller.config.get('tls_key_type', 'rsa'))
+
+    def get(self, hostname):
+        """ Returns (key, certificate), as PEM strs, for a host, making them if needed. """
+        with molns_trace.span('tls_material', host=hostname, key_type=self.key_type) as span_args:
+            reason = self._renew_reason(hostname)
+            if reason is not None:
+                print "Creating the TLS certificate of {0} ({1})".format(hostname, reason)
+                self._create(hostname)
+            span_args['created'] = reason is not None
+            with open(os.path.join(self.directory, self.KEY_FILE)) as fd:
+                key = fd.read()
+            with open(os.path.join(self.directory, self.CERT_FILE)) as fd:
+                cert = fd.read()
+            return (key, cert)
+
+    def _renew_reason(self, hostname):
+        """ Returns why new material is needed for hostname, or None. """
+        try:
+            with open(os.path.join(self.directory, self.INFO_FILE)) as fd:
+                info = json.load(fd)
+        except (IOError, ValueError):
+            return 'none stored'
+        if not all(os.path.isfile(os.path.join(self.directory, f)) for f in [self.KEY_FILE, self.CERT_FILE]):
+            return 'none stored'
+        if info.get('hostname') != hostname:
+            return 'the hostname changed'
+        if info.get('key_type') != self.key_type:
+            return 'the key type changed'
+        if info.get('not_after', 0) - self.RENEW_DAYS * 86400 < time.time():
+            return 'the certificate expires'
+        return None
+
+    def _create(self, hostname):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+        try:
+            (key, cert) = self._create_with_cryptography(hostname)
+        except ImportError:
+            logging.debug("TLSMaterial: the cryptography package is not installed, using the openssl command")
+            (key, cert) = self._create_with_openssl(hostname)
+        # Written before the info file, so material that was not completely written is made again.
+        self._write(self.KEY_FILE, key, 0600)
+        self._write(self.CERT_FILE, cert, 0644)
+        self._write(self.INFO_FILE, json.dumps({'hostname':hostname, 'key_type':self.key_type,
+            'not_after':time.time() + self.VALID_DAYS * 86400}), 0644)
+
+    def _write(self, filename, data, mode):
+        path = os.path.join(self.directory, filename)
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+
+    def _create_with_cryptography(self, hostname):
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa, ec
+        if self.key_type == 'ec':
+            key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        else:
+            key = rsa.generate_private_key(public_exponent=65537, key_size=self.RSA_KEY_SIZE, backend=default_backend())
+        oids = {'C':NameOID.COUNTRY_NAME, 'ST':NameOID.STATE_OR_PROVINCE_NAME, 'L':NameOID.LOCALITY_NAME, 'O':NameOID.ORGANIZATION_NAME}
+        name = x509.Name([x509.NameAttribute(oids[k], unicode(v)) for (k, v) in self.SUBJECT] +
+                         [x509.NameAttribute(NameOID.COMMON_NAME, unicode(hostname))])
+        now = datetime.datetime.utcnow()
+        cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+            .serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(days=1)) \
+            .not_valid_after(now + datetime.timedelta(days=self.VALID_DAYS)) \
+            .add_extension(x509.SubjectAlternativeName([self._alt_name(hostname)]), critical=False) \
+            .sign(key, hashes.SHA256(), default_backend())
+        key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption())
+        return (key_pem, cert.public_bytes(serialization.Encoding.PEM))
+
+    @staticmethod
+    def _is_ip_address(hostname):
+        for family in [socket.AF_INET, socket.AF_INET6]:
+            try:
+                socket.inet_pton(family, hostname)
+                return True
+            except (socket.error, ValueError):
+                pass
+        return False
+
+    @staticmethod
+    def _alt_name(hostname):
+        from cryptography import x509
+        import ipaddress
+        try:
+            return x509.IPAddress(ipaddress.ip_address(unicode(hostname)))
+        except ValueError:
+            return x509.DNSName(unicode(hostname))
+
+    def _create_with_openssl(self, hostname):
+        if self.key_type == 'ec':
+            newkey = ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:{0}'.format(self.EC_CURVE)]
+        else:
+            newkey = ['-newkey', 'rsa:{0}'.format(self.RSA_KEY_SIZE)]
+        subject = ''.join('/{0}={1}'.format(k, v) for (k, v) in self.SUBJECT + [('CN', hostname)])
+        alt_name = '{0}:{1}'.format('IP' if self._is_ip_address(hostname) else 'DNS', hostname)
+        tmp_dir = tempfile.mkdtemp(dir=self.directory)
+        try:
+            (key_file, cert_file) = (os.path.join(tmp_dir, 'key.pem'), os.path.join(tmp_dir, 'cert.pem'))
+            # The subjectAltName is given in a config file, as older openssl versions have no -addext.
+            config_file = os.path.join(tmp_dir, 'openssl.cnf')
+            with open(config_file, 'w') as fd:
+                fd.write("[req]\ndistinguished_name = dn\nx509_extensions = v3\n[dn]\n[v3]\nsubjectAltName = {0}\n".format(alt_name))
+            command = ['openssl', 'req', '-new', '-x509', '-nodes', '-days', str(self.VALID_DAYS), '-subj', subject,
+                       '-config', config_file, '-keyout', key_file, '-out', cert_file] + newkey
+            try:
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            except OSError as e:
+                raise TLSException("Can not create the TLS certificate: install the cryptography package or the openssl command ({0})".format(e))
+            output = process.communicate()[0]
+            if process.returncode != 0:
+                raise TLSException("openssl failed to create the TLS certificate: {0}".format(output))
+            with open(key_file) as fd:
+                key = fd.read()
+            with open(cert_file) as fd:
+                cert = fd.read()
+            return (key, cert)
+        finally:
+            shutil.rmtree(tmp_dir)
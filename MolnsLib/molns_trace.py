@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+
+#############################################################
+# Span tracing of molns commands, for 'molns --trace[=file]'.
+#
+#   with molns_trace.span('exec_command', host=ip_address, command=command):
+#       ...
+#
+# records when the block started and ended, in which process and thread, and whether it
+# raised.  Tracing is off unless start() was called, and span() then costs one check.
+#
+# The spans are appended to a file as they end, one JSON object per line, so the spans of
+# processes forked by the command (e.g. the engine deployments) are kept.  stop() turns them
+# into a Chrome trace (chrome://tracing, or https://ui.perfetto.dev).
+#############################################################
+
+_trace = None
+
+class _Trace():
+    def __init__(self, filename):
+        self.filename = filename
+        self.events_filename = filename + '.events'
+        self.fd = os.open(self.events_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0644)
+        self.threads_named = set()
+        self.lock = threading.Lock()
+
+    def write(self, event):
+        # O_APPEND makes each write atomic, between threads and forked processes.
+        os.write(self.fd, json.dumps(event, default=str) + '\n')
+
+    def thread_id(self):
+        """ Return (pid, tid) of the current thread, naming it in the trace on first use. """
+        pid = os.getpid()
+        thread = threading.current_thread()
+        tid = thread.ident
+        with self.lock:
+            if (pid, tid) not in self.threads_named:
+                self.threads_named.add((pid, tid))
+                self.write({'ph':'M', 'name':'thread_name', 'pid':pid, 'tid':tid, 'args':{'name':thread.name}})
+        return (pid, tid)
+
+def enabled():
+    return _trace is not None
+
+def start(filename=None):
+    """ Start recording spans, for the Chrome trace filename (default: molns-trace-<date>-<time>.json). """
+    global _trace
+    if filename is None:
+        filename = time.strftime('molns-trace-%Y%m%d-%H%M%S.json')
+    _trace = _Trace(filename)
+    return filename
+
+def stop():
+    """ Stop recording, and write the Chrome trace.  Returns its filename. """
+    global _trace
+    if _trace is None:
+        return None
+    (trace, _trace) = (_trace, None)
+    os.close(trace.fd)
+    events = []
+    with open(trace.events_filename) as fd:
+        for line in fd:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                pass # A process killed in the middle of a write
+    with open(trace.filename, 'w') as fd:
+        json.dump({'traceEvents':events, 'displayTimeUnit':'ms'}, fd)
+    os.remove(trace.events_filename)
+    return trace.filename
+
+@contextlib.contextmanager
+def span(name, **args):
+    """ Record the block as a span called name.
+
+    Args:
+        name: a str, the phase (e.g. 'start_instance', 'exec_command').
+        args: shown with the span, e.g. host=ip_address.
+    Yields:
+        The dict of args, to add results found inside the block (e.g. the number of attempts).
+    """
+    trace = _trace
+    if trace is None:
+        yield args
+        return
+    (pid, tid) = trace.thread_id()
+    t0 = time.time()
+    try:
+        yield args
+        args['outcome'] = 'ok'
+    except BaseException as e:
+        args['outcome'] = "{0}: {1}".format(e.__class__.__name__, e)
+        raise
+    finally:
+        trace.write({'ph':'X', 'name':name, 'cat':'molns', 'pid':pid, 'tid':tid,
+            'ts':int(t0 * 1e6), 'dur':int((time.time() - t0) * 1e6), 'args':args})
+
+def add_span(name, start, duration, **args):
+    """ Record a span that was timed elsewhere (e.g. a step of a remote script).
+
+    Args:
+        name: a str, the phase.
+        start: the time.time() it started.
+        duration: its length, in seconds.
+        args: shown with the span.
+    """
+    trace = _trace
+    if trace is None:
+        return
+    (pid, tid) = trace.thread_id()
+    trace.write({'ph':'X', 'name':name, 'cat':'molns', 'pid':pid, 'tid':tid,
+        'ts':int(start * 1e6), 'dur':int(duration * 1e6), 'args':args})
+
+def traced(name=None):
+    """ Decorator that records each call of a method as a span (named after the method by
+    default).  The hostname attribute of the object, if it has one, is recorded as the host,
+    and the name attribute (of config objects) as the target. """
+    def decorator(function):
+        span_name = name if name is not None else function.__name__
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            if _trace is None:
+                return function(self, *args, **kwargs)
+            with span(span_name) as span_args:
+                try:
+                    return function(self, *args, **kwargs)
+                finally:
+                    # Read after the call, as the method may be the one that connects.
+                    if getattr(self, 'hostname', None) is not None:
+                        span_args['host'] = self.hostname
+                    elif isinstance(getattr(self, 'name', None), basestring):
+                        span_args['target'] = self.name
+        return wrapper
+    return decorator
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+import sys
+import time
+import logging
+from molns_ready import probe_ports
+
+#############################################################
+# The phase of a running instance, as far as it can be seen from the outside.
+
+PHASE_BOOTING = 'booting'               # running, but sshd does not answer yet
+PHASE_SSH_READY = 'ssh-ready'           # sshd answers
+PHASE_CONTROLLER_UP = 'controller-up'   # ipcontroller answers (controllers)
+PHASE_ENGINES_UP = 'engines-up'         # ipengine processes are running (workers)
+
+SSH_PORT = 22
+IPCONTROLLER_PORT = 9000
+
+# Seconds between two updates: short while the instances change, longer once they are stable.
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 30
+
+def next_poll_interval(interval, changed):
+    """ Return the time to wait before the next update. """
+    if changed:
+        return MIN_POLL_INTERVAL
+    return min(interval * 2, MAX_POLL_INTERVAL)
+
+#############################################################
+
+class InstanceProbe():
+    """ Find the phase of running instances.
+
+    The SSH connections to the workers are kept open between two probes, so watching a
+    cluster only pays for the SSH handshake once per worker.
+    """
+    def __init__(self, connect_timeout=1.0, ssh_timeout=5):
+        self.connect_timeout = connect_timeout
+        self.ssh_timeout = ssh_timeout
+        self.ssh_clients = {}
+
+    def probe(self, targets):
+        """ Find the phase of instances.
+
+        Args:
+            targets: a list of (key, ip_address, role, username, keyfile), where role is
+                'controller' or 'worker'.
+        Returns:
+            A dict of key -> phase.
+        """
+        addresses = [(t[1], SSH_PORT) for t in targets]
+        addresses += [(t[1], IPCONTROLLER_PORT) for t in targets if t[2] == 'controller']
+        accepted = probe_ports(addresses, timeout=self.connect_timeout)
+        phases = {}
+        workers = []
+        for (key, ip_address, role, username, keyfile) in targets:
+            if (ip_address, SSH_PORT) not in accepted:
+                phases[key] = PHASE_BOOTING
+                self.close_host(ip_address)
+            elif role == 'controller' and (ip_address, IPCONTROLLER_PORT) in accepted:
+                phases[key] = PHASE_CONTROLLER_UP
+            else:
+                phases[key] = PHASE_SSH_READY
+                if role == 'worker':
+                    workers.append((key, ip_address, username, keyfile))
+        if len(workers) > 0:
+            import threading
+            threads = [threading.Thread(target=self._probe_engines, args=(w, phases)) for w in workers]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            for t in threads:
+                t.join()
+        return phases
+
+    def _probe_engines(self, worker, phases):
+        (key, ip_address, username, keyfile) = worker
+        try:
+            client = self.ssh_clients.get(ip_address)
+            if client is None:
+                import paramiko
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.connect(ip_address, SSH_PORT, username=username, key_filename=keyfile, timeout=self.ssh_timeout)
+                self.ssh_clients[ip_address] = client
+            (stdin, stdout, stderr) = client.exec_command('pgrep -c -f ipengine', timeout=self.ssh_timeout)
+            count = stdout.read().strip()
+            if count.isdigit() and int(count) > 0:
+                phases[key] = "{0} ({1})".format(PHASE_ENGINES_UP, count)
+        except Exception as e:
+            logging.debug("InstanceProbe: checking the engines of {0} failed: {1}".format(ip_address, e))
+            self.close_host(ip_address)
+
+    def close_host(self, ip_address):
+        client = self.ssh_clients.pop(ip_address, None)
+        if client is not None:
+            client.close()
+
+    def close(self):
+        for ip_address in self.ssh_clients.keys():
+            self.close_host(ip_address)
+
+#############################################################
+
+class WatchDisplay():
+    """ A table on the terminal, where only the rows that changed are redrawn.
+
+    When the output is not a terminal, the whole table is printed again when any row changed.
+    """
+    def __init__(self, column_names, out=None):
+        self.column_names = column_names
+        self.out = out if out is not None else sys.stdout
+        self.tty = hasattr(self.out, 'isatty') and self.out.isatty()
+        self.rows = None
+        self.widths = None
+        self.lines = 0  # lines drawn, the footer included
+
+    def _format(self, row):
+        return '| ' + ' | '.join([str(n).ljust(self.widths[i]) for i, n in enumerate(row)]) + ' |'
+
+    def _rule(self):
+        return '|' + '|'.join(['-' * (w + 2) for w in self.widths]) + '|'
+
+    def _draw(self, rows, footer):
+        """ Draw the whole table below the cursor.  Returns the number of lines. """
+        lines = [self._rule(), self._format(self.column_names), self._rule()]
+        lines += [self._format(row) for row in rows]
+        lines += [self._rule(), footer]
+        self.out.write('\n'.join(lines) + '\n')
+        return len(lines)
+
+    def update(self, rows, footer):
+        """ Show rows (a list of lists of values) and a footer line.  Returns True if a row changed. """
+        rows = [[str(n) for n in row] for row in rows]
+        changed = rows != self.rows
+        widths = [len(str(n)) for n in self.column_names]
+        for row in rows:
+            widths = [max(w, len(n)) for w, n in zip(widths, row)]
+        if not self.tty:
+            if changed:
+                self.widths = widths
+                self._draw(rows, footer)
+                self.out.flush()
+        elif self.rows is None or len(rows) != len(self.rows) or widths != self.widths:
+            # Move up to the top of the previous table, and draw over it.
+            if self.lines > 0:
+                self.out.write('\033[{0}A\r\033[J'.format(self.lines))
+            self.widths = widths
+            self.lines = self._draw(rows, footer)
+        else:
+            for n, row in enumerate(rows):
+                if row != self.rows[n]:
+                    up = self.lines - (3 + n)
+                    self.out.write('\033[{0}A\r\033[K{1}\033[{0}B\r'.format(up, self._format(row)))
+            self.out.write('\033[1A\r\033[K{0}\n'.format(footer))
+        self.out.flush()
+        self.rows = rows
+        return changed
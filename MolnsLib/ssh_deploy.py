@@ -3,16 +3,28 @@ import json
 import logging
 import os
 import paramiko
+import socket
 import string
 import sys
 import time
 import uuid
 import webbrowser
 import urllib2
+import molns_trace
+import molns_ready
+import ssh_exec
+from ssh_files import FileProvisioner, FileProvisionerException
+from deploy_plan import DeployPlan, DeployPlanProgress, DeployPlanError, notebook_password_hash
+from ssh_pool import pool
 
 class SSHDeployException(Exception):
     pass
 
+class SSHDeployRetryableException(SSHDeployException):
+    ''' The deployment failed before anything was changed on the host (e.g. the connection
+    dropped while the deploy script was uploaded): it can be tried again. '''
+    pass
+
 class SSHDeploy:
     '''
     This class is used for deploy IPython
@@ -28,6 +40,9 @@ class SSHDeploy:
     MAX_NUMBER_SSH_CONNECT_ATTEMPTS = 25
     DEFAULT_SSH_PORT = 22
     DEFAULT_IPCONTROLLER_PORT = 9000
+    # Seconds a remote command may run.
+    COMMAND_TIMEOUT = 1800
+    NUMBER_PROCESSORS_COMMAND = 'python -c "import multiprocessing;print multiprocessing.cpu_count()"'
 
     DEFAULT_PYURDME_TEMPDIR="/mnt/pyurdme_tmp"
 
@@ -44,14 +59,20 @@ class SSHDeploy:
         self.ssh_endpoint = self.DEFAULT_SSH_PORT
         self.keyfile = config.sshkeyfilename()
         self.provider_name = config.name
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        # Set by connect(), to a connection of the SSH connection pool.
+        self.ssh = None
+        # The FileProvisioner of the connection, see files().
+        self._files = None
         self.profile = 'default'
         self.profile_dir = "/home/%s/.ipython/profile_default/" %(self.username)
         self.ipengine_env = 'export INSTANT_OS_CALL_METHOD=SUBPROCESS;export PYURDME_TMPDIR={0};'.format(self.DEFAULT_PYURDME_TEMPDIR)
         self.profile_dir_server = self.profile_dir
         self.profile_dir_client = self.profile_dir
         self.ipython_port = self.DEFAULT_IPCONTROLLER_PORT
+        self.hostname = None
+        self.port = None
+        # A time.time() by which all the remote commands must have finished, or None.
+        self.deadline = None
 
 
     def scp_command(self, hostname):    
@@ -59,7 +80,8 @@ class SSHDeploy:
                 %s@%s:%ssecurity/ipcontroller-engine.json %ssecurity/" \
                 %(self.username, hostname, self.profile_dir_server, self.profile_dir_client)
 
-    def prompt_for_password(self):
+    @staticmethod
+    def prompt_for_password():
         import getpass
         while True:
             print "Choose a password to access the IPython interface."
@@ -72,38 +94,50 @@ class SSHDeploy:
             else:
                 print "Passwords do not match, try again."
 
-    def create_ssl_cert(self, cert_directory, cert_name_prefix, hostname):
-        self.exec_command("mkdir -p '{0}'".format(cert_directory))
-        user_cert = cert_directory + '{0}-user_cert.pem'.format(cert_name_prefix)
-        ssl_key = cert_directory + '{0}-ssl_key.pem'.format(cert_name_prefix)
-        ssl_cert = cert_directory + '{0}-ssl_cert.pem'.format(cert_name_prefix)
+    @staticmethod
+    def _ssl_cert_files(cert_directory, cert_name_prefix):
+        """ Returns (ssl_key, ssl_cert), the names of the key and certificate files on the host. """
+        return (cert_directory + '{0}-ssl_key.pem'.format(cert_name_prefix), cert_directory + '{0}-ssl_cert.pem'.format(cert_name_prefix))
+
+    def _ssl_cert_commands(self, cert_directory, cert_name_prefix, hostname):
+        """ Returns ([command, ...], ssl_key, ssl_cert): the commands that create a self-signed certificate. """
+        (ssl_key, ssl_cert) = self._ssl_cert_files(cert_directory, cert_name_prefix)
         ssl_subj = "/C=CN/ST=SH/L=STAR/O=Dis/CN=%s" % hostname 
-        self.exec_command(
+        commands = ["mkdir -p '{0}'".format(cert_directory),
             "openssl req -new -newkey rsa:4096 -days 365 "
             '-nodes -x509 -subj %s -keyout %s -out %s' %
-            (ssl_subj, ssl_key, ssl_cert))
+            (ssl_subj, ssl_key, ssl_cert)]
+        return (commands, ssl_key, ssl_cert)
+
+    @molns_trace.traced()
+    def create_ssl_cert(self, cert_directory, cert_name_prefix, hostname):
+        (commands, ssl_key, ssl_cert) = self._ssl_cert_commands(cert_directory, cert_name_prefix, hostname)
+        self.exec_command_list_switch(commands)
         return (ssl_key, ssl_cert)
 
-    def create_ipython_config(self, hostname, notebook_password=None):
-        (ssl_key, ssl_cert) = self.create_ssl_cert(self.profile_dir_server, self.username, hostname)
-        remote_file_name = '%sipython_notebook_config.py' % self.profile_dir_server
+    def plan_ipython_config(self, plan, hostname, notebook_password=None, tls=None):
+        """ Add the steps that write the notebook (with a certificate) and ipcontroller configs to plan.
+
+        Args:
+            tls: the molns_tls.TLSMaterial to upload, or None to create a certificate on the host.
+        """
+        if tls is not None:
+            (ssl_key, ssl_cert) = self._ssl_cert_files(self.profile_dir_server, self.username)
+            (key_data, cert_data) = tls.get(hostname)
+            plan.write_file(ssl_key, key_data, mode=0600)
+            plan.write_file(ssl_cert, cert_data)
+        else:
+            (commands, ssl_key, ssl_cert) = self._ssl_cert_commands(self.profile_dir_server, self.username, hostname)
+            plan.step('ssl certificate', *commands)
         notebook_port = self.endpoint
-        sha1py = 'from IPython.lib import passwd; print passwd("%s")'
-        sha1cmd = "python -c '%s'" % sha1py
         if notebook_password is None:
             passwd = self.prompt_for_password()
         else:
             passwd = notebook_password
-        try:
-            sha1pass_out = self.exec_command(sha1cmd % passwd , verbose=False)
-            sha1pass = sha1pass_out[0].strip()
-        except Exception as e:
-            print "Failed: {0}\t{1}:{2}".format(e, hostname, self.ssh_endpoint)
-            raise e
-        
-        sftp = self.ssh.open_sftp()
-        notebook_config_file = sftp.file(remote_file_name, 'w+')
-        notebook_config_file.write('\n'.join([ 
+        # Hashed here: the password is never sent to the host.
+        sha1pass = notebook_password_hash(passwd)
+
+        plan.write_file('%sipython_notebook_config.py' % self.profile_dir_server, '\n'.join([ 
                 "c = get_config()",
                 "c.IPKernelApp.pylab = 'inline'",
                 "c.NotebookApp.certfile = u'%s'" % ssl_cert,
@@ -114,46 +148,21 @@ class SSHDeploy:
                 "c.NotebookApp.port = %d" % int(notebook_port),
                 #"c.Global.exec_lines = ['import dill', 'from IPython.utils import pickleutil', 'pickleutil.use_dill()', 'import logging','logging.getLogger(\'UFL\').setLevel(logging.ERROR)','logging.getLogger(\'FFC\').setLevel(logging.ERROR)']",
                 ]))
-        notebook_config_file.close()
-        
-        remote_file_name='%sipcontroller_config.py' % self.profile_dir_server
-        notebook_config_file = sftp.file(remote_file_name, 'w+')
-        notebook_config_file.write('\n'.join([
+
+        plan.write_file('%sipcontroller_config.py' % self.profile_dir_server, '\n'.join([
                 "c = get_config()",
                 "c.IPControllerApp.log_level=20",
                 "c.HeartMonitor.period=10000",
                 "c.HeartMonitor.max_heartmonitor_misses=10",
                 "c.HubFactory.db_class = \"SQLiteDB\"",
                 ]))
-        notebook_config_file.close()
-
-#        # IPython startup code
-#        remote_file_name='{0}startup/molns_dill_startup.py'.format(self.profile_dir_server)
-#        dill_init_file = sftp.file(remote_file_name, 'w+')
-#        dill_init_file.write('\n'.join([
-#                'import dill',
-#                'from IPython.utils import pickleutil',
-#                'pickleutil.use_dill()',
-#                'import logging',
-#                "logging.getLogger('UFL').setLevel(logging.ERROR)",
-#                "logging.getLogger('FFC').setLevel(logging.ERROR)"
-#                "import cloud",
-#                "logging.getLogger('Cloud').setLevel(logging.ERROR)"
-#                ]))
-#        dill_init_file.close()
-        sftp.close()
-
-    def create_s3_config(self):
-        sftp = self.ssh.open_sftp()
-        remote_file_name='.molns/s3.json'
-        s3_config_file = sftp.file(remote_file_name, 'w')
+
+    def plan_s3_config(self, plan):
         config = {}
         config["provider_type"] = self.config.type
         config["bucket_name"] = "molns_storage_{1}_{0}".format(self.get_cluster_id(), self.provider_name)
         config["credentials"] = self.config.get_config_credentials()
-        s3_config_file.write(json.dumps(config))
-        s3_config_file.close()
-        sftp.close()
+        plan.write_file('.molns/s3.json', json.dumps(config))
 
     def get_cluster_id(self):
         """ retreive the cluster id from the config. """
@@ -171,84 +180,125 @@ class SSHDeploy:
             return idstr
 
 
-    def create_engine_config(self):
-        sftp = self.ssh.open_sftp()
-        remote_file_name='%sipengine_config.py' % self.profile_dir_server
-        notebook_config_file = sftp.file(remote_file_name, 'w+')
-        notebook_config_file.write('\n'.join([
+    def plan_engine_config(self, plan):
+        plan.write_file('%sipengine_config.py' % self.profile_dir_server, '\n'.join([
                 "c = get_config()",
                 "c.IPEngineApp.log_level=20",
                 "c.IPEngineApp.log_to_file = True",
                 "c.Global.exec_lines = ['import dill', 'from IPython.utils import pickleutil', 'pickleutil.use_dill()']",
                 ]))
-        notebook_config_file.close()
-        sftp.close()
-        self.create_s3_config()
 
+    def plan_scratch_space(self, plan):
+        """ Add the steps that set up the local scratch space to plan. """
+        plan.step('local scratch space',
+            "sudo mkdir -p /mnt/molnsarea",
+            "sudo chown ubuntu /mnt/molnsarea",
+            "sudo mkdir -p /mnt/molnsarea/cache",
+            "sudo chown ubuntu /mnt/molnsarea/cache",
+            "test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsarea {0}".format('/home/ubuntu/localarea'))
+
+    def plan_ipengines(self, plan, num_reserved=0):
+        """ Add the step that starts one ipengine per processor of the host, less num_reserved. """
+        plan.step('start ipengines',
+            "num_engines=$(( $({0}) - {1} )) && for n in $(seq 1 $num_engines); do {2}; done".format(
+                self.NUMBER_PROCESSORS_COMMAND, num_reserved,
+                "{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipengine --profile={0} --debug || exit $?".format(self.profile, self.ipengine_env)))
+
+    def run_plan(self, plan):
+        """ Upload plan as a script, run it, and report its steps as they end.
+
+        Raises:
+            SSHDeployRetryableException if the script could not be uploaded, or the host did not
+            accept the command that runs it; SSHDeployException if it failed after that.
+        """
+        script = plan.render()
+        remote_file_name = '/tmp/molns-deploy-{0}.sh'.format(uuid.uuid4())
+        try:
+            with molns_trace.span('sftp_put', host=self.hostname, file=remote_file_name):
+                self.files().put_file(remote_file_name, script, mode=0600)
+        except (paramiko.SSHException, socket.error, EOFError, FileProvisionerException) as e:
+            print "FAILED......\tuploading the deploy script: {0}".format(e)
+            raise SSHDeployRetryableException("uploading the deploy script to {0} failed: {1}".format(self.hostname, e))
+
+        def on_step(n, name, seconds):
+            print "[{0}/{1}] {2}\t{3:.1f}s".format(n + 1, len(plan.steps), name, seconds)
+            molns_trace.add_span('deploy_step', time.time() - seconds, seconds, host=self.hostname, step=name)
+
+        progress = DeployPlanProgress(plan, on_step=on_step)
+
+        def on_output(stream, data):
+            # All the output of the script is logged, as that of each command was before.
+            self._log_output(stream, data)
+            progress.on_output(stream, data)
+
+        started = []
+        try:
+            result = ssh_exec.run_command(self._open_session(), "bash {0}".format(remote_file_name), timeout=self.COMMAND_TIMEOUT,
+                                          deadline=self.deadline, on_output=on_output, on_started=lambda: started.append(True))
+            progress.check(result.status)
+        except (paramiko.SSHException, socket.error, EOFError) as e:
+            print "FAILED......\t{0}".format(e)
+            if len(started) == 0:
+                # The host did not accept the command, so the script did not run.  Once it
+                # is accepted, the script may be running even if none of its output arrived.
+                raise SSHDeployRetryableException("running the deploy script on {0} failed: {1}".format(self.hostname, e))
+            raise SSHDeployException(str(e))
+        except DeployPlanError as e:
+            print "FAILED......\t{0}".format(e)
+            raise SSHDeployException(str(e))
+
+    @molns_trace.traced()
     def _get_ipython_client_file(self):
-        sftp = self.ssh.open_sftp()
-        engine_file = sftp.file(self.profile_dir_server + 'security/ipcontroller-client.json', 'r')
-        engine_file.prefetch()
-        file_data = engine_file.read()
-        engine_file.close()
-        sftp.close()
-        return file_data
+        return self.files().get_file(self.profile_dir_server + 'security/ipcontroller-client.json')
     
+    @molns_trace.traced()
     def _put_ipython_client_file(self, file_data):
-        sftp = self.ssh.open_sftp()
-        engine_file = sftp.file(self.profile_dir_server + 'security/ipcontroller-client.json', 'w+')
-        engine_file.write(file_data)
-        engine_file.close()
-        sftp.close()
+        self.files().put_file(self.profile_dir_server + 'security/ipcontroller-client.json', file_data)
 
+    @molns_trace.traced()
     def _get_ipython_engine_file(self):
-        sftp = self.ssh.open_sftp()
-        engine_file = sftp.file(self.profile_dir_server + 'security/ipcontroller-engine.json', 'r')
-        engine_file.prefetch()
-        file_data = engine_file.read()
-        engine_file.close()
-        sftp.close()
-        return file_data
+        return self.files().get_file(self.profile_dir_server + 'security/ipcontroller-engine.json')
     
+    @molns_trace.traced()
     def _put_ipython_engine_file(self, file_data):
-        sftp = self.ssh.open_sftp()
-        engine_file = sftp.file(self.profile_dir_server + 'security/ipcontroller-engine.json', 'w+')
-        engine_file.write(file_data)
-        engine_file.close()
-        sftp.close()
+        self.files().put_file(self.profile_dir_server + 'security/ipcontroller-engine.json', file_data)
 
     def exec_command_list_switch(self, command_list):
         for command in command_list:
             self.exec_command(command)
 
-    def exec_command(self, command, verbose=True):
+    def exec_command(self, command, verbose=True, timeout=None, on_output=None):
+        """ Run command on the host, and return its output as a list of lines.
+
+        Args:
+            command: the command line.
+            verbose: print the command.  Commands run with verbose=False may contain a password.
+            timeout: seconds the command may run (default: COMMAND_TIMEOUT).  The command also
+                stops at self.deadline.
+            on_output: a function called with ('stdout'|'stderr', data) as the output arrives
+                (default: log it at the debug level, if verbose).
+        Raises:
+            SSHDeployException if the command failed or timed out.
+        """
+        with molns_trace.span('exec_command', host=self.hostname, command=command if verbose else '(not shown)'):
+            return self._exec_command(command, verbose, timeout, on_output)
+
+    def _log_output(self, stream, data):
+        logging.debug("{0} {1}: {2}".format(self.hostname, stream, data.rstrip('\n')))
+
+    def _exec_command(self, command, verbose=True, timeout=None, on_output=None):
+        if timeout is None:
+            timeout = self.COMMAND_TIMEOUT
+        if on_output is None and verbose:
+            on_output = self._log_output
         try:
-            stdout_data = []
-            stderr_data = []
-            session = self.ssh.get_transport().open_session()
-            session.exec_command(command)
-            nbytes = 4096
-            #TODO add a timeout here, don't wait for commands forever.
-            while True:
-                if session.recv_ready():
-                    msg = session.recv(nbytes)
-                    stdout_data.append(msg)
-                if session.recv_stderr_ready():
-                    msg = session.recv_stderr(nbytes)
-                    stderr_data.append(msg)
-                if session.exit_status_ready():
-                    break
-                time.sleep(0.1) # Sleep breifly to prevent over-polling
-
-            status = session.recv_exit_status()
-            str_return = ''.join(stdout_data).splitlines()
-            stderr_str = ''.join(stderr_data)
-            session.close()
-            if status != 0:
-                raise paramiko.SSHException("Exit Code: {0}\tSTDOUT: {1}\tSTDERR: {2}\n\n".format(status, "\n".join(str_return), stderr_str))
+            result = ssh_exec.run_command(self._open_session(), command, timeout=timeout, deadline=self.deadline,
+                                          on_output=on_output, capture_stdout=True)
+            if result.status != 0:
+                raise paramiko.SSHException(result.error_message())
             if verbose:
                 print "EXECUTING...\t{0}".format(command)
-            return str_return
+            return result.stdout.splitlines()
         except paramiko.SSHException as e:
             if verbose:
                 print "FAILED......\t{0}\t{1}".format(command,e)
@@ -256,29 +306,72 @@ class SSHDeploy:
 
     def exec_multi_command(self, command, next_command):
         try:
-            stdin, stdout, stderr = self.ssh.exec_command(command)
-            stdin.write(next_command)
-            stdin.flush()
-            status = stdout.channel.recv_exit_status()
-            if status != 0:
-                raise paramiko.SSHException("Exit Code: {0}\tSTDOUT: {1}\tSTDERR: {2}\n\n".format(status, stdout.read(), stderr.read()))
+            result = ssh_exec.run_command(self._open_session(), command, timeout=self.COMMAND_TIMEOUT, deadline=self.deadline,
+                                          on_output=self._log_output, input_data=next_command)
+            if result.status != 0:
+                raise paramiko.SSHException(result.error_message())
         except paramiko.SSHException as e:
             print "FAILED......\t{0}\t{1}".format(command,e)
             raise e
-            
+
     def connect(self, hostname, port):
         print "Connecting to {0}:{1} keyfile={2}".format(hostname,port,self.keyfile)
-        for i in range(self.MAX_NUMBER_SSH_CONNECT_ATTEMPTS):
+        self.hostname = hostname
+        self.port = port
+        with molns_trace.span('ssh_connect', host=hostname, port=port) as span_args:
+            if not pool.has_connection(hostname, port, self.username, self.keyfile):
+                # Log in once sshd accepts connections, rather than retrying the login while the host boots.
+                with molns_trace.span('wait_for_port', host=hostname, port=port):
+                    if not molns_ready.wait_for_port(hostname, int(port), timeout=self.MAX_NUMBER_SSH_CONNECT_ATTEMPTS * self.SSH_CONNECT_WAITTIME):
+                        raise SSHDeployException("ssh connect Failed!!!\t{0}:{1} does not accept connections".format(hostname, port))
+            for i in range(self.MAX_NUMBER_SSH_CONNECT_ATTEMPTS):
+                span_args['attempts'] = i + 1
+                try:
+                    # Reuses the open connection to this host, if there is one.
+                    self._release()
+                    self.ssh = pool.get(hostname, port, self.username, self.keyfile)
+                    print "SSH connection established"
+                    return
+                except Exception as e:
+                    print "Retry in {0} seconds...\t\t{1}".format(self.SSH_CONNECT_WAITTIME,e)
+                    time.sleep(self.SSH_CONNECT_WAITTIME)
+            raise SSHDeployException("ssh connect Failed!!!\t{0}:{1}".format(hostname,self.ssh_endpoint))
+
+    def disconnect(self):
+        """ Done with the host.  The connection stays open in the pool, for the next phase. """
+        if self._files is not None:
             try:
-                self.ssh.connect(hostname, port, username=self.username,
-                    key_filename=self.keyfile)
-                print "SSH connection established"
-                return
+                self._files.close()
             except Exception as e:
-                print "Retry in {0} seconds...\t\t{1}".format(self.SSH_CONNECT_WAITTIME,e)
-                time.sleep(self.SSH_CONNECT_WAITTIME)
-        raise SSHDeployException("ssh connect Failed!!!\t{0}:{1}".format(hostname,self.ssh_endpoint))
-
+                logging.debug("SSHDeploy: closing the SFTP session of {0} failed: {1}".format(self.hostname, e))
+            self._files = None
+        self._release()
+
+    def _release(self):
+        """ Give the connection back to the pool. """
+        if self.ssh is not None:
+            pool.release(self.hostname, self.port, self.username, self.keyfile, self.ssh)
+            self.ssh = None
+
+    def files(self):
+        """ Returns the FileProvisioner of the host: one SFTP session, opened on first use, for
+        all the files read and written until disconnect(). """
+        if self._files is None or self._files.client is not self.ssh:
+            self._files = FileProvisioner(self.ssh, self.hostname)
+        return self._files
+
+    def _open_session(self):
+        pool.touch(self.hostname, self.port, self.username, self.keyfile)
+        try:
+            return self.ssh.get_transport().open_session()
+        except (paramiko.SSHException, EOFError, AttributeError) as e:
+            # The pooled connection was closed under us (e.g. sshd restarted): reconnect once.
+            logging.debug("SSHDeploy: reconnecting to {0}: {1}".format(self.hostname, e))
+            pool.discard(self.hostname, self.port, self.username, self.keyfile)
+            self.ssh = pool.get(self.hostname, self.port, self.username, self.keyfile)
+            return self.ssh.get_transport().open_session()
+
+    @molns_trace.traced()
     def deploy_molns_webserver(self, ip_address):
         try:
             self.connect(ip_address, self.ssh_endpoint)
@@ -288,49 +381,55 @@ class SSHDeploy:
             self.exec_command("git clone https://github.com/Molns/MOLNS_web_landing_page.git /usr/local/molns_webroot")
             self.exec_multi_command("cd /usr/local/molns_webroot; python -m SimpleHTTPServer {0} > ~/.molns_webserver.log 2>&1 &".format(self.DEFAULT_PRIVATE_WEBSERVER_PORT), '\n')
             self.exec_command("sudo iptables -t nat -A PREROUTING -i eth0 -p tcp --dport {0} -j REDIRECT --to-port {1}".format(self.DEFAULT_PUBLIC_WEBSERVER_PORT,self.DEFAULT_PRIVATE_WEBSERVER_PORT))
-            self.ssh.close()
+            self.disconnect()
             print "Deploying MOLNs webserver"
             url = "http://{0}/".format(ip_address)
-            while True:
-                try:
-                    req = urllib2.urlopen(url)
-                    sys.stdout.write("\n")
-                    sys.stdout.flush()
-                    break
-                except Exception as e:
-                    #sys.stdout.write("{0}".format(e))
-                    sys.stdout.write(".")
-                    sys.stdout.flush()
-                    time.sleep(1)
+            with molns_trace.span('wait_for_webserver', host=ip_address, url=url):
+                while True:
+                    try:
+                        req = urllib2.urlopen(url)
+                        sys.stdout.write("\n")
+                        sys.stdout.flush()
+                        break
+                    except Exception as e:
+                        #sys.stdout.write("{0}".format(e))
+                        sys.stdout.write(".")
+                        sys.stdout.flush()
+                        time.sleep(1)
             webbrowser.open(url)
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
+        finally:
+            self.disconnect()
 
+    @molns_trace.traced()
     def get_number_processors(self):
-        cmd = 'python -c "import multiprocessing;print multiprocessing.cpu_count()"'
         try:
-            output = self.exec_command(cmd)[0].strip()
+            output = self.exec_command(self.NUMBER_PROCESSORS_COMMAND)[0].strip()
             return int(output)
         except Exception as e:
             raise SSHDeployException("Could not determine the number of processors on the remote system: {0}".format(e))
 
-    def deploy_stochss(self, ip_address, port=1443):
+    def deploy_stochss(self, ip_address, port=1443, tls=None):
         try:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(ip_address, self.ssh_endpoint)
             print "Configure Nginx"
-            (ssl_key, ssl_cert) = self.create_ssl_cert('/home/ubuntu/.nginx_cert/', 'stochss', ip_address)
-            sftp = self.ssh.open_sftp()
+            if tls is not None:
+                (ssl_key, ssl_cert) = self._ssl_cert_files('/home/ubuntu/.nginx_cert/', 'stochss')
+                (key_data, cert_data) = tls.get(ip_address)
+                self.exec_command("mkdir -p '/home/ubuntu/.nginx_cert/'")
+                self.files().put_files([(ssl_key, key_data, 0600), (ssl_cert, cert_data, None)])
+            else:
+                (ssl_key, ssl_cert) = self.create_ssl_cert('/home/ubuntu/.nginx_cert/', 'stochss', ip_address)
             with open(os.path.dirname(os.path.abspath(__file__))+os.sep+'..'+os.sep+'templates'+os.sep+'nginx.conf') as fd:
-                web_file = sftp.file("/tmp/nginx.conf", 'w+')
                 buff = fd.read()
                 buff = string.replace(buff, '###LISTEN_PORT###', str(port))
                 buff = string.replace(buff, '###SSL_CERT###', str(ssl_cert))
                 buff = string.replace(buff, '###SSL_CERT_KEY###', str(ssl_key))
                 print buff
-                web_file.write(buff)
-                web_file.close()
+                self.files().put_file("/tmp/nginx.conf", buff)
             self.exec_command("sudo chown root /tmp/nginx.conf")
             self.exec_command("sudo mv /tmp/nginx.conf /etc/nginx/nginx.conf")
             print "Starting Nginx"
@@ -364,127 +463,112 @@ class SSHDeploy:
         except Exception as e:
             print "StochSS launch failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
+        finally:
+            self.disconnect()
 
-    def deploy_ipython_controller(self, ip_address, notebook_password=None):
+    @molns_trace.traced()
+    def deploy_ipython_controller(self, ip_address, notebook_password=None, tls=None):
         controller_hostname =  ''
         engine_file_data = ''
         try:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(ip_address, self.ssh_endpoint)
-            
-            # Set up the symlink to local scratch space
-            self.exec_command("sudo mkdir -p /mnt/molnsarea")
-            self.exec_command("sudo chown ubuntu /mnt/molnsarea")
-            self.exec_command("sudo mkdir -p /mnt/molnsarea/cache")
-            self.exec_command("sudo chown ubuntu /mnt/molnsarea/cache")
-
-            self.exec_command("test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsarea {0}".format('/home/ubuntu/localarea'))
-            
-            # Setup symlink to the shared scratch space
-            self.exec_command("sudo mkdir -p /mnt/molnsshared")
-            self.exec_command("sudo chown ubuntu /mnt/molnsshared")
-            self.exec_command("test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsshared {0}".format('/home/ubuntu/shared'))
-            #
-            self.exec_command("sudo mkdir -p {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
-            self.exec_command("sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
-            #
-            #self.exec_command("cd /usr/local/molnsutil && git pull && sudo python setup.py install")
-            self.exec_command("mkdir -p .molns")
-            self.create_s3_config()
 
-            self.exec_command("ipython profile create {0}".format(self.profile))
-            self.create_ipython_config(ip_address, notebook_password)
-            self.create_engine_config()
-            self.exec_command("source /usr/local/pyurdme/pyurdme_init; screen -d -m ipcontroller --profile={1} --ip='*' --location={0} --port={2} --log-to-file".format(ip_address, self.profile, self.ipython_port), '\n')
-            # Start one ipengine per processor
-            num_procs = self.get_number_processors()
-            num_engines = num_procs - 2
-            for _ in range(num_engines):
-                self.exec_command("{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipengine --profile={0} --debug".format(self.profile, self.ipengine_env))
-            self.exec_command("{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipython notebook --profile={0}".format(self.profile, self.ipengine_env))
-            self.exec_command("sudo iptables -t nat -A PREROUTING -i eth0 -p tcp --dport {0} -j REDIRECT --to-port {1}".format(self.DEFAULT_PUBLIC_NOTEBOOK_PORT,self.DEFAULT_PRIVATE_NOTEBOOK_PORT))
-            self.ssh.close()
+            plan = DeployPlan('controller')
+            self.plan_scratch_space(plan)
+            plan.step('shared space',
+                "sudo mkdir -p /mnt/molnsshared",
+                "sudo chown ubuntu /mnt/molnsshared",
+                "test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsshared {0}".format('/home/ubuntu/shared'))
+            plan.step('pyurdme tempdir',
+                "sudo mkdir -p {0}".format(self.DEFAULT_PYURDME_TEMPDIR),
+                "sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
+            #self.exec_command("cd /usr/local/molnsutil && git pull && sudo python setup.py install")
+            plan.step('molns directory', "mkdir -p .molns")
+            self.plan_s3_config(plan)
+
+            plan.step('ipython profile', "ipython profile create {0}".format(self.profile))
+            self.plan_ipython_config(plan, ip_address, notebook_password, tls)
+            self.plan_engine_config(plan)
+            plan.step('start ipcontroller', "source /usr/local/pyurdme/pyurdme_init; screen -d -m ipcontroller --profile={1} --ip='*' --location={0} --port={2} --log-to-file".format(ip_address, self.profile, self.ipython_port))
+            # Start one ipengine per processor, leaving two for the controller and the notebook
+            self.plan_ipengines(plan, num_reserved=2)
+            plan.step('start notebook', "{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipython notebook --profile={0}".format(self.profile, self.ipengine_env))
+            plan.step('port forwarding', "sudo iptables -t nat -A PREROUTING -i eth0 -p tcp --dport {0} -j REDIRECT --to-port {1}".format(self.DEFAULT_PUBLIC_NOTEBOOK_PORT,self.DEFAULT_PRIVATE_NOTEBOOK_PORT))
+            self.run_plan(plan)
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
+        finally:
+            # Also closes the SFTP session, which would be left open on the pooled connection.
+            self.disconnect()
         url = "http://%s" %(ip_address)
         print "\nThe URL for your MOLNs cluster is: %s." % url
 
+    @molns_trace.traced()
     def get_ipython_engine_file(self, ip_address):
         try:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(ip_address, self.ssh_endpoint)
-            engine_file_data = self._get_ipython_engine_file()
-            self.ssh.close()
-            return engine_file_data
+            return self._get_ipython_engine_file()
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
+        finally:
+            self.disconnect()
 
+    @molns_trace.traced()
     def get_ipython_client_file(self, ip_address):
         try:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(ip_address, self.ssh_endpoint)
-            engine_file_data = self._get_ipython_engine_file()
-            self.ssh.close()
-            return engine_file_data
+            return self._get_ipython_engine_file()
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
+        finally:
+            self.disconnect()
 
 
+    @molns_trace.traced()
     def deploy_ipython_engine(self, ip_address, controler_ip, engine_file_data, controller_ssh_keyfile):
         try:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(ip_address, self.ssh_endpoint)
-            
-            # Setup the symlink to local scratch space
-            self.exec_command("sudo mkdir -p /mnt/molnsarea")
-            self.exec_command("sudo chown ubuntu /mnt/molnsarea")
-            self.exec_command("sudo mkdir -p /mnt/molnsarea/cache")
-            self.exec_command("sudo chown ubuntu /mnt/molnsarea/cache")
-
-
-            self.exec_command("test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsarea {0}".format('/home/ubuntu/localarea'))
-            #
-            self.exec_command("sudo mkdir -p {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
-            self.exec_command("sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
+
+            plan = DeployPlan('engine')
+            self.plan_scratch_space(plan)
+            plan.step('pyurdme tempdir',
+                "sudo mkdir -p {0}".format(self.DEFAULT_PYURDME_TEMPDIR),
+                "sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
             # Setup config for object store
-            self.exec_command("mkdir -p .molns")
-            self.create_s3_config()
-            
-            
+            plan.step('molns directory', "mkdir -p .molns")
+            self.plan_s3_config(plan)
+
             # SSH mount the controller on each engine
-            remote_file_name='.ssh/id_dsa'
             with open(controller_ssh_keyfile) as fd:
-                sftp = self.ssh.open_sftp()
-                controller_keyfile = sftp.file(remote_file_name, 'w')
                 buff = fd.read()
-                print "Read {0} bytes from file {1}".format(len(buff), controller_ssh_keyfile)
-                controller_keyfile.write(buff)
-                controller_keyfile.close()
-                print "Remote file {0} has {1} bytes".format(remote_file_name, sftp.stat(remote_file_name).st_size)
-                sftp.close()
-            self.exec_command("chmod 0600 {0}".format(remote_file_name))
-            self.exec_command("mkdir -p /home/ubuntu/shared")
-            self.exec_command("sshfs -o Ciphers=arcfour -o Compression=no -o reconnect -o idmap=user -o StrictHostKeyChecking=no ubuntu@{0}:/mnt/molnsshared /home/ubuntu/shared".format(controler_ip))
+            print "Read {0} bytes from file {1}".format(len(buff), controller_ssh_keyfile)
+            plan.write_file('.ssh/id_dsa', buff, mode=0600)
+            plan.step('mount shared space',
+                "mkdir -p /home/ubuntu/shared",
+                "sshfs -o Ciphers=arcfour -o Compression=no -o reconnect -o idmap=user -o StrictHostKeyChecking=no ubuntu@{0}:/mnt/molnsshared /home/ubuntu/shared".format(controler_ip))
 
             # Update the Molnsutil package: TODO remove when molnsutil is stable
             #self.exec_command("cd /usr/local/molnsutil && git pull && sudo python setup.py install")
 
-            self.exec_command("ipython profile create {0}".format(self.profile))
-            self.create_engine_config()
+            plan.step('ipython profile', "ipython profile create {0}".format(self.profile))
+            self.plan_engine_config(plan)
             # Just write the engine_file to the engine
-            self._put_ipython_engine_file(engine_file_data)
+            plan.write_file(self.profile_dir_server + 'security/ipcontroller-engine.json', engine_file_data)
             # Start one ipengine per processor
-            for _ in range(self.get_number_processors()):
-                self.exec_command("{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipengine --profile={0} --debug".format(self.profile,  self.ipengine_env))
-
-            self.ssh.close()
-
+            self.plan_ipengines(plan)
+            self.run_plan(plan)
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
+        finally:
+            self.disconnect()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+import time
+import select
+import paramiko
+
+#############################################################
+# Run a command on an SSH channel, waiting on the channel instead of polling it.
+#
+#   result = ssh_exec.run_command(transport.open_session(), 'ls', timeout=60, on_output=callback)
+#
+# The output is passed to on_output(stream, data) as it arrives.  Only the last TAIL_BYTES
+# of each stream are kept for error messages, unless capture_stdout is set.
+#############################################################
+
+# Bytes of stdout and stderr kept for error messages.
+TAIL_BYTES = 4096
+# Longest wait on the channel.  The exit status of a command does not wake up select(), so a
+# command that exits while a process it started in the background holds its output open is
+# seen within this time.
+EXIT_STATUS_WAIT = 1.0
+RECV_BYTES = 32768
+
+class CommandTimeout(paramiko.SSHException):
+    ''' The command did not finish before its deadline. '''
+    pass
+
+class CommandResult():
+    def __init__(self, status, stdout, stdout_tail, stderr_tail):
+        # The exit code of the command.
+        self.status = status
+        # All of stdout if it was captured, else None.
+        self.stdout = stdout
+        self.stdout_tail = stdout_tail
+        self.stderr_tail = stderr_tail
+
+    def error_message(self):
+        return "Exit Code: {0}\tSTDOUT: {1}\tSTDERR: {2}\n\n".format(self.status, self.stdout_tail, self.stderr_tail)
+
+def command_deadline(timeout=None, deadline=None):
+    """ Return the time by which a command must finish (or None), from the timeout of the
+    command (seconds) and a deadline of all the commands (a time.time()). """
+    if timeout is not None:
+        if deadline is None or time.time() + timeout < deadline:
+            return time.time() + timeout
+    return deadline
+
+def run_command(session, command, timeout=None, deadline=None, on_output=None, capture_stdout=False, input_data=None, on_started=None):
+    """ Run command on a new session (channel), and wait for it to finish.
+
+    Args:
+        session: a paramiko Channel, from transport.open_session().  It is closed on return.
+        command: the command line.
+        timeout: seconds the command may run, or None.
+        deadline: a time.time() by which the command must have finished, or None.
+        on_output: a function called with ('stdout'|'stderr', data) as output arrives, or None.
+        capture_stdout: keep all of stdout (for commands whose output is used).
+        input_data: a str written to the stdin of the command, which is then closed.
+        on_started: a function called (without arguments) once the host accepted the command.
+    Returns:
+        A CommandResult.
+    Raises:
+        CommandTimeout if the command did not finish in time, paramiko.SSHException if the
+        connection failed.
+    """
+    start = time.time()
+    end = command_deadline(timeout, deadline)
+    stdout_data = [] if capture_stdout else None
+    tails = {'stdout': '', 'stderr': ''}
+
+    def received(stream, data):
+        if stream == 'stdout' and stdout_data is not None:
+            stdout_data.append(data)
+        tails[stream] = (tails[stream] + data)[-TAIL_BYTES:]
+        if on_output is not None:
+            on_output(stream, data)
+
+    try:
+        session.exec_command(command)
+        if on_started is not None:
+            on_started()
+        if input_data is not None:
+            session.sendall(input_data)
+            session.shutdown_write()
+        while True:
+            # Read before checking the exit status: output received with it is not lost.
+            exited = session.exit_status_ready()
+            while session.recv_ready():
+                received('stdout', session.recv(RECV_BYTES))
+            while session.recv_stderr_ready():
+                received('stderr', session.recv_stderr(RECV_BYTES))
+            if exited:
+                # Also set when the channel was closed without an exit status (status -1).
+                break
+            remaining = None if end is None else end - time.time()
+            if remaining is not None and remaining <= 0:
+                raise CommandTimeout("Timed out after {0:.1f}s".format(time.time() - start))
+            if session.eof_received:
+                # All the output is in: only the exit status is missing.
+                session.status_event.wait(remaining)
+                continue
+            wait = EXIT_STATUS_WAIT if remaining is None else min(remaining, EXIT_STATUS_WAIT)
+            select.select([session], [], [], wait)
+        status = session.recv_exit_status()
+    finally:
+        session.close()
+    return CommandResult(status, ''.join(stdout_data) if stdout_data is not None else None, tails['stdout'], tails['stderr'])
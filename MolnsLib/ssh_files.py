@@ -0,0 +1,74 @@
+import stat
+import logging
+
+class FileProvisionerException(Exception):
+    pass
+
+class FileProvisioner():
+    """ The files of a host, read and written over one SFTP session.
+
+    The session is opened on first use, and kept until close(), so the files of a deployment
+    do not each pay for a new SFTP channel.  Writes are pipelined (the data is sent without
+    waiting for each block to be acknowledged), and each file written is checked with a stat.
+    """
+    def __init__(self, client, hostname=None):
+        """
+        Args:
+            client: a connected paramiko.SSHClient.
+            hostname: the host, for messages.
+        """
+        self.client = client
+        self.hostname = hostname
+        self.sftp = None
+
+    def _session(self):
+        if self.sftp is None:
+            self.sftp = self.client.open_sftp()
+        return self.sftp
+
+    def put_files(self, files):
+        """ Write files, then check that they all have the right size and mode.
+
+        Args:
+            files: a list of (remote_file_name, data, mode), where mode (e.g. 0600) is None to
+                keep the default of the host.  A file with a mode has it before any data is written.
+        Raises:
+            FileProvisionerException if a file is not as written.
+        """
+        sftp = self._session()
+        for (remote_file_name, data, mode) in files:
+            remote_file = sftp.file(remote_file_name, 'w')
+            try:
+                if mode is not None:
+                    remote_file.chmod(mode)
+                remote_file.set_pipelined(True)
+                remote_file.write(data)
+            finally:
+                remote_file.close()
+        for (remote_file_name, data, mode) in files:
+            attributes = sftp.stat(remote_file_name)
+            if attributes.st_size != len(data):
+                raise FileProvisionerException("{0}:{1} has {2} bytes, {3} were written".format(self.hostname, remote_file_name, attributes.st_size, len(data)))
+            if mode is not None and stat.S_IMODE(attributes.st_mode) != mode:
+                raise FileProvisionerException("{0}:{1} has mode {2:o}, not {3:o}".format(self.hostname, remote_file_name, stat.S_IMODE(attributes.st_mode), mode))
+            logging.debug("FileProvisioner: wrote {0}:{1} ({2} bytes)".format(self.hostname, remote_file_name, len(data)))
+
+    def put_file(self, remote_file_name, data, mode=None):
+        self.put_files([(remote_file_name, data, mode)])
+
+    def get_file(self, remote_file_name):
+        """ Returns the content of a file of the host. """
+        remote_file = self._session().file(remote_file_name, 'r')
+        try:
+            remote_file.prefetch()
+            return remote_file.read()
+        finally:
+            remote_file.close()
+
+    def close(self):
+        """ Close the SFTP session (not the SSH connection). """
+        if self.sftp is not None:
+            try:
+                self.sftp.close()
+            finally:
+                self.sftp = None
@@ -0,0 +1,140 @@
+import os
+import time
+import atexit
+import logging
+import threading
+import paramiko
+
+class PooledConnection():
+    """ An open SSH connection, when it was last used, and how many users hold it. """
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.time()
+        # get() calls not yet matched by a release().
+        self.checkouts = 0
+
+class SSHConnectionPool():
+    """ Open SSH connections, shared by the SSHDeploy and InstallSW objects of this process.
+
+    The connections are keyed by (hostname, port, username, keyfile), so the deployment phases
+    of a host (controller, webserver, engine file, ...) use one connection instead of a new
+    handshake and authentication each.  Connections send keepalives, are checked before they
+    are reused, and are closed after IDLE_TIMEOUT seconds without use.  A connection handed out
+    by get() is in use until it is given back with release(), and is not closed meanwhile, however
+    long its commands run.
+    """
+    # Seconds between keepalive messages on an open connection.
+    KEEPALIVE_INTERVAL = 30
+    # Seconds a connection that nobody holds can stay unused before it is closed.
+    IDLE_TIMEOUT = 300
+    # A connection that was unused for this many seconds is checked before it is reused.
+    HEALTH_CHECK_AFTER = 5
+    # Seconds to wait for the TCP connection and the SSH banner.
+    CONNECT_TIMEOUT = 30
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self, hostname, port, username, keyfile):
+        """ Return a connected paramiko.SSHClient, reusing the open connection to the same
+        host, port, user and key if it is healthy.  Give it back with release() when done.
+
+        Raises:
+            The exception of paramiko.SSHClient.connect() if a new connection fails.
+        """
+        key = (hostname, int(port), username, keyfile)
+        now = time.time()
+        with self._lock:
+            self._check_pid()
+            self._evict_idle(now)
+            entry = self._connections.get(key)
+        if entry is not None:
+            if self._is_healthy(entry, now):
+                with self._lock:
+                    entry.last_used = now
+                    entry.checkouts += 1
+                return entry.client
+            logging.debug("SSHConnectionPool: connection to {0}:{1} is broken, reconnecting".format(hostname, port))
+            self.discard(hostname, port, username, keyfile)
+        # Connect without the lock, so several hosts can be connected to at the same time.
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname, int(port), username=username, key_filename=keyfile, timeout=self.CONNECT_TIMEOUT, banner_timeout=self.CONNECT_TIMEOUT)
+        client.get_transport().set_keepalive(self.KEEPALIVE_INTERVAL)
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None:
+                # Another thread connected to the same host meanwhile.
+                client.close()
+                entry.last_used = now
+                entry.checkouts += 1
+                return entry.client
+            entry = PooledConnection(client)
+            entry.checkouts = 1
+            self._connections[key] = entry
+        return client
+
+    def release(self, hostname, port, username, keyfile, client):
+        """ Give back a client returned by get().  Its idle time counts from now. """
+        with self._lock:
+            entry = self._connections.get((hostname, int(port), username, keyfile))
+            # Nothing to do if the connection was discarded (and maybe replaced) meanwhile.
+            if entry is not None and entry.client is client:
+                entry.checkouts = max(entry.checkouts - 1, 0)
+                entry.last_used = time.time()
+
+    def touch(self, hostname, port, username, keyfile):
+        """ Record that the connection to a host is being used. """
+        with self._lock:
+            entry = self._connections.get((hostname, int(port), username, keyfile))
+            if entry is not None:
+                entry.last_used = time.time()
+
+    def has_connection(self, hostname, port, username, keyfile):
+        """ Returns True if there is an open connection to the host (it may have gone bad since). """
+        with self._lock:
+            self._check_pid()
+            return (hostname, int(port), username, keyfile) in self._connections
+
+    def discard(self, hostname, port, username, keyfile):
+        """ Close the connection to a host, e.g. after it failed. """
+        with self._lock:
+            entry = self._connections.pop((hostname, int(port), username, keyfile), None)
+        if entry is not None:
+            entry.client.close()
+
+    def close_all(self):
+        with self._lock:
+            self._check_pid()
+            (entries, self._connections) = (self._connections.values(), {})
+        for entry in entries:
+            entry.client.close()
+
+    def _is_healthy(self, entry, now):
+        transport = entry.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if now - entry.last_used > self.HEALTH_CHECK_AFTER:
+            try:
+                transport.send_ignore()
+            except Exception:
+                return False
+        return True
+
+    def _evict_idle(self, now):
+        for key in [k for (k, entry) in self._connections.items() if entry.checkouts == 0 and now - entry.last_used > self.IDLE_TIMEOUT]:
+            logging.debug("SSHConnectionPool: closing idle connection to {0}:{1}".format(key[0], key[1]))
+            self._connections.pop(key).client.close()
+
+    def _check_pid(self):
+        """ A forked process (e.g. an engine deployment) must not use, or close, the
+        connections of its parent: it starts with an empty pool. """
+        if os.getpid() != self._pid:
+            self._connections = {}
+            self._pid = os.getpid()
+
+# The pool of this process.
+pool = SSHConnectionPool()
+atexit.register(pool.close_all)
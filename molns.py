@@ -1,24 +1,84 @@
 #!/usr/bin/env python
+import time
+_startup_time = time.time()
 import os
 import re
 import sys
-from MolnsLib.molns_datastore import Datastore, DatastoreException, VALID_PROVIDER_TYPES, get_provider_handle
+from MolnsLib.molns_datastore_base import DatastoreException, VALID_PROVIDER_TYPES, DATASTORE_BACKENDS, get_provider_handle, get_datastore_backend
 from MolnsLib.molns_provider import ProviderException
+from MolnsLib import molns_daemon
+from MolnsLib import molns_trace
 from collections import OrderedDict
 import subprocess
-from MolnsLib.ssh_deploy import SSHDeploy
-import multiprocessing
 import json
+import threading
+import itertools
+import shlex
+import Queue
 
 import logging
+# Modules that are slow to import.  They are only imported by the commands that use them
+# (the datastore backend by MOLNSConfig, and ssh_deploy when deploying).
+HEAVY_MODULES = ['sqlalchemy', 'paramiko', 'boto', 'novaclient']
+_import_time = time.time()
 ###############################################
 class MOLNSException(Exception):
     pass
 
 ###############################################
-class MOLNSConfig(Datastore):
-    def __init__(self, config_dir=None, db_file=None):
-        Datastore.__init__(self,config_dir=config_dir, db_file=db_file)
+class MOLNSConfig():
+    """ The datastore used by the molns commands, with the options that apply to all commands.
+    The Datastore API is forwarded to the datastore of the selected backend.
+    """
+    def __init__(self, config_dir=None, db_file=None, status_max_age=None, backend='sqlite', output_format='table', max_parallel=None):
+        self.backend = backend
+        self._datastore_args = {'config_dir':config_dir, 'db_file':db_file}
+        # Commands that only read the status of instances will trust the last known
+        # status in the datastore if it is at most this many seconds old.
+        self.status_max_age = status_max_age
+        # How tables are printed, one of OUTPUT_FORMATS.
+        self.output_format = output_format
+        # Hosts deployed to at the same time, or None for the default of the command.
+        self.max_parallel = max_parallel
+        # Seconds spent importing the backend and opening the datastore (None until it is opened).
+        self.datastore_import_time = None
+        self.datastore_open_time = None
+
+    def _open_datastore(self):
+        """ Import the backend and open the datastore, on first use. """
+        t0 = time.time()
+        datastore_class = get_datastore_backend(self.backend)
+        t1 = time.time()
+        self.datastore = datastore_class(**self._datastore_args)
+        self.datastore_import_time = t1 - t0
+        self.datastore_open_time = time.time() - t1
+        return self.datastore
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name == 'datastore':
+            return self._open_datastore()
+        return getattr(self.datastore, name)
+
+    def copy(self):
+        """ Return a MOLNSConfig with the same options, and its own handle on the datastore,
+        for commands run in another thread. """
+        config = MOLNSConfig(status_max_age=self.status_max_age, backend=self.backend, output_format=self.output_format, max_parallel=self.max_parallel)
+        config._datastore_args = self._datastore_args
+        config.datastore = self.datastore.copy()
+        return config
+
+    def get_config_dir(self):
+        """ Return the config dir, without opening the datastore if it was given. """
+        if self._datastore_args['config_dir'] is not None:
+            return self._datastore_args['config_dir']
+        return self.config_dir
+
+    def refresh(self):
+        """ Pick up changes made by other processes, if the datastore is open. """
+        if 'datastore' in self.__dict__:
+            self.datastore.refresh()
     
     def __str__(self):
         return "MOLNSConfig(config_dir={0})".format(self.config_dir)
@@ -45,26 +105,126 @@ class MOLNSbase():
                         myval = None
                 obj.config[key] = myval
             else:
+                check_config_choice(key, conf, config[key])
                 obj.config[key] = config[key]
 
     @classmethod
     def _get_workerobj(cls, args, config):
         # Name
-        worker_obj = None
         if len(args) > 0:
             worker_name = args[0]
-            # Get worker db object
-            try:
-                worker_obj = config.get_object(name=worker_name, kind='WorkerGroup')
-            except DatastoreException:
-                worker_obj = None
-            #logging.debug("controller_obj {0}".format(controller_obj))
-            if worker_obj is None:
-                print "worker group '{0}' is not initialized, use 'molns worker setup {0}' to initialize the controller.".format(worker_name)
         else:
-            print "No worker name specified, please specify a name"
+            raise MOLNSException("No worker name specified, please specify a name")
+        # Get worker db object
+        try:
+            worker_obj = config.get_object(name=worker_name, kind='WorkerGroup')
+        except DatastoreException:
+            worker_obj = None
+        if worker_obj is None:
+            raise MOLNSException("worker group '{0}' is not initialized, use 'molns worker setup {0}' to initialize the worker group.".format(worker_name))
         return worker_obj
 
+    # Number of targets of a multi-target command (e.g. 'molns stop a b c') handled at once.
+    MAX_PARALLEL_TARGETS = 8
+
+    @classmethod
+    def _target_names(cls, args, config, kind):
+        """ Return the names given to a command that accepts several targets, or all the
+        configured objects of kind with --all. """
+        if '--all' in args:
+            names = [p.name for p in config.list_objects(kind=kind)]
+            if len(names) == 0:
+                raise MOLNSException("No {0} configured".format(kind))
+            return names
+        return args
+
+    @classmethod
+    def _run_on_targets(cls, function, names, config, **kwargs):
+        """ Call function([name], config, **kwargs) for each of the names, MAX_PARALLEL_TARGETS
+        at a time.  Each call gets its own copy of config, so the datastore of a thread is
+        only used by that thread.
+
+        Returns:
+            A table with the outcome and the duration of each call.
+        """
+        def run(name, target_config):
+            t0 = time.time()
+            try:
+                with molns_trace.span(function.__name__, target=name):
+                    output = function([name], target_config, **kwargs)
+                # The functions raise MOLNSException (or return an 'error') when they fail.
+                if isinstance(output, dict) and output.get('error') is not None:
+                    return ("Error: {0}".format(output['error']), time.time() - t0)
+                return ('ok', time.time() - t0)
+            except Exception as e:
+                logging.exception(e)
+                return ("Error: {0}".format(e), time.time() - t0)
+        calls = [(run, (name, config.copy())) for name in names]
+        results = run_in_threads(calls, max_threads=cls.MAX_PARALLEL_TARGETS)
+        table_data = []
+        for (name, (result, error)) in zip(names, results):
+            (outcome, duration) = result
+            table_data.append([name, outcome, "{0:.1f}s".format(duration)])
+        output = {'type':'table', 'column_names':['name', 'result', 'time'], 'data':table_data}
+        failed = len([row for row in table_data if row[1] != 'ok'])
+        if failed > 0:
+            output['error'] = "{0} of {1} failed".format(failed, len(names))
+        return output
+
+    @classmethod
+    def _listing_name(cls, name, kind, obj_id):
+        """ Return an owner name from an InstanceListing, or an error string if the owner is not found. """
+        if name is None:
+            return 'ERROR: {0} {1} not found'.format(kind, obj_id)
+        return name
+
+    @classmethod
+    def _iter_instances_status(cls, config, owners_instances, max_age=None):
+        """ Get the status of instances that belong to different controllers and worker groups.
+
+        The instances of each provider are described with one get_instances_status() request,
+        and the providers are asked in parallel.  The new statuses are stored in the datastore.
+
+        Args:
+            owners_instances: a list of (owner, instance) pairs, where owner is the controller or
+                worker group object of the instance.
+            max_age: use the last known status of an instance if it is at most this many seconds old.
+        Returns:
+            A generator of (instance, status) pairs, in the order the statuses become known:
+            the last known statuses first, then the instances of each provider as it answers.
+        """
+        known = []
+        by_provider = OrderedDict()
+        for (owner, i) in owners_instances:
+            status = owner.get_last_known_status(i, max_age=max_age)
+            if status is not None:
+                known.append((i, status))
+                continue
+            if owner.provider_id not in by_provider:
+                # The provider is loaded here, as the datastore can only be used from this thread.
+                owner.provider
+                by_provider[owner.provider_id] = (owner, [])
+            by_provider[owner.provider_id][1].append(i)
+        requests = by_provider.values()
+        # The requests are started now, not when the caller starts iterating.
+        results = iter_in_threads([(owner.get_instances_status, (instances,)) for (owner, instances) in requests])
+        return cls._iter_statuses(config, known, requests, results)
+
+    @classmethod
+    def _iter_statuses(cls, config, known, requests, results):
+        for pair in known:
+            yield pair
+        new_statuses = []
+        for (n, result, error) in results:
+            if error is not None:
+                raise error
+            for i in requests[n][1]:
+                new_statuses.append((i, result[i.provider_instance_identifier]))
+                yield new_statuses[-1]
+        # Stored once all the providers have answered: the commit expires the instances,
+        # which the requests still running must not load from their threads.
+        config.set_instances_status(new_statuses)
+
     @classmethod
     def _get_controllerobj(cls, args, config):
         # Name
@@ -204,16 +364,14 @@ class MOLNSController(MOLNSbase):
         if len(args) > 0:
             controller_name = args[0]
         else:
-            print "Usage: molns.py controller setup NAME"
-            return
+            raise MOLNSException("Usage: molns.py controller setup NAME")
         try:
             controller_obj = config.get_object(args[0], kind='Controller')
         except DatastoreException as e:
             # provider
             providers = config.list_objects(kind='Provider')
             if len(providers)==0:
-                print "No providers configured, please configure one ('molns provider setup') before initializing controller."
-                return
+                raise MOLNSException("No providers configured, please configure one ('molns provider setup') before initializing controller.")
             print "Select a provider:"
             for n,p in enumerate(providers):
                 print "\t[{0}] {1}".format(n,p.name)
@@ -225,8 +383,7 @@ class MOLNSController(MOLNSbase):
             try:
                 controller_obj = config.create_object(ptype=provider_obj.type, name=controller_name, kind='Controller', provider_id=provider_id)
             except DatastoreException as e:
-                print e
-                return
+                raise MOLNSException(str(e))
         setup_object(controller_obj)
         config.save_object(controller_obj, kind='Controller')
 
@@ -274,14 +431,12 @@ class MOLNSController(MOLNSbase):
         # Check if they are running
         ip = None
         if len(instance_list) > 0:
-            for i in instance_list:
-                status = controller_obj.get_instance_status(i)
+            for (i, status) in zip(instance_list, controller_obj.get_cached_instances_status(instance_list, max_age=config.status_max_age)):
                 logging.debug("instance={0} has status={1}".format(i, status))
                 if status == controller_obj.STATUS_RUNNING:
                     ip = i.ip_address
         if ip is None:
-            print "No active instance for this controller"
-            return
+            raise MOLNSException("No active instance for this controller")
         #print " ".join(['/usr/bin/ssh','-oStrictHostKeyChecking=no','-oUserKnownHostsFile=/dev/null','-i',controller_obj.provider.sshkeyfilename(),'ubuntu@{0}'.format(ip)])
         #os.execl('/usr/bin/ssh','-oStrictHostKeyChecking=no','-oUserKnownHostsFile=/dev/null','-i',controller_obj.provider.sshkeyfilename(),'ubuntu@{0}'.format(ip))
         cmd = ['/usr/bin/ssh','-oStrictHostKeyChecking=no','-oUserKnownHostsFile=/dev/null','-i',controller_obj.provider.sshkeyfilename(),'ubuntu@{0}'.format(ip)]
@@ -301,14 +456,12 @@ class MOLNSController(MOLNSbase):
         # Check if they are running
         ip = None
         if len(instance_list) > 0:
-            for i in instance_list:
-                status = controller_obj.get_instance_status(i)
+            for (i, status) in zip(instance_list, controller_obj.get_cached_instances_status(instance_list, max_age=config.status_max_age)):
                 logging.debug("instance={0} has status={1}".format(i, status))
                 if status == controller_obj.STATUS_RUNNING:
                     ip = i.ip_address
         if ip is None:
-            print "No active instance for this controller"
-            return
+            raise MOLNSException("No active instance for this controller")
         #print " ".join(['/usr/bin/ssh','-oStrictHostKeyChecking=no','-oUserKnownHostsFile=/dev/null','-i',controller_obj.provider.sshkeyfilename(),'ubuntu@{0}'.format(ip)])
         #os.execl('/usr/bin/ssh','-oStrictHostKeyChecking=no','-oUserKnownHostsFile=/dev/null','-i',controller_obj.provider.sshkeyfilename(),'ubuntu@{0}'.format(ip))
         cmd = ['/usr/bin/scp','-r','-oStrictHostKeyChecking=no','-oUserKnownHostsFile=/dev/null','-i',controller_obj.provider.sshkeyfilename(), args[1], 'ubuntu@{0}:/home/ubuntu/'.format(ip)]
@@ -328,14 +481,12 @@ class MOLNSController(MOLNSbase):
         # Check if they are running
         ip = None
         if len(instance_list) > 0:
-            for i in instance_list:
-                status = controller_obj.get_instance_status(i)
+            for (i, status) in zip(instance_list, controller_obj.get_cached_instances_status(instance_list, max_age=config.status_max_age)):
                 logging.debug("instance={0} has status={1}".format(i, status))
                 if status == controller_obj.STATUS_RUNNING:
                     ip = i.ip_address
         if ip is None:
-            print "No active instance for this controller"
-            return
+            raise MOLNSException("No active instance for this controller")
         #print " ".join(['/usr/bin/ssh','-oStrictHostKeyChecking=no','-oUserKnownHostsFile=/dev/null','-i',controller_obj.provider.sshkeyfilename(),'ubuntu@{0}'.format(ip)])
         #os.execl('/usr/bin/ssh','-oStrictHostKeyChecking=no','-oUserKnownHostsFile=/dev/null','-i',controller_obj.provider.sshkeyfilename(),'ubuntu@{0}'.format(ip))
         cmd = ['/usr/bin/scp','-oStrictHostKeyChecking=no','-oUserKnownHostsFile=/dev/null','-i',controller_obj.provider.sshkeyfilename(), args[1], 'ubuntu@{0}:/home/ubuntu/shared'.format(ip)]
@@ -351,51 +502,47 @@ class MOLNSController(MOLNSbase):
         if len(args) > 0:
             controller_obj = cls._get_controllerobj(args, config)
             if controller_obj is None: return
-            # Check if any instances are assigned to this controller
-            instance_list = config.get_controller_instances(controller_id=controller_obj.id)
-            table_data = []
-            if len(instance_list) > 0:
-                for i in instance_list:
-                    #provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
-                    try:
-                        p = config.get_object_by_id(i.provider_id, 'Provider')
-                        provider_name = p.name
-                    except DatastoreException as e:
-                        provider_name = 'ERROR: {0}'.format(e)
-                    controller_name = config.get_object_by_id(i.controller_id, 'Controller').name
-                    status = controller_obj.get_instance_status(i)
-                    table_data.append([controller_name, status, 'controller', provider_name, i.provider_instance_identifier, i.ip_address])
-
-            else:
+            # Get all instances of this controller, and their owner names, in one query
+            listing = config.get_instance_listing(controller_id=controller_obj.id)
+            controller_listing = [l for l in listing if l.instance.worker_group_id is None]
+            worker_listing = [l for l in listing if l.instance.worker_group_id is not None]
+            if len(controller_listing) == 0:
                 return {'msg': "No instance running for this controller"}
+            owners_instances = [(controller_obj, l.instance) for l in controller_listing]
             # Check if any worker instances are assigned to this controller
-            instance_list = config.get_worker_instances(controller_id=controller_obj.id)
-            if len(instance_list) > 0:
-                for i in instance_list:
-                    worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
-                    worker_obj = cls._get_workerobj([worker_name], config)
-                    #provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
-                    try:
-                        p = config.get_object_by_id(i.provider_id, 'Provider')
-                        provider_name = p.name
-                    except DatastoreException as e:
-                        provider_name = 'ERROR: {0}'.format(e)
-                    status = worker_obj.get_instance_status(i)
-                    table_data.append([worker_name, status, 'worker', provider_name, i.provider_instance_identifier, i.ip_address])
+            worker_objs = {}
+            for l in worker_listing:
+                i = l.instance
+                if i.worker_group_id not in worker_objs:
+                    worker_objs[i.worker_group_id] = cls._get_workerobj([l.worker_group_name], config)
+                owners_instances.append((worker_objs[i.worker_group_id], i))
+            statuses = cls._iter_instances_status(config, owners_instances, max_age=config.status_max_age)
+            listing_by_id = dict((l.instance.id, l) for l in listing)
+            def table_data():
+                # A row is produced as soon as the status of its instance is known.
+                for (i, status) in statuses:
+                    l = listing_by_id[i.id]
+                    provider_name = cls._listing_name(l.provider_name, 'Provider', i.provider_id)
+                    if i.worker_group_id is None:
+                        controller_name = cls._listing_name(l.controller_name, 'Controller', i.controller_id)
+                        yield [controller_name, status, 'controller', provider_name, i.provider_instance_identifier, i.ip_address]
+                    else:
+                        yield [l.worker_group_name, status, 'worker', provider_name, i.provider_instance_identifier, i.ip_address]
             #table_print(['name','status','type','provider','instance id', 'IP address'],table_data)
-            r = {'type':'table', 'column_names':['name','status','type','provider','instance id', 'IP address'], 'data':table_data}
+            r = {'type':'table', 'column_names':['name','status','type','provider','instance id', 'IP address'], 'data':table_data()}
             return r
         else:
-            instance_list = config.get_all_instances()
-            if len(instance_list) > 0:
+            listing = config.get_instance_listing()
+            if len(listing) > 0:
                 table_data = []
-                for i in instance_list:
-                    provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
-                    controller_name = config.get_object_by_id(i.controller_id, 'Controller').name
+                for l in listing:
+                    i = l.instance
+                    provider_name = cls._listing_name(l.provider_name, 'Provider', i.provider_id)
                     if i.worker_group_id is not None:
-                        worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
+                        worker_name = cls._listing_name(l.worker_group_name, 'WorkerGroup', i.worker_group_id)
                         table_data.append([worker_name, 'worker', provider_name, i.provider_instance_identifier])
                     else:
+                        controller_name = cls._listing_name(l.controller_name, 'Controller', i.controller_id)
                         table_data.append([controller_name, 'controller', provider_name, i.provider_instance_identifier])
 
                 r = {'type':'table', 'column_names':['name','type','provider','instance id'], 'data':table_data}
@@ -404,6 +551,60 @@ class MOLNSController(MOLNSbase):
             else:
                 return {'msg': "No instance found"}
 
+    @classmethod
+    def watch_controller(cls, args, config):
+        """ Show the status and phase of the instances of a controller (or of all instances),
+        updated until interrupted. """
+        logging.debug("MOLNSController.watch_controller(args={0})".format(args))
+        from MolnsLib import molns_watch
+        controller_obj = None
+        if len(args) > 0:
+            controller_obj = cls._get_controllerobj(args, config)
+        probe = molns_watch.InstanceProbe()
+        display = molns_watch.WatchDisplay(['name', 'type', 'provider', 'instance id', 'IP address', 'status', 'phase'])
+        interval = molns_watch.MIN_POLL_INTERVAL
+        try:
+            while True:
+                # Show the instances started or terminated by other molns commands.
+                config.refresh()
+                if controller_obj is not None:
+                    listing = config.get_instance_listing(controller_id=controller_obj.id)
+                else:
+                    listing = config.get_instance_listing()
+                owners = {}
+                owners_instances = []
+                for l in listing:
+                    i = l.instance
+                    if i.worker_group_id is not None:
+                        key = ('WorkerGroup', i.worker_group_id)
+                    else:
+                        key = ('Controller', i.controller_id)
+                    if key not in owners:
+                        try:
+                            owners[key] = config.get_object_by_id(key[1], kind=key[0])
+                        except DatastoreException:
+                            owners[key] = None
+                    if owners[key] is not None:
+                        owners_instances.append((owners[key], i))
+                statuses = dict((i.id, status) for (i, status) in cls._iter_instances_status(config, owners_instances))
+                targets = []
+                for (owner, i) in owners_instances:
+                    if statuses[i.id] == owner.STATUS_RUNNING and i.ip_address is not None:
+                        role = 'worker' if i.worker_group_id is not None else 'controller'
+                        targets.append((i.id, i.ip_address, role, owner.provider['login_username'], owner.provider.sshkeyfilename()))
+                phases = probe.probe(targets)
+                rows = []
+                for (owner, i) in owners_instances:
+                    role = 'worker' if i.worker_group_id is not None else 'controller'
+                    rows.append([owner.name, role, owner.provider.name, i.provider_instance_identifier, i.ip_address, statuses[i.id], phases.get(i.id, '')])
+                changed = display.update(rows, "{0} instances, updated at {1} (Ctrl-C to stop)".format(len(rows), time.strftime('%H:%M:%S')))
+                interval = molns_watch.next_poll_interval(interval, changed)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print ""
+        finally:
+            probe.close()
+
 
     @classmethod
     def start_controller(cls, args, config, password=None):
@@ -416,14 +617,14 @@ class MOLNSController(MOLNSbase):
         # Check if they are running or stopped (if so, resume them)
         inst = None
         if len(instance_list) > 0:
-            for i in instance_list:
-                status = controller_obj.get_instance_status(i)
+            for (i, status) in zip(instance_list, controller_obj.get_cached_instances_status(instance_list)):
                 if status == controller_obj.STATUS_RUNNING:
                     print "controller already running at {0}".format(i.ip_address)
                     return
                 elif status == controller_obj.STATUS_STOPPED:
                     print "Resuming instance at {0}".format(i.ip_address)
                     controller_obj.resume_instance(i)
+                    config.set_instance_status(i, controller_obj.STATUS_RUNNING)
                     inst = i
                     break
         if inst is None:
@@ -431,10 +632,41 @@ class MOLNSController(MOLNSbase):
             print "Starting new controller"
             inst = controller_obj.start_instance()
         # deploying
+        from MolnsLib.ssh_deploy import SSHDeploy
+        from MolnsLib.molns_tls import TLSMaterial
+        # The key and certificate of the notebook, made once and kept in the config dir.
+        tls = TLSMaterial.for_controller(controller_obj, config.config_dir)
         sshdeploy = SSHDeploy(config=controller_obj.provider, config_dir=config.config_dir)
-        sshdeploy.deploy_ipython_controller(inst.ip_address, notebook_password=password)
+        sshdeploy.deploy_ipython_controller(inst.ip_address, notebook_password=password, tls=tls)
         sshdeploy.deploy_molns_webserver(inst.ip_address)
-        #sshdeploy.deploy_stochss(inst.ip_address, port=443)
+        #sshdeploy.deploy_stochss(inst.ip_address, port=443, tls=tls)
+
+    @classmethod
+    def start_controllers(cls, args, config):
+        """ Start the head nodes of MOLNs controllers (several names, or --all). """
+        names = cls._target_names(args, config, 'Controller')
+        if len(names) <= 1:
+            return cls.start_controller(names, config)
+        from MolnsLib.ssh_deploy import SSHDeploy
+        # Asked once for all the controllers, before the output of the threads mixes.
+        password = SSHDeploy.prompt_for_password()
+        return cls._run_on_targets(cls.start_controller, names, config, password=password)
+
+    @classmethod
+    def stop_controllers(cls, args, config):
+        """ Stop the head nodes of MOLNs controllers (several names, or --all). """
+        names = cls._target_names(args, config, 'Controller')
+        if len(names) <= 1:
+            return cls.stop_controller(names, config)
+        return cls._run_on_targets(cls.stop_controller, names, config)
+
+    @classmethod
+    def terminate_controllers(cls, args, config):
+        """ Terminate the head nodes of MOLNs controllers (several names, or --all). """
+        names = cls._target_names(args, config, 'Controller')
+        if len(names) <= 1:
+            return cls.terminate_controller(names, config)
+        return cls._run_on_targets(cls.terminate_controller, names, config)
 
     @classmethod
     def stop_controller(cls, args, config):
@@ -446,19 +678,13 @@ class MOLNSController(MOLNSbase):
         instance_list = config.get_all_instances(controller_id=controller_obj.id)
         # Check if they are running
         if len(instance_list) > 0:
-            for i in instance_list:
-                if i.worker_group_id is None:
-                    status = controller_obj.get_instance_status(i)
-                    if status == controller_obj.STATUS_RUNNING:
-                        print "Stopping controller running at {0}".format(i.ip_address)
-                        controller_obj.stop_instance(i)
-                else:
-                    worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
-                    worker_obj = cls._get_workerobj([worker_name], config)
-                    status = worker_obj.get_instance_status(i)
-                    if status == worker_obj.STATUS_RUNNING or status == worker_obj.STATUS_STOPPED:
-                        print "Terminating worker '{1}' running at {0}".format(i.ip_address, worker_name)
-                        worker_obj.terminate_instance(i)
+            controller_instances = [i for i in instance_list if i.worker_group_id is None]
+            for (i, status) in zip(controller_instances, controller_obj.get_cached_instances_status(controller_instances)):
+                if status == controller_obj.STATUS_RUNNING:
+                    print "Stopping controller running at {0}".format(i.ip_address)
+                    controller_obj.stop_instance(i)
+                    config.set_instance_status(i, controller_obj.STATUS_STOPPED)
+            cls._terminate_workers(cls._workers_to_terminate([i for i in instance_list if i.worker_group_id is not None], config))
     
         else:
             print "No instance running for this controller"
@@ -474,31 +700,48 @@ class MOLNSController(MOLNSbase):
         logging.debug("\tinstance_list={0}".format([str(i) for i in instance_list]))
         # Check if they are running or stopped 
         if len(instance_list) > 0:
-            for i in instance_list:
-                if i.worker_group_id is None:
-                    status = controller_obj.get_instance_status(i)
-                    if status == controller_obj.STATUS_RUNNING or status == controller_obj.STATUS_STOPPED:
-                        print "Terminating controller running at {0}".format(i.ip_address)
-                        controller_obj.terminate_instance(i)
-                else:
-                    worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
-                    worker_obj = cls._get_workerobj([worker_name], config)
-                    status = worker_obj.get_instance_status(i)
-                    if status == worker_obj.STATUS_RUNNING or status == worker_obj.STATUS_STOPPED:
-                        print "Terminating worker '{1}' running at {0}".format(i.ip_address, worker_name)
-                        worker_obj.terminate_instance(i)
-
+            controller_instances = [i for i in instance_list if i.worker_group_id is None]
+            for (i, status) in zip(controller_instances, controller_obj.get_cached_instances_status(controller_instances)):
+                if status == controller_obj.STATUS_RUNNING or status == controller_obj.STATUS_STOPPED:
+                    print "Terminating controller running at {0}".format(i.ip_address)
+                    controller_obj.terminate_instance(i)
+            cls._terminate_workers(cls._workers_to_terminate([i for i in instance_list if i.worker_group_id is not None], config))
 
         else:
             print "No instance running for this controller"
 
+    @classmethod
+    def _workers_to_terminate(cls, worker_instances, config):
+        """ Return a dict of worker group id -> (worker_obj, instances) of the worker instances that are running or stopped.
+        The status of the instances of each worker group is asked with one request. """
+        by_group = OrderedDict()
+        for i in worker_instances:
+            by_group.setdefault(i.worker_group_id, []).append(i)
+        workers_to_terminate = OrderedDict()
+        for (worker_group_id, group_instances) in by_group.items():
+            worker_name = config.get_object_by_id(worker_group_id, 'WorkerGroup').name
+            worker_obj = cls._get_workerobj([worker_name], config)
+            instances = []
+            for (i, status) in zip(group_instances, worker_obj.get_cached_instances_status(group_instances)):
+                if status == worker_obj.STATUS_RUNNING or status == worker_obj.STATUS_STOPPED:
+                    print "Terminating worker '{1}' running at {0}".format(i.ip_address, worker_obj.name)
+                    instances.append(i)
+            workers_to_terminate[worker_group_id] = (worker_obj, instances)
+        return workers_to_terminate
+
+    @classmethod
+    def _terminate_workers(cls, workers_to_terminate):
+        """ Terminate the instances of each worker group with one call (and one datastore transaction). """
+        for (worker_obj, instances) in workers_to_terminate.values():
+            if len(instances) > 0:
+                worker_obj.terminate_instance(instances)
+
     @classmethod
     def connect_controller_to_local(cls, args, config):
         """ Connect a local iPython installation to the controller. """
         logging.debug("MOLNSController.connect_controller_to_local(args={0})".format(args))
         if len(args) != 2:
-            print "USAGE: molns local-connect controller_name profile_name"
-            return
+            raise MOLNSException("USAGE: molns local-connect controller_name profile_name")
         controller_name = args[1]
         profile_name = args[1]
         logging.debug("connecting controller {0} to local ipython profile {1}".format(controller_name, profile_name))
@@ -509,16 +752,15 @@ class MOLNSController(MOLNSbase):
         # Check if they are running
         inst = None
         if len(instance_list) > 0:
-            for i in instance_list:
-                status = controller_obj.get_instance_status(i)
+            for (i, status) in zip(instance_list, controller_obj.get_cached_instances_status(instance_list, max_age=config.status_max_age)):
                 if status == controller_obj.STATUS_RUNNING:
                     print "Connecting to controller at {0}".format(i.ip_address)
                     inst = i
                     break
         if inst is None:
-            print "No instance running for this controller"
-            return
+            raise MOLNSException("No instance running for this controller")
         # deploying
+        from MolnsLib.ssh_deploy import SSHDeploy
         sshdeploy = SSHDeploy(config=controller_obj.provider, config_dir=config.config_dir)
         client_file_data = sshdeploy.get_ipython_client_file(inst.ip_address)
         home_dir = os.environ.get('HOME')
@@ -656,8 +898,7 @@ class MOLNSWorkerGroup(MOLNSbase):
         logging.debug("MOLNSWorkerGroup.setup_worker_groups(config={0})".format(config))
         # name
         if len(args) == 0:
-            print "USAGE: molns worker setup name"
-            return
+            raise MOLNSException("USAGE: molns worker setup name")
         group_name = args[0]
         try:
             worker_obj = config.get_object(args[0], kind='WorkerGroup')
@@ -665,8 +906,7 @@ class MOLNSWorkerGroup(MOLNSbase):
             # provider
             providers = config.list_objects(kind='Provider')
             if len(providers)==0:
-                print "No providers configured, please configure one ('molns provider setup') before initializing worker group."
-                return
+                raise MOLNSException("No providers configured, please configure one ('molns provider setup') before initializing worker group.")
             print "Select a provider:"
             for n,p in enumerate(providers):
                 print "\t[{0}] {1}".format(n,p.name)
@@ -677,8 +917,7 @@ class MOLNSWorkerGroup(MOLNSbase):
             # controller
             controllers = config.list_objects(kind='Controller')
             if len(controllers)==0:
-                print "No controllers configured, please configure one ('molns controller setup') before initializing worker group."
-                return
+                raise MOLNSException("No controllers configured, please configure one ('molns controller setup') before initializing worker group.")
             print "Select a controller:"
             for n,p in enumerate(controllers):
                 print "\t[{0}] {1}".format(n,p.name)
@@ -690,8 +929,7 @@ class MOLNSWorkerGroup(MOLNSbase):
             try:
                 worker_obj = config.create_object(ptype=provider_obj.type, name=group_name, kind='WorkerGroup', provider_id=provider_id, controller_id=controller_obj.id)
             except DatastoreException as e:
-                print e
-                return
+                raise MOLNSException(str(e))
         setup_object(worker_obj)
         config.save_object(worker_obj, kind='WorkerGroup')
 
@@ -740,42 +978,56 @@ class MOLNSWorkerGroup(MOLNSbase):
         logging.debug("MOLNSWorkerGroup.status_worker_groups(args={0})".format(args))
         if len(args) > 0:
             worker_obj = cls._get_workerobj(args, config)
-            if worker_obj is None: return
             # Check if any instances are assigned to this worker
-            instance_list = config.get_all_instances(worker_group_id=worker_obj.id)
+            listing = config.get_instance_listing(worker_group_id=worker_obj.id)
             # Check if they are running or stopped 
-            if len(instance_list) > 0:
-                table_data = []
-                for i in instance_list:
-                    status = worker_obj.get_instance_status(i)
-                    #print "{0} type={3} ip={1} id={2}".format(status, i.ip_address, i.provider_instance_identifier, worker_obj.PROVIDER_TYPE)
-                    worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
-                    provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
-                    status = worker_obj.get_instance_status(i)
-                    table_data.append([worker_name, status, 'worker', provider_name, i.provider_instance_identifier, i.ip_address])
-                return {'type':'table','column_names':['name','status','type','provider','instance id', 'IP address'],'data':table_data}
+            if len(listing) > 0:
+                statuses = cls._iter_instances_status(config, [(worker_obj, l.instance) for l in listing], max_age=config.status_max_age)
+                listing_by_id = dict((l.instance.id, l) for l in listing)
+                def table_data():
+                    # A row is produced as soon as the status of its instance is known.
+                    for (i, status) in statuses:
+                        l = listing_by_id[i.id]
+                        #print "{0} type={3} ip={1} id={2}".format(status, i.ip_address, i.provider_instance_identifier, worker_obj.PROVIDER_TYPE)
+                        provider_name = cls._listing_name(l.provider_name, 'Provider', i.provider_id)
+                        yield [l.worker_group_name, status, 'worker', provider_name, i.provider_instance_identifier, i.ip_address]
+                return {'type':'table','column_names':['name','status','type','provider','instance id', 'IP address'],'data':table_data()}
             else:
                 return {'msg': "No worker instances running for this cluster"}
         else:
             raise MOLNSException("USAGE: molns worker status NAME")
 
+    @classmethod
+    def start_worker_groups_all(cls, args, config):
+        """ Start the workers of MOLNs clusters (several names, or --all). """
+        names = cls._target_names(args, config, 'WorkerGroup')
+        if len(names) <= 1:
+            return cls.start_worker_groups(names, config)
+        return cls._run_on_targets(cls.start_worker_groups, names, config)
+
+    @classmethod
+    def terminate_worker_groups_all(cls, args, config):
+        """ Terminate the workers of MOLNs clusters (several names, or --all). """
+        names = cls._target_names(args, config, 'WorkerGroup')
+        if len(names) <= 1:
+            return cls.terminate_worker_groups(names, config)
+        return cls._run_on_targets(cls.terminate_worker_groups, names, config)
+
     @classmethod
     def start_worker_groups(cls, args, config):
         """ Start workers of a MOLNs cluster. """
         logging.debug("MOLNSWorkerGroup.start_worker_groups(args={0})".format(args))
         worker_obj = cls._get_workerobj(args, config)
-        if worker_obj is None: return
         num_vms = worker_obj['num_vms']
         num_vms_to_start = int(num_vms)
         controller_ip = cls.__launch_workers__get_controller(worker_obj, config)
-        if controller_ip is None: return
         #logging.debug("\tcontroller_ip={0}".format(controller_ip))
         try:
             inst_to_deploy = cls.__launch_worker__start_or_resume_vms(worker_obj, config, num_vms_to_start)
             #logging.debug("\tinst_to_deploy={0}".format(inst_to_deploy))
-            cls.__launch_worker__deploy_engines(worker_obj, controller_ip, inst_to_deploy, config)
+            return cls.__launch_worker__deploy_engines(worker_obj, controller_ip, inst_to_deploy, config)
         except ProviderException as e:
-            print "Could not start workers: {0}".format(e)
+            raise MOLNSException("Could not start workers: {0}".format(e))
 
     
     @classmethod
@@ -783,22 +1035,20 @@ class MOLNSWorkerGroup(MOLNSbase):
         """ Add workers of a MOLNs cluster. """
         logging.debug("MOLNSWorkerGroup.add_worker_groups(args={0})".format(args))
         if len(args) < 2:
-            print "Usage: molns worker add GROUP num"
-            return
+            raise MOLNSException("Usage: molns worker add GROUP num")
         try:
             num_vms_to_start = int(args[1])
         except ValueError:
-            print "'{0}' in not a valid number of engines.".format(args[1])
-            return
+            num_vms_to_start = 0
+        if num_vms_to_start < 1:
+            raise MOLNSException("'{0}' is not a valid number of engines.".format(args[1]))
         worker_obj = cls._get_workerobj(args, config)
-        if worker_obj is None: return
         controller_ip = cls.__launch_workers__get_controller(worker_obj, config)
-        if controller_ip is None: return
         try:
             inst_to_deploy = cls.__launch_worker__start_vms(worker_obj, num_vms_to_start)
-            cls.__launch_worker__deploy_engines(worker_obj, controller_ip, inst_to_deploy, config)
+            return cls.__launch_worker__deploy_engines(worker_obj, controller_ip, inst_to_deploy, config)
         except ProviderException as e:
-            print "Could not start workers: {0}".format(e)
+            raise MOLNSException("Could not start workers: {0}".format(e))
 
     @classmethod
     def __launch_workers__get_controller(cls, worker_obj, config):
@@ -808,16 +1058,14 @@ class MOLNSWorkerGroup(MOLNSbase):
         provider_obj = worker_obj.controller
         # Check if they are running or stopped (if so, resume them)
         if len(instance_list) > 0:
-            for i in instance_list:
-                status = provider_obj.get_instance_status(i)
+            for (i, status) in zip(instance_list, provider_obj.get_cached_instances_status(instance_list)):
                 logging.debug("instance {0} has status {1}".format(i.id, status))
                 if status == provider_obj.STATUS_RUNNING or status == provider_obj.STATUS_STOPPED:
                     controller_ip = i.ip_address
                     print "Controller running at {0}".format(controller_ip)
                     break
         if controller_ip is None:
-            print "No controller running for this worker group."
-            return
+            raise MOLNSException("No controller running for worker group '{0}'.".format(worker_obj.name))
         return controller_ip
         
 
@@ -829,8 +1077,7 @@ class MOLNSWorkerGroup(MOLNSbase):
         inst_to_resume = []
         inst_to_deploy = []
         if len(instance_list) > 0:
-            for i in instance_list:
-                status = worker_obj.get_instance_status(i)
+            for (i, status) in zip(instance_list, worker_obj.get_cached_instances_status(instance_list)):
                 if status == worker_obj.STATUS_RUNNING:
                     print "Worker running at {0}".format(i.ip_address)
                     num_vms_to_start -= 1
@@ -841,6 +1088,8 @@ class MOLNSWorkerGroup(MOLNSbase):
         #logging.debug("inst_to_resume={0}".format(inst_to_resume))
         if len(inst_to_resume) > 0:
             worker_obj.resume_instance(inst_to_resume)
+            for i in inst_to_resume:
+                config.set_instance_status(i, worker_obj.STATUS_RUNNING)
             inst_to_deploy.extend(inst_to_resume)
         inst_to_deploy.extend(cls.__launch_worker__start_vms(worker_obj, num_vms_to_start))
         #logging.debug("inst_to_deploy={0}".format(inst_to_deploy))
@@ -859,53 +1108,81 @@ class MOLNSWorkerGroup(MOLNSbase):
         return inst_to_deploy
 
 
+    # Number of engine hosts deployed to at the same time, unless --parallel=N is given.
+    DEFAULT_PARALLEL_DEPLOYS = 16
+    # Attempts to deploy to a host that failed before anything was changed on it.
+    DEPLOY_ATTEMPTS = 3
+    DEPLOY_RETRY_WAITTIME = 5
+
     @classmethod
     def __launch_worker__deploy_engines(cls, worker_obj, controller_ip, inst_to_deploy, config):
+        """ Deploy the engines on the instances, config.max_parallel (or DEFAULT_PARALLEL_DEPLOYS)
+        at a time, in threads.
+
+        Returns:
+            A table with the result of each host, with an error if any of them failed.
+        """
         print "Deploying on {0} workers".format(len(inst_to_deploy))
-        if len(inst_to_deploy) > 0:
-            # deploying
-            controller_ssh = SSHDeploy(config=worker_obj.controller.provider, config_dir=config.config_dir)
-            engine_ssh = SSHDeploy(config=worker_obj.provider, config_dir=config.config_dir)
-            engine_file = controller_ssh.get_ipython_engine_file(controller_ip)
-            controller_ssh_keyfile = worker_obj.controller.provider.sshkeyfilename()
-            if len(inst_to_deploy) > 1:
-                logging.debug("__launch_worker__deploy_engines() workpool(size={0})".format(len(inst_to_deploy)))
-                jobs = []
-                for i in inst_to_deploy:
-                    logging.debug("multiprocessing.Process(target=engine_ssh.deploy_ipython_engine({0}, engine_file)".format(i.ip_address))
-                    p = multiprocessing.Process(target=engine_ssh.deploy_ipython_engine, args=(i.ip_address, controller_ip, engine_file, controller_ssh_keyfile,))
-                    jobs.append(p)
-                    p.start()
-                    logging.debug("__launch_worker__deploy_engines() joining processes.")
-                for p in jobs:
-                    p.join()
-                logging.debug("__launch_worker__deploy_engines() joined processes.")
-            else:
-                for i in inst_to_deploy:
-                    logging.debug("starting engine on {0}".format(i.ip_address))
-                    engine_ssh.deploy_ipython_engine(i.ip_address, controller_ip, engine_file, controller_ssh_keyfile)
-        else:
+        if len(inst_to_deploy) == 0:
             return
-        print "Success"
+        # deploying
+        from MolnsLib.ssh_deploy import SSHDeploy, SSHDeployRetryableException
+        # Read in this thread: the threads do not use the datastore.
+        config_dir = config.config_dir
+        engine_provider = worker_obj.provider
+        controller_ssh = SSHDeploy(config=worker_obj.controller.provider, config_dir=config_dir)
+        engine_file = controller_ssh.get_ipython_engine_file(controller_ip)
+        controller_ssh_keyfile = worker_obj.controller.provider.sshkeyfilename()
+
+        def deploy(inst):
+            t0 = time.time()
+            for attempt in range(1, cls.DEPLOY_ATTEMPTS + 1):
+                # An SSHDeploy holds the connection to its host, so each host has its own.
+                engine_ssh = SSHDeploy(config=engine_provider, config_dir=config_dir)
+                try:
+                    logging.debug("starting engine on {0}".format(inst.ip_address))
+                    engine_ssh.deploy_ipython_engine(inst.ip_address, controller_ip, engine_file, controller_ssh_keyfile)
+                    return ('ok', attempt, time.time() - t0)
+                except SSHDeployRetryableException as e:
+                    if attempt == cls.DEPLOY_ATTEMPTS:
+                        return ("Error: {0}".format(e), attempt, time.time() - t0)
+                    print "{0}: {1}, trying again in {2} seconds".format(inst.ip_address, e, cls.DEPLOY_RETRY_WAITTIME)
+                    time.sleep(cls.DEPLOY_RETRY_WAITTIME)
+                except Exception as e:
+                    logging.exception(e)
+                    return ("Error: {0}".format(e), attempt, time.time() - t0)
+
+        max_threads = config.max_parallel if config.max_parallel is not None else cls.DEFAULT_PARALLEL_DEPLOYS
+        logging.debug("__launch_worker__deploy_engines() {0} hosts, {1} at a time".format(len(inst_to_deploy), max_threads))
+        results = run_in_threads([(deploy, (i,)) for i in inst_to_deploy], max_threads=max_threads)
+        table_data = []
+        for (i, (result, error)) in zip(inst_to_deploy, results):
+            (outcome, attempts, duration) = result if error is None else ("Error: {0}".format(error), 1, 0)
+            table_data.append([i.ip_address, i.provider_instance_identifier, outcome, attempts, "{0:.1f}s".format(duration)])
+        output = {'type':'table', 'column_names':['IP address', 'instance id', 'result', 'attempts', 'time'], 'data':table_data}
+        failed = len([row for row in table_data if row[2] != 'ok'])
+        if failed > 0:
+            output['error'] = "the engines of {0} of {1} hosts could not be deployed".format(failed, len(inst_to_deploy))
+        return output
 
     @classmethod
     def stop_worker_groups(cls, args, config):
         """ Stop workers of a MOLNs cluster. """
         logging.debug("MOLNSWorkerGroup.stop_worker_groups(args={0})".format(args))
         worker_obj = cls._get_workerobj(args, config)
-        if worker_obj is None: return
         # Check for any instances are assigned to this worker group
         instance_list = config.get_all_instances(worker_group_id=worker_obj.id)
         # Check if they are running or stopped (if so, resume them)
         inst_to_stop = []
         if len(instance_list) > 0:
-            for i in instance_list:
-                status = worker_obj.get_instance_status(i)
+            for (i, status) in zip(instance_list, worker_obj.get_cached_instances_status(instance_list)):
                 if status == worker_obj.STATUS_RUNNING:
                     print "Stopping worker at {0}".format(i.ip_address)
                     inst_to_stop.append(i)
         if len(inst_to_stop) > 0:
             worker_obj.stop_instance(inst_to_stop)
+            for i in inst_to_stop:
+                config.set_instance_status(i, worker_obj.STATUS_STOPPED)
         else:
             print "No workers running in the worker group"
 
@@ -914,14 +1191,12 @@ class MOLNSWorkerGroup(MOLNSbase):
         """ Terminate workers of a MOLNs cluster. """
         logging.debug("MOLNSWorkerGroup.terminate_worker_groups(args={0})".format(args))
         worker_obj = cls._get_workerobj(args, config)
-        if worker_obj is None: return
         # Check for any instances are assigned to this worker group
         instance_list = config.get_all_instances(worker_group_id=worker_obj.id)
         # Check if they are running or stopped (if so, resume them)
         inst_to_stop = []
         if len(instance_list) > 0:
-            for i in instance_list:
-                status = worker_obj.get_instance_status(i)
+            for (i, status) in zip(instance_list, worker_obj.get_cached_instances_status(instance_list)):
                 if status == worker_obj.STATUS_RUNNING or status == worker_obj.STATUS_STOPPED:
                     print "Terminating worker at {0}".format(i.ip_address)
                     inst_to_stop.append(i)
@@ -1048,9 +1323,7 @@ class MOLNSProvider(MOLNSbase):
         """ Setup a new provider. Create the MOLNS image and SSH key if necessary."""
         #print "MOLNSProvider.provider_setup(args={0})".format(args)
         if len(args) < 1:
-            print "USAGE: molns provider setup name"
-            print "\tCreates a new provider with the given name."
-            return
+            raise MOLNSException("USAGE: molns provider setup name\n\tCreates a new provider with the given name.")
         # find the \n\tWhere PROVIDER_TYPE is one of: {0}".format(VALID_PROVIDER_TYPES)
         # provider name
         provider_name = args[0]
@@ -1075,8 +1348,7 @@ class MOLNSProvider(MOLNSbase):
                 provider_obj = config.create_object(name=args[0], ptype=provider_type, kind='Provider')
             except DatastoreException as e:
                 logging.exception(e)
-                print e
-                return
+                raise MOLNSException(str(e))
         print "Enter configuration for provider {0}:".format(args[0])
         setup_object(provider_obj)
         config.save_object(provider_obj, kind='Provider')
@@ -1095,8 +1367,7 @@ class MOLNSProvider(MOLNSbase):
         print "Checking all config artifacts."
         # check for ssh key
         if provider_obj['key_name'] is None or provider_obj['key_name'] == '':
-            print "Error: no key_name specified."
-            return
+            raise MOLNSException("no key_name specified.")
         elif not provider_obj.check_ssh_key():
             print "Creating key '{0}'".format(provider_obj['key_name'])
             provider_obj.create_ssh_key()
@@ -1105,8 +1376,7 @@ class MOLNSProvider(MOLNSbase):
 
         # check for security group
         if provider_obj['group_name'] is None or provider_obj['group_name'] == '':
-            print "Error: no security group specified."
-            return
+            raise MOLNSException("no security group specified.")
         elif not provider_obj.check_security_group():
             print "Creating security group '{0}'".format(provider_obj['group_name'])
             provider_obj.create_seurity_group()
@@ -1116,13 +1386,12 @@ class MOLNSProvider(MOLNSbase):
         # check for MOLNS image
         if provider_obj['molns_image_name'] is None or provider_obj['molns_image_name'] == '':
             if provider_obj['ubuntu_image_name'] is None or provider_obj['ubuntu_image_name'] == '':
-                print "Error: no ubuntu_image_name given, can not create molns image."
+                raise MOLNSException("no ubuntu_image_name given, can not create molns image.")
             else:
                 print "Creating new image, this process can take a long time (10-30 minutes)."
                 provider_obj['molns_image_name'] = provider_obj.create_molns_image()
         elif not provider_obj.check_molns_image():
-            print "Error: an molns image was provided, but it is not available in cloud."
-            return
+            raise MOLNSException("an molns image was provided, but it is not available in cloud.")
 
         print "Success."
         config.save_object(provider_obj, kind='Provider')
@@ -1132,22 +1401,20 @@ class MOLNSProvider(MOLNSbase):
     def provider_rebuild(cls, args, config):
         """ Rebuild the MOLNS image."""
         if len(args) < 1:
-            print "USAGE: molns provider rebuild name"
-            print "\tCreates a new provider with the given name."
-            return
+            raise MOLNSException("USAGE: molns provider rebuild name\n\tCreates a new provider with the given name.")
         # provider name
         provider_name = args[0]
         # check if provider exists
         try:
             provider_obj = config.get_object(args[0], kind='Provider')
             if provider_obj['ubuntu_image_name'] is None or provider_obj['ubuntu_image_name'] == '':
-                print "Error: no ubuntu_image_name given, can not create molns image."
+                raise MOLNSException("no ubuntu_image_name given, can not create molns image.")
             else:
                 provider_obj['molns_image_name'] = provider_obj.create_molns_image()
                 print "Success. new image = {0}".format(provider_obj['molns_image_name'])
                 config.save_object(provider_obj, kind='Provider')
         except DatastoreException as e:
-            print "provider not found"
+            raise MOLNSException("provider '{0}' not found".format(provider_name))
 
     @classmethod
     def provider_list(cls, args, config):
@@ -1169,8 +1436,7 @@ class MOLNSProvider(MOLNSbase):
         """ Show all the details of a provider config. """
         #print "MOLNSProvider.show_provider(args={0}, config={1})".format(args, config)
         if len(args) == 0:
-            print "USAGE: molns provider show name"
-            return
+            raise MOLNSException("USAGE: molns provider show name")
         print config.get_object(name=args[0], kind='Provider')
 
     @classmethod
@@ -1178,8 +1444,7 @@ class MOLNSProvider(MOLNSbase):
         """ Delete a provider config. """
         #print "MOLNSProvider.delete_provider(args={0}, config={1})".format(args, config)
         if len(args) == 0:
-            print "USAGE: molns provider delete name"
-            return
+            raise MOLNSException("USAGE: molns provider delete name")
         config.delete_object(name=args[0], kind='Provider')
 ###############################################
 
@@ -1187,36 +1452,36 @@ class MOLNSInstances(MOLNSbase):
     @classmethod
     def show_instances(cls, args, config):
         """ List all instances in the db """
-        instance_list = config.get_all_instances()
-        if len(instance_list) > 0:
-            table_data = []
-            for i in instance_list:
-                provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
+        def table_data(listing):
+            for l in listing:
+                i = l.instance
+                provider_name = cls._listing_name(l.provider_name, 'Provider', i.provider_id)
                 if i.worker_group_id is not None:
-                    name = config.get_object_by_id(i.worker_id, 'WorkerGroup').name
+                    name = cls._listing_name(l.worker_group_name, 'WorkerGroup', i.worker_group_id)
                     itype = 'worker'
                 else:
-                    name = config.get_object_by_id(i.controller_id, 'Controller').name
+                    name = cls._listing_name(l.controller_name, 'Controller', i.controller_id)
                     itype = 'controller'
-                table_data.append([i.id, provider_name, i.provider_instance_identifier, itype, name])
-            table_print(['ID', 'provider', 'instance id', 'type', 'name'],table_data)
-        else:
-            print "No instance found"
+                yield [i.id, provider_name, i.provider_instance_identifier, itype, name]
+        listing = config.iter_instance_listing()
+        try:
+            first = next(listing)
+        except StopIteration:
+            return {'msg': "No instance found"}
+        return {'type':'table', 'column_names':['ID', 'provider', 'instance id', 'type', 'name'], 'data':table_data(itertools.chain([first], listing))}
 
     @classmethod
     def delete_instance(cls, args, config):
         """ delete an instance in the db """
         if len(args) == 0:
-            print "Usage: molns instance delete INSTANCE_ID"
-            return
+            raise MOLNSException("Usage: molns instance delete INSTANCE_ID")
         try:
             instance_id = int(args[0])
         except ValueError:
-            print "instance ID must be a integer"
-            return
+            raise MOLNSException("instance ID must be a integer")
         instance = config.get_instance_by_id(instance_id)
         if instance is None:
-            print "instance not found"
+            raise MOLNSException("instance not found")
         else:
             config.delete_instance(instance)
             print "instance {0} deleted".format(instance_id)
@@ -1225,16 +1490,120 @@ class MOLNSInstances(MOLNSbase):
     @classmethod
     def clear_instances(cls, args, config):
         """ delete all instances in the db """
-        instance_list = config.get_all_instances()
-        if len(instance_list) > 0:
-            for i in instance_list:
-                print i
-                config.delete_instance(i)
-                print "instance {0} deleted".format(i.id)
+        count = config.delete_all_instances()
+        if count > 0:
+            print "{0} instances deleted".format(count)
         else:
             print "No instance found"
 
 
+###############################################
+
+class MOLNSDaemon(MOLNSbase):
+    @classmethod
+    def start_daemon(cls, args, config):
+        """ Start molnsd, which runs the molns commands of this config dir in one long lived process. """
+        config_dir = os.path.abspath(config.get_config_dir())
+        if not os.path.isdir(config_dir):
+            os.makedirs(config_dir)
+        def serve(request):
+            return serve_daemon_request(daemon_config, request)
+        # Opened by the daemon process, on its first request.
+        daemon_config = MOLNSConfig(config_dir=config_dir)
+        pid = molns_daemon.start_daemon(config_dir, serve)
+        return {'msg':"molnsd started (pid {0})".format(pid)}
+
+    @classmethod
+    def stop_daemon(cls, args, config):
+        """ Stop molnsd. """
+        if molns_daemon.stop_daemon(config.get_config_dir()):
+            return {'msg':"molnsd stopped"}
+        return {'msg':"molnsd is not running"}
+
+    @classmethod
+    def status_daemon(cls, args, config):
+        """ Show if molnsd is running. """
+        status = molns_daemon.daemon_status(config.get_config_dir())
+        if status is None:
+            return {'msg':"molnsd is not running"}
+        return {'msg':"molnsd running (pid {0}), up {1:.0f} seconds, {2} commands served".format(status['pid'], time.time() - status['started'], status['requests'])}
+
+###############################################
+
+class MOLNSBatch(MOLNSbase):
+    @classmethod
+    def parse_batch(cls, lines):
+        """ Parse the lines of a batch file.
+
+        Each line is a molns command (the leading 'molns' is optional), with shell quoting and
+        comments.  A line that ends with '&' runs in parallel with the lines that follow it, up
+        to the next line without '&'.
+
+        Returns:
+            A list of groups of (line, args) pairs.  The commands of a group run in parallel,
+            and each group waits for the previous one.
+        Raises:
+            MOLNSException on a line that is not a valid molns command.
+        """
+        groups = []
+        group = []
+        for n, line in enumerate(lines, 1):
+            try:
+                args = shlex.split(line, comments=True)
+            except ValueError as e:
+                raise MOLNSException("line {0}: {1}".format(n, e))
+            if len(args) == 0:
+                continue
+            parallel = args[-1] == '&'
+            if parallel:
+                args = args[:-1]
+            if len(args) > 0 and args[0] == 'molns':
+                args = args[1:]
+            if len(args) == 0 or find_command(args) is None:
+                raise MOLNSException("line {0}: unknown command: {1}".format(n, line.strip()))
+            if args[0] == 'batch':
+                raise MOLNSException("line {0}: batch files can not run other batch files".format(n))
+            group.append((line.strip(), args))
+            if not parallel:
+                groups.append(group)
+                group = []
+        if len(group) > 0:
+            groups.append(group)
+        return groups
+
+    @classmethod
+    def run_batch(cls, args, config):
+        """ Run the molns commands of a file ('-' for stdin) in one process, one per line; end a line with '&' to run it in parallel with the next one. """
+        # Stops at the first command that fails, unless --keep-going is given.
+        keep_going = '--keep-going' in args
+        args = [a for a in args if a != '--keep-going']
+        if len(args) != 1:
+            raise MOLNSException("USAGE: molns batch [--keep-going] FILE|-")
+        if args[0] == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(args[0]) as fd:
+                lines = fd.readlines()
+        # The whole file is checked before any command is run.
+        groups = cls.parse_batch(lines)
+        failed = []
+        count = 0
+        for group in groups:
+            for (line, command_args) in group:
+                sys.stderr.write("molns> {0}\n".format(line))
+            if len(group) == 1:
+                exit_codes = [run_command(group[0][1], config)]
+            else:
+                # Each thread has its own datastore handle, see MOLNSbase._run_on_targets()
+                results = run_in_threads([(run_command, (command_args, config.copy())) for (line, command_args) in group], max_threads=cls.MAX_PARALLEL_TARGETS)
+                exit_codes = [1 if error is not None else result for (result, error) in results]
+            count += len(group)
+            failed += [line for ((line, command_args), exit_code) in zip(group, exit_codes) if exit_code != 0]
+            if len(failed) > 0 and not keep_going:
+                raise MOLNSException("'{0}' failed, {1} of {2} commands run".format(failed[0], count, sum([len(g) for g in groups])))
+        if len(failed) > 0:
+            raise MOLNSException("{0} of {1} commands failed: {2}".format(len(failed), count, ', '.join(["'{0}'".format(l) for l in failed])))
+
 ##############################################################################################
 ##############################################################################################
 ##############################################################################################
@@ -1250,11 +1619,18 @@ def process_output_exception(e):
     logging.exception(e)
     sys.stderr.write("Error: {0}\n".format(e))
 
-def process_output(result):
+OUTPUT_FORMATS = ['table', 'json', 'ndjson']
+
+def process_output(result, output_format='table'):
     if result is not None:
         if type(result)==dict and 'type' in result:
             if result['type'] == 'table' and 'column_names' in result and 'data' in result:
-                table_print(result['column_names'],result['data'])
+                if output_format == 'json':
+                    json_print(result['column_names'],result['data'])
+                elif output_format == 'ndjson':
+                    ndjson_print(result['column_names'],result['data'])
+                else:
+                    table_print(result['column_names'],result['data'])
             if result['type'] == 'file' and 'filename' in result and 'data' in result:
                 output_to_file(result['filename'],result['data'])
         elif type(result)==dict and 'msg' in result:
@@ -1266,7 +1642,33 @@ def output_to_file(filename, data):
     with open(filename,'w+') as fd:
         fd.write(data)
 
+def _json_row(column_names, row):
+    if len(row) != len(column_names):
+        raise Exception("len(row) != len(column_names): {0} vs {1}".format(len(row), len(column_names)))
+    return json.dumps(OrderedDict(zip(column_names, row)), default=str)
+
+def json_print(column_names, data):
+    """ Print the rows of a table as a JSON list of objects, written as the rows are produced.
+    The list is closed even if producing a row fails, so the output stays valid JSON (with the
+    rows produced before the error). """
+    sys.stdout.write('[')
+    try:
+        for n, row in enumerate(data):
+            sys.stdout.write('{0}\n{1}'.format(',' if n > 0 else '', _json_row(column_names, row)))
+            sys.stdout.flush()
+    finally:
+        sys.stdout.write('\n]\n')
+        sys.stdout.flush()
+
+def ndjson_print(column_names, data):
+    """ Print the rows of a table as JSON objects, one per line, as the rows are produced. """
+    for row in data:
+        sys.stdout.write(_json_row(column_names, row) + '\n')
+        sys.stdout.flush()
+
 def table_print(column_names, data):
+    # The column widths depend on all the rows.
+    data = list(data)
     column_width = [0]*len(column_names)
     for i,n in enumerate(column_names):
         column_width[i] = len(str(n))
@@ -1319,10 +1721,22 @@ def raw_input_default_config(q, default=None, obj=None):
     else:
         return raw_input_default(q['q'], default=default, obfuscate=False)
 
+def check_config_choice(key, conf, value):
+    """ Raise MOLNSException if the config var has 'choices' and value is not one of them. """
+    if 'choices' in conf and value not in conf['choices']:
+        raise MOLNSException("'{0}' is not a valid {1}, must be one of: {2}".format(value, key, ', '.join(conf['choices'])))
+
 def setup_object(obj):
     """ Setup a molns_datastore object using raw_input_default function. """
     for key, conf, value in obj.get_config_vars():
-        obj[key] = raw_input_default_config(conf, default=value, obj=obj)
+        while True:
+            answer = raw_input_default_config(conf, default=value, obj=obj)
+            try:
+                check_config_choice(key, conf, answer)
+                break
+            except MOLNSException as e:
+                print e
+        obj[key] = answer
 
 ###############################################
 class SubCommand():
@@ -1337,20 +1751,30 @@ class SubCommand():
     def __eq__(self, other):
         return self.command == other
 
-    def run(self, args, config_dir=None):
+    def find(self, args):
+        """ Return the Command that args (without this command) would run, or None. """
+        if len(args) > 0:
+            for c in self.subcommands:
+                if c == args[0]:
+                    return c.find(args[1:])
+        return None
+
+    def run(self, args, config):
         #print "SubCommand().run({0}, {1})".format(self.command, args)
         if len(args) > 0:
             cmd = args[0]
             for c in self.subcommands:
                 if c == cmd:
-                    return c.run(args[1:], config_dir=config_dir)
+                    return c.run(args[1:], config=config)
         raise CommandException("command not found")
 
 ###############################################
 class Command():
-    def __init__(self, command, args_defs={}, description=None, function=None):
+    def __init__(self, command, args_defs={}, description=None, function=None, run_locally=False):
         self.command = command
         self.args_defs = args_defs
+        # Commands that use the terminal (prompts, ssh/scp), or manage molnsd, are never run by molnsd.
+        self.run_locally = run_locally
         if function is None:
             raise Exception("Command must have a function")
         self.function = function
@@ -1371,33 +1795,37 @@ class Command():
     def __eq__(self, other):
         return self.command == other
 
-    def run(self, args, config_dir=None):
-        config = MOLNSConfig(config_dir=config_dir)
+    def find(self, args):
+        return self
+
+    def run(self, args, config):
         return self.function(args, config=config)
 ###############################################
 
 COMMAND_LIST = [
         # Commands to interact with the head-node.
         Command('ssh', {'name':None},
-            function=MOLNSController.ssh_controller),
+            function=MOLNSController.ssh_controller, run_locally=True),
         Command('status', {'name':None},
             function=MOLNSController.status_controller),
-        Command('start', {'name':None},
-            function=MOLNSController.start_controller),
-        Command('stop', {'name':None},
-            function=MOLNSController.stop_controller),
-        Command('terminate', {'name':None},
-            function=MOLNSController.terminate_controller),
+        Command('watch', {'name':None},
+            function=MOLNSController.watch_controller, run_locally=True),
+        Command('start', {'name ...|--all':None},
+            function=MOLNSController.start_controllers, run_locally=True),
+        Command('stop', {'name ...|--all':None},
+            function=MOLNSController.stop_controllers),
+        Command('terminate', {'name ...|--all':None},
+            function=MOLNSController.terminate_controllers),
         Command('put', {'name':None, 'file':None},
-            function=MOLNSController.put_controller),
+            function=MOLNSController.put_controller, run_locally=True),
         Command('upload', {'name':None, 'file':None},
-            function=MOLNSController.upload_controller),
+            function=MOLNSController.upload_controller, run_locally=True),
         #Command('local-connect', {'name':None},
         #    function=MOLNSController.connect_controller_to_local),
         # Commands to interact with controller
         SubCommand('controller',[
             Command('setup', {'name':None},
-                function=MOLNSController.setup_controller),
+                function=MOLNSController.setup_controller, run_locally=True),
             Command('list', {'name':None},
                 function=MOLNSController.list_controller),
             Command('show', {'name':None},
@@ -1412,23 +1840,23 @@ COMMAND_LIST = [
         # Commands to interact with Worker-Groups
         SubCommand('worker',[
             Command('setup', {'name':None},
-                function=MOLNSWorkerGroup.setup_worker_groups),
+                function=MOLNSWorkerGroup.setup_worker_groups, run_locally=True),
             Command('list', {'name':None},
                 function=MOLNSWorkerGroup.list_worker_groups),
             Command('show', {'name':None},
                 function=MOLNSWorkerGroup.show_worker_groups),
             Command('delete', {'name':None},
                 function=MOLNSWorkerGroup.delete_worker_groups),
-            Command('start', {'name':None},
-                function=MOLNSWorkerGroup.start_worker_groups),
+            Command('start', {'name ...|--all':None},
+                function=MOLNSWorkerGroup.start_worker_groups_all),
             Command('add', {'name':None},
                 function=MOLNSWorkerGroup.add_worker_groups),
             Command('status', {'name':None},
                 function=MOLNSWorkerGroup.status_worker_groups),
             #Command('stop', {'name':None},
             #    function=MOLNSWorkerGroup.stop_worker_groups),
-            Command('terminate', {'name':None},
-                function=MOLNSWorkerGroup.terminate_worker_groups),
+            Command('terminate', {'name ...|--all':None},
+                function=MOLNSWorkerGroup.terminate_worker_groups_all),
             Command('export',{'name':None},
                 function=MOLNSWorkerGroup.worker_group_export),
             Command('import',{'filename.json':None},
@@ -1437,7 +1865,7 @@ COMMAND_LIST = [
         # Commands to interact with Infrastructure-Providers
         SubCommand('provider',[
             Command('setup',{'name':None},
-                function=MOLNSProvider.provider_setup),
+                function=MOLNSProvider.provider_setup, run_locally=True),
             Command('rebuild',{'name':None},
                 function=MOLNSProvider.provider_rebuild),
             Command('list',{'name':None},
@@ -1460,6 +1888,17 @@ COMMAND_LIST = [
             Command('clear', {},
                 function=MOLNSInstances.clear_instances),
         ]),
+        Command('batch', {'FILE|-':None, '--keep-going':None},
+            function=MOLNSBatch.run_batch, run_locally=True),
+        # Commands to manage the molns daemon
+        SubCommand('daemon',[
+            Command('start', {},
+                function=MOLNSDaemon.start_daemon, run_locally=True),
+            Command('stop', {},
+                function=MOLNSDaemon.stop_daemon, run_locally=True),
+            Command('status', {},
+                function=MOLNSDaemon.status_daemon, run_locally=True),
+        ]),
                 
                 ]
 
@@ -1467,49 +1906,267 @@ def printHelp():
     print "molns <command> <command-args>"
     print " --config=[Config Directory=./.molns/]"
     print "\tSpecify an alternate config location.  (Must be first argument.)"
+    print " --max-age=[Seconds]"
+    print "\tUse the last known status of instances if it is at most this old,"
+    print "\tinstead of asking the cloud provider (status, ssh, put, upload)."
+    print " --datastore=[{0}]".format('|'.join(DATASTORE_BACKENDS.keys()))
+    print "\tSelect the datastore backend.  ('memory' keeps nothing after the command exits.)"
+    print " --output=[{0}]".format('|'.join(OUTPUT_FORMATS))
+    print "\tPrint tables as a JSON list of objects, or as one JSON object per line (ndjson)."
+    print "\tRows are printed as soon as they are known, e.g. as each provider reports its instances."
+    print " --parallel=[Hosts=16]"
+    print "\tDeploy the engines of at most this many worker hosts at the same time."
+    print " --no-daemon"
+    print "\tRun the command in this process, even if molnsd is running ('molns daemon start')."
+    print " --profile[=File]"
+    print "\tProfile the command: print the functions where the time went, and write File.pstats (cProfile)"
+    print "\tand File.collapsed (stacks sampled from all threads, for flamegraph.pl)."
+    print " --trace[=File]"
+    print "\tRecord the phases of the command (instance starts, SSH connections, remote commands, file"
+    print "\ttransfers, ...) with their host and outcome, and write them to File as a Chrome trace (chrome://tracing)."
+    print " --startup-profile"
+    print "\tReport the time spent importing molns, opening the datastore and running the command."
     for c in COMMAND_LIST:
         print c
 
 
-def parseArgs():
-    if len(sys.argv) < 2 or sys.argv[1] == '-h':
-        printHelp()
-        return
-    
-    arg_list = sys.argv[1:]
-    config_dir = './.molns/'
-    while len(arg_list) > 0 and arg_list[0].startswith('--'):
-        if arg_list[0].startswith('--config='):
-            config_dir = sys.argv[1].split('=',2)[1]
-        if arg_list[0].startswith('--debug'):
-            print "Turning on Debugging output"
-            logger.setLevel(logging.DEBUG)  #for Debugging
-        arg_list = arg_list[1:]
-    
+def iter_in_threads(calls):
+    """ Make each call, a (function, args) pair, in its own thread.  The threads are started
+    before this returns.
+    Returns:
+        A generator of (n, result, exception), where n is the index of the call, in the order
+        the calls finish.
+    """
+    done = Queue.Queue()
+    def run(n, function, args):
+        try:
+            done.put((n, function(*args), None))
+        except Exception as e:
+            logging.debug("iter_in_threads() {0} failed: {1}".format(function, e))
+            done.put((n, None, e))
+    for n, (function, args) in enumerate(calls):
+        t = threading.Thread(target=run, args=(n, function, args))
+        t.daemon = True
+        t.start()
+    def results():
+        for _ in range(len(calls)):
+            yield done.get()
+    return results()
+
+def run_in_threads(calls, max_threads=None):
+    """ Make each call, a (function, args) pair, in its own thread and wait for all of them.
+    A single call is made in the current thread.
+    Args:
+        max_threads: if given, make at most this many calls at the same time.
+    Returns:
+        A list of (result, exception) pairs, in the order of the calls.
+    """
+    results = [(None, None)] * len(calls)
+    def run(n, function, args):
+        try:
+            results[n] = (function(*args), None)
+        except Exception as e:
+            logging.debug("run_in_threads() {0} failed: {1}".format(function, e))
+            results[n] = (None, e)
+    if len(calls) == 1:
+        run(0, *calls[0])
+        return results
+    if max_threads is not None and max_threads < len(calls):
+        todo = Queue.Queue()
+        for n, call in enumerate(calls):
+            todo.put((n, call))
+        def run_next():
+            while True:
+                try:
+                    (n, (function, args)) = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                run(n, function, args)
+        threads = [threading.Thread(target=run_next) for _ in range(max_threads)]
+    else:
+        threads = [threading.Thread(target=run, args=(n, function, args)) for n, (function, args) in enumerate(calls)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def print_startup_profile(config, command_start_time):
+    """ Print where the time of this molns run went, to stderr. """
+    now = time.time()
+    sys.stderr.write("startup profile:\n")
+    sys.stderr.write("  import molns:    {0:.3f}s\n".format(_import_time - _startup_time))
+    command_time = now - command_start_time
+    if config.datastore_open_time is None:
+        sys.stderr.write("  open datastore:  not opened\n")
+    else:
+        sys.stderr.write("  import backend:  {0:.3f}s ({1})\n".format(config.datastore_import_time, config.backend))
+        sys.stderr.write("  open datastore:  {0:.3f}s\n".format(config.datastore_open_time))
+        command_time -= config.datastore_import_time + config.datastore_open_time
+    sys.stderr.write("  command:         {0:.3f}s\n".format(command_time))
+    sys.stderr.write("  total:           {0:.3f}s\n".format(now - _startup_time))
+    loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+    sys.stderr.write("  heavy modules:   {0}\n".format(', '.join(loaded) if len(loaded) > 0 else 'none'))
+
+def find_command(arg_list):
+    """ Return the Command that arg_list would run, or None. """
+    for cmd in COMMAND_LIST:
+        if len(arg_list) > 0 and cmd == arg_list[0]:
+            return cmd.find(arg_list[1:])
+    return None
+
+def serve_daemon_request(config, request):
+    """ Run a command sent to molnsd by a client (see run_command). """
+    config.refresh()
+    config.status_max_age = request.get('status_max_age')
+    config.output_format = request.get('output_format', 'table')
+    config.max_parallel = request.get('max_parallel')
+    os.chdir(request['cwd'])
+    return run_command(request['args'], config)
+
+def run_command(arg_list, config):
+    """ Run the command given by arg_list (without the global options).
+    Returns:
+        The exit code: 0 on success, 1 if the command failed or is unknown.
+    """
     if len(arg_list) == 0 or arg_list[0] =='help' or arg_list[0] == '-h':
         printHelp()
-        return
+        return 0
         
     if arg_list[0] in COMMAND_LIST:
         for cmd in COMMAND_LIST:
             if cmd == arg_list[0]:
                 try:
-                    output = cmd.run(arg_list[1:], config_dir=config_dir)
-                    process_output(output)
-                    return
+                    with molns_trace.span('command', command=' '.join(arg_list)):
+                        output = cmd.run(arg_list[1:], config=config)
+                        process_output(output, config.output_format)
+                    # A command that partly failed (e.g. on some of the hosts) shows its output,
+                    # and the error.
+                    if isinstance(output, dict) and output.get('error') is not None:
+                        sys.stderr.write("Error: {0}\n".format(output['error']))
+                        return 1
+                    return 0
                 except CommandException:
                     pass
                 except Exception as e:
                     process_output_exception(e)
-                    return
+                    return 1
 
     print "unknown command: " +  " ".join(arg_list)
     #printHelp()
     print "use 'molns help' to see all possible commands"
+    return 1
+
+def parseArgs():
+    """ Run the command of the command line.
+    Returns:
+        The exit code of molns.
+    """
+    if len(sys.argv) < 2 or sys.argv[1] == '-h':
+        printHelp()
+        return 0
+    
+    arg_list = sys.argv[1:]
+    config_dir = './.molns/'
+    status_max_age = None
+    backend = 'sqlite'
+    output_format = 'table'
+    max_parallel = None
+    startup_profile = False
+    profile = False
+    profile_file = None
+    trace = False
+    trace_file = None
+    use_daemon = True
+    debug = False
+    while len(arg_list) > 0 and arg_list[0].startswith('--'):
+        if arg_list[0].startswith('--config='):
+            config_dir = arg_list[0].split('=',2)[1]
+        if arg_list[0].startswith('--max-age='):
+            try:
+                status_max_age = float(arg_list[0].split('=',2)[1])
+            except ValueError:
+                print "--max-age must be a number of seconds"
+                return 1
+        if arg_list[0].startswith('--datastore='):
+            backend = arg_list[0].split('=',2)[1]
+            if backend not in DATASTORE_BACKENDS:
+                print "--datastore must be one of {0}".format(', '.join(DATASTORE_BACKENDS.keys()))
+                return 1
+        if arg_list[0].startswith('--output='):
+            output_format = arg_list[0].split('=',2)[1]
+            if output_format not in OUTPUT_FORMATS:
+                print "--output must be one of {0}".format(', '.join(OUTPUT_FORMATS))
+                return 1
+        if arg_list[0].startswith('--parallel='):
+            try:
+                max_parallel = int(arg_list[0].split('=',2)[1])
+            except ValueError:
+                max_parallel = 0
+            if max_parallel < 1:
+                print "--parallel must be a number of hosts, at least 1"
+                return 1
+        if arg_list[0].startswith('--debug'):
+            print "Turning on Debugging output"
+            logger.setLevel(logging.DEBUG)  #for Debugging
+            debug = True
+        if arg_list[0] == '--no-daemon':
+            use_daemon = False
+        if arg_list[0] == '--startup-profile':
+            startup_profile = True
+        if arg_list[0] == '--trace' or arg_list[0].startswith('--trace='):
+            trace = True
+            if '=' in arg_list[0]:
+                trace_file = arg_list[0].split('=',2)[1]
+        if arg_list[0] == '--profile' or arg_list[0].startswith('--profile='):
+            profile = True
+            if '=' in arg_list[0]:
+                profile_file = arg_list[0].split('=',2)[1]
+        arg_list = arg_list[1:]
+
+    # Hand the command to molnsd if it is running for this config dir.
+    command = find_command(arg_list)
+    if use_daemon and command is not None and not command.run_locally and backend == 'sqlite' and not debug and not startup_profile and not profile and not trace:
+        request = {'args':arg_list, 'cwd':os.getcwd(), 'status_max_age':status_max_age, 'output_format':output_format, 'max_parallel':max_parallel}
+        try:
+            exit_code = molns_daemon.run_in_daemon(config_dir, request)
+            if exit_code is not None:
+                return exit_code
+        except molns_daemon.DaemonException as e:
+            process_output_exception(e)
+            return 1
+
+    # The datastore is only opened when the command uses it.
+    config = MOLNSConfig(config_dir=config_dir, status_max_age=status_max_age, backend=backend, output_format=output_format, max_parallel=max_parallel)
+    profiler = None
+    if profile:
+        from MolnsLib.molns_profile import CommandProfiler
+        profiler = CommandProfiler(profile_file)
+    if trace:
+        molns_trace.start(trace_file)
+    command_start_time = time.time()
+    try:
+        if profiler is not None:
+            profiler.start()
+        try:
+            exit_code = run_command(arg_list, config)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+    finally:
+        if startup_profile or profile:
+            print_startup_profile(config, command_start_time)
+        if profiler is not None:
+            profiler.report(sys.stderr)
+            sys.stderr.write("Profile written to {0}\n".format(', '.join(profiler.write())))
+        if trace:
+            sys.stderr.write("Trace written to {0}\n".format(molns_trace.stop()))
+    return exit_code
 
 
 if __name__ == "__main__":
     logger = logging.getLogger()
     #logger.setLevel(logging.INFO)  #for Debugging
     logger.setLevel(logging.CRITICAL)
-    parseArgs()
+    sys.exit(parseArgs())